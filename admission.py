@@ -0,0 +1,110 @@
+"""
+ADMISSION.PY
+
+Per-user token buckets that decide, before any handler runs, whether an expensive update
+(/start or an upload) is handled. Each user may make `burst` requests at once and earns
+`rate_per_minute` more per minute. The first refused request after a run of admitted ones
+gets a cooldown notice; later ones are dropped silently. A user refused `strikes_to_ignore`
+times in a row is ignored outright for `ignore_seconds`.
+
+All videos of one album (media group) are charged as a single request.
+
+Buckets of users who have been quiet long enough to be full again (and are not being
+ignored) are forgotten, and at most `max_users` buckets are kept, so memory stays bounded.
+"""
+
+import logging
+import time
+from collections import Counter, OrderedDict
+from enum import Enum
+
+
+class Decision(Enum):
+    ADMIT = "admit"
+    NOTIFY = "notify"  # Refused; tell the user to slow down
+    DROP = "drop"  # Refused silently
+
+
+class _Bucket(object):
+
+    __slots__ = ("tokens", "updated_at", "strikes", "notified", "ignored_until", "media_group_id")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        self.strikes = 0
+        self.notified = False
+        self.ignored_until = 0.0
+        self.media_group_id = None
+
+
+class AdmissionControl(object):
+
+    def __init__(self, rate_per_minute: float, burst: int, strikes_to_ignore: int = 20,
+                 ignore_seconds: float = 600, max_users: int = 100000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(burst, 1)
+        self.strikes_to_ignore = strikes_to_ignore
+        self.ignore_seconds = ignore_seconds
+        self.max_users = max(max_users, 1)
+        self.counters = Counter()
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def admit(self, user_id: int, media_group_id: str = None) -> Decision:
+        now = time.monotonic()
+        self._expire(now)
+        bucket = self._buckets.pop(user_id, None) or _Bucket(self.burst, now)
+        self._buckets[user_id] = bucket
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+        bucket.updated_at = now
+
+        if bucket.ignored_until > now:
+            self.counters["ignored"] += 1
+            return Decision.DROP
+
+        if media_group_id is not None and media_group_id == bucket.media_group_id:
+            self.counters["admitted"] += 1
+            return Decision.ADMIT
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.strikes = 0
+            bucket.notified = False
+            bucket.media_group_id = media_group_id
+            self.counters["admitted"] += 1
+            return Decision.ADMIT
+
+        self.counters["throttled"] += 1
+        bucket.strikes += 1
+        if self.strikes_to_ignore and bucket.strikes >= self.strikes_to_ignore:
+            bucket.ignored_until = now + self.ignore_seconds
+            bucket.strikes = 0
+            self.counters["offenders"] += 1
+            logging.warning("Ignoring user %s for %ss after repeated flooding.", user_id, self.ignore_seconds)
+            return Decision.DROP
+        if not bucket.notified:
+            bucket.notified = True
+            self.counters["notified"] += 1
+            return Decision.NOTIFY
+        return Decision.DROP
+
+    def _expire(self, now: float) -> None:
+        # Least recently seen first; stop at the first bucket that still matters
+        refill_seconds = self.burst / self.rate if self.rate else float("inf")
+        while self._buckets:
+            user_id, bucket = next(iter(self._buckets.items()))
+            idle = now - bucket.updated_at >= refill_seconds and bucket.ignored_until <= now
+            if not idle and len(self._buckets) < self.max_users:
+                break
+            self._buckets.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            **{name: self.counters[name] for name in ("admitted", "throttled", "notified", "ignored", "offenders")},
+            "tracked_users": len(self._buckets),
+            "ignored_users": sum(1 for bucket in self._buckets.values() if bucket.ignored_until > now),
+        }
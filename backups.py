@@ -0,0 +1,134 @@
+"""
+BACKUPS.PY
+
+Online backups of the bot's SQLite database while the bot keeps running.
+
+The copy is made with SQLite's online backup API from a separate read connection, a few
+pages per step with a short pause after each. That connection holds a read transaction
+for the whole copy, so the snapshot is consistent and the backup never restarts, while
+the bot's writes carry on in the WAL. Each copy is gzipped next to the earlier ones and
+only the newest `keep` are kept.
+
+These functions block; the bot runs them in a thread. They also work from the command
+line, e.g. to check a backup before restoring it:
+
+    python backups.py verify backups/bouncerbot_2024-05-01_03-00-00.db.gz
+
+To restore, stop the bot, gunzip a verified backup over DATABASE_PATH (and remove any
+leftover -wal and -shm files next to it), then start the bot again.
+"""
+
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+BACKUP_PREFIX = "bouncerbot_"
+BACKUP_SUFFIX = ".db.gz"
+
+
+def backup_database(source_path: str, backup_directory: str, pages_per_step: int = 100,
+                    step_pause: float = 0.005) -> dict:
+    """copy the database into a new gzip snapshot in backup_directory and return a report"""
+    os.makedirs(backup_directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    backup_path = os.path.join(backup_directory, f"{BACKUP_PREFIX}{stamp}{BACKUP_SUFFIX}")
+    copy_path = backup_path[:-len(".gz")] + ".partial"
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        time.sleep(step_pause)  # Lets the bot's own statements in between steps
+
+    started = time.perf_counter()
+    try:
+        source = sqlite3.connect(source_path, isolation_level=None)
+        destination = sqlite3.connect(copy_path)
+        try:
+            source.execute("BEGIN")
+            source.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # Starts the read transaction
+            source.backup(destination, pages=pages_per_step, progress=progress)
+            source.execute("COMMIT")
+        finally:
+            destination.close()
+            source.close()
+        copied = time.perf_counter()
+
+        with open(copy_path, "rb") as f_in, gzip.open(backup_path + ".tmp", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(backup_path + ".tmp", backup_path)
+        database_bytes = os.path.getsize(copy_path)
+    finally:
+        for leftover in (copy_path, backup_path + ".tmp"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return {
+        "path": backup_path,
+        "database_bytes": database_bytes,
+        "compressed_bytes": os.path.getsize(backup_path),
+        "steps": steps,
+        "copy_seconds": round(copied - started, 2),
+        "compress_seconds": round(time.perf_counter() - copied, 2),
+    }
+
+
+def list_backups(backup_directory: str) -> list:
+    """backup paths, oldest first (the timestamped names sort by age)"""
+    return sorted(glob.glob(os.path.join(backup_directory, f"{BACKUP_PREFIX}*{BACKUP_SUFFIX}")))
+
+
+def rotate_backups(backup_directory: str, keep: int) -> list:
+    """delete all but the newest `keep` backups and return the deleted paths"""
+    backups = list_backups(backup_directory)
+    removed = backups[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def verify_backup(backup_path: str) -> dict:
+    """unpack a backup into a temporary file and check that it opens, passes PRAGMA integrity_check
+    and has readable tables. returns {"ok", "integrity", "schema_version", "tables": {name: rows}}"""
+    handle, restore_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(backup_path) or ".")
+    try:
+        with os.fdopen(handle, "wb") as f_out, gzip.open(backup_path, "rb") as f_in:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        connection = sqlite3.connect(restore_path)
+        try:
+            integrity = "; ".join(row[0] for row in connection.execute("PRAGMA integrity_check").fetchall())
+            schema_version = connection.execute("PRAGMA user_version").fetchone()[0]
+            table_names = [row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+            tables = {name: connection.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in table_names}
+        finally:
+            connection.close()
+    except (OSError, EOFError, sqlite3.Error) as e:
+        return {"ok": False, "integrity": str(e), "schema_version": None, "tables": {}}
+    finally:
+        for path in (restore_path, restore_path + "-wal", restore_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    return {"ok": integrity == "ok", "integrity": integrity, "schema_version": schema_version, "tables": tables}
+
+
+def main(argv) -> None:
+    if len(argv) != 2 or argv[0] != "verify":
+        sys.exit("Usage: python backups.py verify <backup.db.gz>")
+    result = verify_backup(argv[1])
+    print(f"integrity: {result['integrity']}")
+    print(f"schema version: {result['schema_version']}")
+    for name, rows in result["tables"].items():
+        print(f"    {name}: {rows} rows")
+    sys.exit(0 if result["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
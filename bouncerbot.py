@@ -7,94 +7,190 @@ Authored by Shinanygans (shinanygans@proton.me)
 This bot will as for a sample media contribution before responding with a link that the user can access.
 """
 
+import time
+# Taken before the heavy imports so the startup report covers them
+startup_started = time.perf_counter()
+
 import logging
+import os
 import re
-import sys
-import inspect
-from logging.handlers import TimedRotatingFileHandler
+import signal
+from pathlib import Path
 from datetime import datetime, timedelta, timezone
 import pytz
 import asyncio
 import csv
+import io
+import json
+from collections import deque
 from functools import wraps
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo, ReplyParameters
 from telegram.constants import ChatType, ParseMode
-from telegram.error import RetryAfter, Forbidden, TimedOut, BadRequest, NetworkError
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError
 from telegram.ext import (
+    ApplicationHandlerStop,
     ChatMemberHandler,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     CallbackContext,
     Application,
 )
-from db_utils import Database
-from config import (
-    BOT_TOKEN,
-    AUTHORIZED_ADMINS,
-    START_MESSAGE,
-    MINUTES_TO_LINK_EXPIRATION,
-    UPLOADS_NEEDED,
-    HELP_MESSAGE,
-    SETUP_MESSAGE,
-    VIDEO_REVIEW_GROUP_ID
-)
-
-
-
-# Configure logging
-when = 'midnight'  # Rotate logs at midnight (other options include 'H', 'D', 'W0' - 'W6', 'MIDNIGHT', or a custom time)
-interval = 1  # Rotate daily
-backup_count = 7  # Retain logs for 7 days
-log_handler = TimedRotatingFileHandler('app.log', when=when, interval=interval, backupCount=backup_count)
-log_handler.suffix = "%Y-%m-%d"  # Suffix for log files (e.g., 'my_log.log.2023-10-22')
-
-logging.basicConfig(
-    level=logging.WARNING,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        log_handler,
-    ]
-)
+from db_utils import Database, FUNNEL_COUNTERS
+from log_utils import configure_logging
+from error_utils import ErrorReporter
+from media_index import BloomFilter
+from state_backend import create_state_backend
+from dispatch_queue import DispatchQueue, RateLimiter, call_with_retry, retry_after_seconds
+from invite_links import OutstandingLinks
+from admission import AdmissionControl, Decision
+from chat_registry import ChatRegistry
+from event_journal import EventJournal, EVENT_KINDS, EVENT_TIME_FORMAT
+from backups import backup_database, list_backups, rotate_backups, verify_backup
+import config
+from runtime_config import RuntimeConfig, ConfigError, RELOADABLE, parse_value
+import fingerprints
+from fingerprints import Fingerprinter, FingerprintIndex
+from profiling import profiler, traced, write_chrome_trace, ProfilingApplication, TracingRequest
+from config import BOT_TOKEN
+# Settings added since the first release. Older config.py files may not have them, so sample_config.py's defaults apply
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+ERROR_LOG_WINDOW_SECONDS = getattr(config, "ERROR_LOG_WINDOW_SECONDS", 60)
+ERROR_TRACEBACK_SAMPLE_RATE = getattr(config, "ERROR_TRACEBACK_SAMPLE_RATE", 0.01)
+MEDIA_REUSE_LIMIT = getattr(config, "MEDIA_REUSE_LIMIT", 0)
+MEDIA_REUSE_POLICY = getattr(config, "MEDIA_REUSE_POLICY", "downweight")
+MEDIA_INDEX_BLOOM_CAPACITY = getattr(config, "MEDIA_INDEX_BLOOM_CAPACITY", 1000000)
+STATE_BACKEND_URL = getattr(config, "STATE_BACKEND_URL", "memory://")
+WORKER_COUNT = getattr(config, "WORKER_COUNT", 1)
+WORKER_INDEX = getattr(config, "WORKER_INDEX", 0)
+SCHEDULER_TICK_SECONDS = getattr(config, "SCHEDULER_TICK_SECONDS", 1)
+SCHEDULER_BATCH_SIZE = getattr(config, "SCHEDULER_BATCH_SIZE", 100)
+MAINTENANCE_INTERVAL_MINUTES = getattr(config, "MAINTENANCE_INTERVAL_MINUTES", 60)
+MAINTENANCE_TIME_BUDGET_SECONDS = getattr(config, "MAINTENANCE_TIME_BUDGET_SECONDS", 5)
+ABANDONED_USER_RETENTION_DAYS = getattr(config, "ABANDONED_USER_RETENTION_DAYS", 90)
+ARCHIVE_ABANDONED_USERS = getattr(config, "ARCHIVE_ABANDONED_USERS", True)
+REVIEW_MESSAGES_PER_MINUTE = getattr(config, "REVIEW_MESSAGES_PER_MINUTE", 20)
+REVIEW_BACKLOG_WARNING = getattr(config, "REVIEW_BACKLOG_WARNING", 50)
+LINK_REVOCATIONS_PER_MINUTE = getattr(config, "LINK_REVOCATIONS_PER_MINUTE", 20)
+OUTSTANDING_LINKS_CAPACITY = getattr(config, "OUTSTANDING_LINKS_CAPACITY", 100000)
+ADMISSION_RATE_PER_MINUTE = getattr(config, "ADMISSION_RATE_PER_MINUTE", 10)
+ADMISSION_BURST = getattr(config, "ADMISSION_BURST", 10)
+ADMISSION_STRIKES_TO_IGNORE = getattr(config, "ADMISSION_STRIKES_TO_IGNORE", 20)
+ADMISSION_IGNORE_MINUTES = getattr(config, "ADMISSION_IGNORE_MINUTES", 10)
+NEAR_DUPLICATE_DETECTION = getattr(config, "NEAR_DUPLICATE_DETECTION", False)
+NEAR_DUPLICATE_MAX_DISTANCE = getattr(config, "NEAR_DUPLICATE_MAX_DISTANCE", 6)
+FINGERPRINT_WORKERS = getattr(config, "FINGERPRINT_WORKERS", 2)
+BACKUP_INTERVAL_HOURS = getattr(config, "BACKUP_INTERVAL_HOURS", 24)
+BACKUP_DIRECTORY = getattr(config, "BACKUP_DIRECTORY", "backups")
+BACKUP_KEEP = getattr(config, "BACKUP_KEEP", 7)
+BACKUP_VERIFY = getattr(config, "BACKUP_VERIFY", True)
 
-# Create a separate handler for console output with a higher level (WARNING)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.WARNING)  # Set the level to WARNING or higher
-console_formatter = logging.Formatter("BOUNCERBOT: %(message)s")
-console_handler.setFormatter(console_formatter)
-
-# Attach the console handler to the root logger
-logging.getLogger().addHandler(console_handler)
 
 
 # Global variables
 bouncerbot = None
 app = None
-db = Database()
+db = None  # opened by build_application()
+# UPLOADS_NEEDED, AUTHORIZED_ADMINS, the messages etc. Reloadable with /reload or SIGHUP (see reload_config)
+runtime_config = RuntimeConfig(config)
+chat_registry = None  # created with db
+# With several workers, chats recorded by the others are picked up this often
+CHAT_REGISTRY_REFRESH_SECONDS = 60
 utc_timezone = pytz.utc
-cached_active_chats = {}
-
-# Dictionary to keep track of media groups that have been processed
-processed_media_groups = {}
+error_reporter = ErrorReporter(ERROR_LOG_WINDOW_SECONDS, ERROR_TRACEBACK_SAMPLE_RATE)
+media_filter = BloomFilter(MEDIA_INDEX_BLOOM_CAPACITY)
+
+# Unused invite links, so join events resolve without a query (see track_used_link)
+outstanding_links = OutstandingLinks(OUTSTANDING_LINKS_CAPACITY)
+outstanding_links.complete = False  # until load_outstanding_links has run
+pending_links_used = []
+LINK_USED_FLUSH_SECONDS = 2
+LINK_USED_FLUSH_SIZE = 100
+
+# Append-only journal of user events, written to the database in batches (see flush_events)
+journal = EventJournal(capacity=50000)
+EVENT_FLUSH_SECONDS = 2
+EVENTS_DEFAULT_DAYS = 1
+
+# Thumbnail fingerprints of past uploads (see near_duplicate_check)
+near_duplicates_enabled = NEAR_DUPLICATE_DETECTION and fingerprints.available
+fingerprinter = Fingerprinter(FINGERPRINT_WORKERS)
+fingerprint_index = FingerprintIndex(NEAR_DUPLICATE_MAX_DISTANCE)
+
+# Per-user flood protection for /start and uploads (see admission_check)
+admission = AdmissionControl(ADMISSION_RATE_PER_MINUTE, ADMISSION_BURST,
+                             strikes_to_ignore=ADMISSION_STRIKES_TO_IGNORE, ignore_seconds=ADMISSION_IGNORE_MINUTES * 60)
+
+# Startup report (see note_first_update)
+startup_timings = {"imports_ms": round((time.perf_counter() - startup_started) * 1000, 1)}
+first_update_seen = False
+media_filter_ready = False
+STARTUP_PROBE_CONCURRENCY = 5
+
+# Online backups (see run_backup)
+BACKUP_PAGES_PER_STEP = 100
+BACKUP_STEP_PAUSE_SECONDS = 0.005
+backup_lock = asyncio.Lock()
+
+# /stats (see stats_command)
+STATS_WINDOW_DAYS = (1, 7, 30)
+STATS_ERRORS_SHOWN = 10  # Most frequent error:function pairs listed
+
+# /profile (see profile_command)
+PROFILE_DEFAULT_UPDATES = 50
+PROFILE_MAX_UPDATES = 1000
+
+# Seen chats, registration menus and grant locks, shared between workers
+state = create_state_backend(STATE_BACKEND_URL)
+ROUTED_UPDATE_IDS_KEPT = 10000  # Recently consumed update ids, to skip an update routed twice (see run_partition_worker)
+GRANT_LOCK_SECONDS = 30
+REGISTER_MENU_SECONDS = 3600
+REGISTER_PAGE_SIZE = 20
+
+# Durable scheduled jobs (see run_scheduled_jobs)
+MEDIA_GROUP_DELAY_SECONDS = 1.2
+CONFIRMATION_DELETE_SECONDS = 3
+JOB_LEASE_SECONDS = 60
+JOB_MAX_ATTEMPTS = 5
+
+# Database maintenance (see run_maintenance)
+MAINTENANCE_SLICE_ROWS = 500
+MAINTENANCE_VACUUM_PAGES = 200
+
+# Moving users out of the pre-split users table (see migrate_legacy_users)
+USER_MIGRATION_BATCH_SIZE = 1000
+USER_MIGRATION_PAUSE_SECONDS = 0.05
+
+# Revoking dead invite links in Telegram (see revoke_stale_links)
+LINK_REVOCATION_INTERVAL_SECONDS = 60
+LINK_REVOCATION_BATCH_SIZE = 200
+revocation_limiter = RateLimiter(LINK_REVOCATIONS_PER_MINUTE)
+revocation_lock = asyncio.Lock()
+revocation_stats = {"revoked": 0, "given_up": 0}
+
+# Chat cleanup (see clean_inactive_chats)
+CHAT_CLEANUP_BATCH_SIZE = 500
+CHAT_CLEANUP_PAUSE_SECONDS = 0.05
+CHAT_CLEANUP_LOCK_SECONDS = 300
+
+# /bulkban (see bulk_ban)
+BULK_BAN_CONCURRENCY = 5
+BULK_BAN_MAX_RETRIES = 3
+BULK_BAN_PROGRESS_SECONDS = 3
 
 
 ########## ERROR HANDLING ##########
 def handle_error(exception: Exception):
-    exc_type, exc_value, exc_traceback = sys.exc_info()
-    current_frame = inspect.currentframe()
-    caller_frame = current_frame.f_back if current_frame else None
-    function_name = caller_frame.f_code.co_name if caller_frame else 'Unknown'
-    
-    logging.warning(
-        f"Error in function '{function_name}' - {exception}. "
-        f"Exception Raised In: {exc_traceback.tb_frame.f_code.co_name} - "
-        f"Line: {exc_traceback.tb_lineno} - "
-        f"Type: {exc_type}. "
-
-    )
+    error_reporter.report(exception)
     return
 
+# Forwards to VIDEO_REVIEW_GROUP_ID, paced per chat (see forward_media_to_admin_group)
+review_queue = DispatchQueue(REVIEW_MESSAGES_PER_MINUTE, backlog_warning=REVIEW_BACKLOG_WARNING,
+                             on_error=handle_error, name="Review queue")
+ALBUM_LIMIT = 10
+
 ########## WRAPPERS ##########
 def user_not_banned(handler_function):
     @wraps(handler_function)
@@ -118,7 +214,8 @@ def authorized_admin_check(handler_function):
     async def wrapper(update: Update, context: CallbackContext):
         try:
             user_id = update.effective_user.id
-            if AUTHORIZED_ADMINS and user_id not in AUTHORIZED_ADMINS:
+            authorized_admins = runtime_config.AUTHORIZED_ADMINS
+            if authorized_admins and user_id not in authorized_admins:
                 return 
             else:
                 return await handler_function(update, context)
@@ -184,47 +281,209 @@ def parse_user_tuple_list_from_db(user_tuple_list):
     return user_dict
 
 
-def create_keyboard_from_active_chats():
+def create_keyboard_from_active_chats(page_number=0):
     buttons = []
-    button_names={}
-    active_chats = db.return_all_active_chats()
-    for chat_id, chat_title in active_chats.items():
-        buttons.append(InlineKeyboardButton(chat_title, callback_data=f"activechats_{chat_id}"))
-        button_names[chat_id] = chat_title
-
-    buttons.append(InlineKeyboardButton("None", callback_data="activechats_None"))
+    chats, page_number, pages = chat_registry.page(page_number, REGISTER_PAGE_SIZE)
+    for chat_id, chat_title in chats:
+        buttons.append(InlineKeyboardButton(chat_title or str(chat_id), callback_data=f"activechats_{chat_id}"))
 
     # Create a two-column layout for the buttons
     keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
 
-    # Create an inline keyboard markup
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Telegram caps the size of a keyboard, so long chat lists are split into pages
+    if pages > 1:
+        navigation = []
+        if page_number > 0:
+            navigation.append(InlineKeyboardButton("« Previous", callback_data=f"registerpage_{page_number - 1}"))
+        navigation.append(InlineKeyboardButton(f"{page_number + 1} / {pages}", callback_data=f"registerpage_{page_number}"))
+        if page_number < pages - 1:
+            navigation.append(InlineKeyboardButton("Next »", callback_data=f"registerpage_{page_number + 1}"))
+        keyboard.append(navigation)
+
+    keyboard.append([InlineKeyboardButton("None", callback_data="activechats_None")])
 
-    return reply_markup, button_names
+    # Create an inline keyboard markup
+    return InlineKeyboardMarkup(keyboard)
 
 
 def list_active_chats():
     response_text = "ACTIVE CHATS:\n\n"
-    active_chats = db.return_all_active_chats()
-    for chat_id, chat_title in active_chats.items():
+    for chat_id, chat_title in chat_registry.items():
         response_text += f"{chat_id} - {chat_title}\n"
     return response_text
 
 
+def media_is_recycled(unique_file_id) -> bool:
+    """Return True if more than MEDIA_REUSE_LIMIT other users have already submitted this file."""
+    if not MEDIA_REUSE_LIMIT:
+        return False
+    # Each worker only sees its own additions, so the filter can only rule files out with a single worker
+    if WORKER_COUNT == 1 and media_filter_ready and unique_file_id not in media_filter:
+        return False
+    return db.lookup_media_reuse_count(unique_file_id) > MEDIA_REUSE_LIMIT
+
+
+def record_upload(user_id, file_id, unique_file_id, chat_id, counted=True, fingerprint=None):
+    """Store an upload and return the user's new upload count, or None if they already sent this file."""
+    uploads_needed, _ = destination_settings(chat_id)
+    stored_fingerprint = fingerprints.to_signed(fingerprint) if fingerprint is not None else None
+    num_uploads = db.record_upload(user_id, file_id, unique_file_id, chat_id, counted, uploads_needed, stored_fingerprint)
+    if num_uploads is None:
+        journal.record("duplicate", user_id, chat_id, file=unique_file_id, reason="repeat")
+        return None
+    journal.record("uploaded", user_id, chat_id, file=unique_file_id, counted=counted)
+    media_filter.add(unique_file_id)
+    if fingerprint is not None:
+        fingerprint_index.add(fingerprint, (user_id, chat_id))
+    return num_uploads
+
+
+async def fingerprint_video(bot, thumbnail_file_id):
+    """Return the fingerprint of a video's thumbnail, or None if detection is off or the thumbnail can't be read."""
+    if not near_duplicates_enabled or not thumbnail_file_id:
+        return None
+    try:
+        thumbnail = await bot.get_file(thumbnail_file_id)
+        return await fingerprinter.fingerprint(await thumbnail.download_as_bytearray())
+    except Exception as e:
+        logging.debug("Could not fingerprint thumbnail %s: %s", thumbnail_file_id, e)
+        return None
+
+
+def near_duplicate_check(fingerprint, user_id, chat_id) -> tuple:
+    """Return (duplicate, recycled): whether the user already sent a near copy of this video for the chat,
+    and whether more than MEDIA_REUSE_LIMIT other users have."""
+    if fingerprint is None:
+        return False, False
+    matches = fingerprint_index.search(fingerprint)
+    if any(value == (user_id, chat_id) for _, value in matches):
+        return True, False
+    other_users = {value[0] for _, value in matches if value[0] != user_id}
+    return False, bool(MEDIA_REUSE_LIMIT) and len(other_users) > MEDIA_REUSE_LIMIT
+
+
+async def load_fingerprint_index(batch_size=10000):
+    # Like load_media_filter: yields between batches while updates are handled.
+    # Until it finishes, near copies of older uploads can slip through.
+    fingerprint_index.clear()
+    for position, (fingerprint, user_id, chat_id) in enumerate(db.iterate_video_fingerprints(batch_size), 1):
+        fingerprint_index.add(fingerprints.to_unsigned(fingerprint), (user_id, chat_id))
+        if position % batch_size == 0:
+            await asyncio.sleep(0)
+    logging.info("Loaded %s video fingerprints.", len(fingerprint_index))
+
+
+async def load_media_filter(batch_size=10000):
+    # Runs while updates are being handled, so it yields between batches.
+    # media_is_recycled asks the database until the filter is complete.
+    global media_filter_ready
+    media_filter_ready = False
+    media_filter.clear()
+    for position, unique_file_id in enumerate(db.iterate_media_index_ids(batch_size), 1):
+        media_filter.add(unique_file_id)
+        if position % batch_size == 0:
+            await asyncio.sleep(0)
+    media_filter_ready = True
+    logging.info("Loaded %s media ids into the media index filter.", media_filter.count)
+
+
+def default_destination_chat_id():
+    destination_chat_id = db.lookup_setting("destination_chat_id")
+    return int(destination_chat_id) if destination_chat_id else None
+
+
+def resolve_destination_chat_id(args) -> int:
+    """Return the destination chat named by a /start deep-link payload, or the default destination."""
+    if args:
+        try:
+            chat_id = int(args[0])
+            if db.lookup_destination_chat(chat_id) is not None:
+                return chat_id
+        except ValueError:
+            pass
+    return default_destination_chat_id()
+
+
+def current_destination_chat_id(user_id) -> int:
+    """Return the destination chat the user last started the bot for."""
+    chat_id = db.lookup_user_destination(user_id)
+    return chat_id if chat_id is not None else default_destination_chat_id()
+
+
+def destination_settings(chat_id) -> tuple:
+    """Return (uploads_needed, minutes_to_link_expiration) for a destination chat, falling back to config."""
+    chat_settings = db.lookup_destination_chat(chat_id) if chat_id else None
+    uploads_needed, minutes_to_link_expiration = chat_settings if chat_settings else (None, None)
+    return (
+        runtime_config.UPLOADS_NEEDED if uploads_needed is None else uploads_needed,
+        runtime_config.MINUTES_TO_LINK_EXPIRATION if minutes_to_link_expiration is None else minutes_to_link_expiration,
+    )
+
+
+async def state_call(method, *args, **kwargs):
+    """Call a state backend method, in a thread if the backend waits on the network."""
+    if state.blocking:
+        return await asyncio.to_thread(method, *args, **kwargs)
+    return method(*args, **kwargs)
+
+
+def lock_token() -> str:
+    # A value no other task uses, so a backend can tell whether a lock it lost the reply for is ours
+    return f"{WORKER_INDEX}:{os.urandom(8).hex()}"
+
+
+async def acquire_grant_lock(user_id, chat_id) -> bool:
+    """Claim the right to mint a link for this user and chat, so two workers or tasks never both grant one."""
+    return await state_call(state.set_if_absent, f"grant_lock:{user_id}:{chat_id}", lock_token(), ttl=GRANT_LOCK_SECONDS)
+
+
+async def release_grant_lock(user_id, chat_id):
+    await state_call(state.delete, f"grant_lock:{user_id}:{chat_id}")
+
+
+def record_granted_link(user_id, invite_link, chat_id):
+    """Store a newly granted link, remember it for join events, and schedule its expiry."""
+    db.record_access_granted(user_id, invite_link, chat_id)
+    journal.record("granted", user_id, chat_id, link=invite_link)
+    if invite_link:
+        _, minutes_to_link_expiration = destination_settings(chat_id)
+        expires_at = (datetime.now(timezone.utc) + timedelta(minutes=minutes_to_link_expiration)).timestamp() if minutes_to_link_expiration else None
+        outstanding_links.add(invite_link, user_id, chat_id, expires_at)
+    schedule_link_expiry(user_id, chat_id, invite_link)
+
+
+def schedule_link_expiry(user_id, chat_id, invite_link):
+    # Replaces any pending expiry for this user and chat, since only the newest link is on record
+    _, minutes_to_link_expiration = destination_settings(chat_id)
+    if not invite_link or not minutes_to_link_expiration:
+        return
+    run_at = datetime.now(timezone.utc) + timedelta(minutes=minutes_to_link_expiration)
+    payload = {"user_id": user_id, "chat_id": chat_id, "invite_link": invite_link}
+    db.schedule_job("expire_link", run_at, payload, job_key=f"expire_link:{user_id}:{chat_id}")
+
+
+def deep_link_for_chat(chat_id) -> str:
+    return f"https://t.me/{bouncerbot.username}?start={chat_id}"
+
+
 def extract_callback_data(data):
     callback_data = data.split("_")
     return callback_data[0], callback_data[1]
 
 
-def handle_choice(choice, button_names):
+def handle_choice(choice):
     if choice == "None":
-        message_text = f"Destination group set to <strong>None</strong>."
+        message_text = "Destination group set to <strong>None</strong>."
         db.update_settings("destination_chat_id", None)
     else:
         try:
             choice_int = int(choice)
-            message_text = f"Destination group set to <strong>{button_names[choice_int]}</strong>."
+            if choice_int not in chat_registry:
+                raise KeyError(choice_int)
+            message_text = f"Destination group set to <strong>{chat_registry.title(choice_int, choice)}</strong>."
             db.update_settings("destination_chat_id", choice_int)
+            if db.lookup_destination_chat(choice_int) is None:
+                db.record_destination_chat(choice_int)
         except:
             message_text = "Invalid action."
     return message_text
@@ -234,13 +493,13 @@ def handle_choice(choice, button_names):
 
 
 ########## ASYNCHRONOUS UTILITIES ##########
-async def create_one_time_invite_link() -> str:
+async def create_one_time_invite_link(destination_chat_id) -> str:
     try:
         # Create a new invite link that can only be used once
-        destination_chat_id = db.lookup_setting("destination_chat_id")
         if destination_chat_id is None:
             return None
-        expire_time = int((datetime.now() + timedelta(minutes=MINUTES_TO_LINK_EXPIRATION)).timestamp()) if MINUTES_TO_LINK_EXPIRATION else None
+        _, minutes_to_link_expiration = destination_settings(destination_chat_id)
+        expire_time = int((datetime.now() + timedelta(minutes=minutes_to_link_expiration)).timestamp()) if minutes_to_link_expiration else None
         invite_creation_response = await bouncerbot.create_chat_invite_link(int(destination_chat_id), member_limit=1, expire_date=expire_time)
         invite_link = invite_creation_response.invite_link
         return invite_link
@@ -249,18 +508,19 @@ async def create_one_time_invite_link() -> str:
         return None
 
 
-async def request_invite_link(context: CallbackContext, user_specs) -> str:
+async def request_invite_link(context: CallbackContext, user_specs, destination_chat_id) -> str:
     # Get the chat ID
     user_id, _, _= user_specs
     try:
         # Create a one-time invite link
-        invite_link = await create_one_time_invite_link()
+        invite_link = await create_one_time_invite_link(destination_chat_id)
+        _, minutes_to_link_expiration = destination_settings(destination_chat_id)
         if invite_link is None:
             response_text = "Currently, there is no active chat to link to. Please check back later."
         else:
             response_text = f"Here is your one-time invite link: {invite_link}"
-            if MINUTES_TO_LINK_EXPIRATION:
-                response_text += f"\n\nThis link will expire in {MINUTES_TO_LINK_EXPIRATION} minutes."
+            if minutes_to_link_expiration:
+                response_text += f"\n\nThis link will expire in {minutes_to_link_expiration} minutes."
 
         # Send the invite link to the user
         await context.bot.send_message(chat_id=user_id, text=response_text)
@@ -273,8 +533,9 @@ async def request_invite_link(context: CallbackContext, user_specs) -> str:
 async def send_confirmation_and_delete_original(bot, chat_id, user_id, message_id, message_text):
     try:
         await bot.send_message(chat_id=chat_id, text=message_text, parse_mode=ParseMode.HTML)
-        await asyncio.sleep(3)
-        await bot.delete_message(chat_id=user_id, message_id=message_id)
+        if message_id:
+            run_at = datetime.now(timezone.utc) + timedelta(seconds=CONFIRMATION_DELETE_SECONDS)
+            db.schedule_job("delete_message", run_at, {"chat_id": user_id, "message_id": message_id})
     except Exception as e:
         handle_error(e)
     return
@@ -292,33 +553,75 @@ async def track_used_link(update: Update, context: CallbackContext):
 
     link_used = update.chat_member.invite_link.invite_link
     new_member = update.chat_member.new_chat_member.user
-    db_user = db.lookup_invite_link(link_used)
-    link_in_db = db_user is not None
+    link_in_db = outstanding_links.pop(link_used) is not None
+    # A miss is only final while the map holds every outstanding link this bot has handed out
+    if not link_in_db and not (outstanding_links.complete and WORKER_COUNT == 1):
+        link_in_db = db.lookup_invite_link(link_used) is not None
    
     if link_in_db:
-        db.record_link_used(new_member.id)
-        logging.warning(f"Invite link {link_used} was used by {new_member.full_name} (ID: {new_member.id})")
+        # Written in batches by flush_links_used
+        pending_links_used.append((link_used, new_member.id, update.chat_member.chat.id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")))
+        journal.record("link_used", new_member.id, update.chat_member.chat.id, link=link_used)
+        if len(pending_links_used) >= LINK_USED_FLUSH_SIZE:
+            flush_links_used()
+        logging.info("Invite link %s was used by %s (ID: %s)", link_used, new_member.full_name, new_member.id)
         
     return
 
 
+def flush_links_used():
+    if not pending_links_used:
+        return
+    batch = pending_links_used[:]
+    pending_links_used.clear()
+    db.record_links_used(batch)
+
+
+async def flush_links_used_job(context: CallbackContext):
+    try:
+        flush_links_used()
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def flush_events_job(context: CallbackContext):
+    try:
+        journal.flush(db)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def load_outstanding_links():
+    """Rebuild the map of unused invite links from the database."""
+    outstanding_links.clear()
+    minutes_by_chat = {}
+    rows = db.return_outstanding_invite_links(OUTSTANDING_LINKS_CAPACITY + 1)
+    # Oldest first, so that if the map overflows it keeps the newest links
+    for invite_link, user_id, chat_id, access_granted in reversed(rows):
+        if chat_id not in minutes_by_chat:
+            minutes_by_chat[chat_id] = destination_settings(chat_id)[1]
+        granted_at = parse_date_from_db(access_granted)
+        minutes = minutes_by_chat[chat_id]
+        expires_at = (granted_at + timedelta(minutes=minutes)).timestamp() if minutes and granted_at else None
+        outstanding_links.add(invite_link, user_id, chat_id, expires_at)
+    logging.info("Loaded %s outstanding invite links.", len(outstanding_links))
+
+
 async def handle_message(update: Update, context: CallbackContext) -> None:
     try:
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
         chat_type = update.effective_chat.type
-        db_user = db.lookup_user(user_id)
 
         is_banned = db.lookup_is_user_banned(user_id)
         if is_banned:
             return
 
         # If not a private bot chat, and the chat is not in the active_chats list, add it
-        if chat_type != ChatType.PRIVATE and chat_id not in cached_active_chats.keys():
-            chat_title = update.effective_chat.title
-            cached_active_chats[chat_id] = chat_title
-            db.record_active_chat(chat_id, chat_title)
-            logging.warning(f"Chat {chat_id} ({chat_title}) added to active_chats.")
+        if chat_type != ChatType.PRIVATE and chat_registry.add(chat_id, update.effective_chat.title):
+            logging.info("Chat %s (%s) added to active_chats.", chat_id, update.effective_chat.title)
 
     except Exception as e:
         handle_error(e)
@@ -328,10 +631,11 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
 async def handle_video_upload(update: Update, context: CallbackContext):
     user_id, full_name, username = get_user_details(update)
     user_specs = (user_id, full_name, username)
-    chat_id = update.message.chat_id
     chat_type = update.effective_chat.type
     video_file_id = update.message.video.file_id
     video_file_unique_id = update.message.video.file_unique_id
+    thumbnail = update.message.video.thumbnail
+    thumbnail_file_id = thumbnail.file_id if thumbnail else None
     media_group_id = update.message.media_group_id
 
 
@@ -339,13 +643,9 @@ async def handle_video_upload(update: Update, context: CallbackContext):
             try:
                 message = update.effective_message
                 if message.media_group_id:
-                    msg_dict = {"user_id": user_id, "full_name": full_name, "username": username, "chat_id": chat_id, "video_file_id": video_file_id, "video_file_unique_id": video_file_unique_id}
-                    jobs = context.job_queue.get_jobs_by_name(str(message.media_group_id)) if context.job_queue else None
-                    if jobs:
-                        jobs[0].data.append(msg_dict)
-                    else:
-                        context.job_queue.run_once(callback=handle_media_group, when=1.2, data=[msg_dict],
-                                            name=str(message.media_group_id))
+                    msg_dict = {"user_id": user_id, "full_name": full_name, "username": username, "chat_id": destination_chat_id, "video_file_id": video_file_id, "video_file_unique_id": video_file_unique_id, "thumbnail_file_id": thumbnail_file_id}
+                    run_at = datetime.now(timezone.utc) + timedelta(seconds=MEDIA_GROUP_DELAY_SECONDS)
+                    db.append_to_job("media_group", run_at, f"media_group:{message.media_group_id}", msg_dict)
             except Exception as e:
                 handle_error(e)
             return
@@ -358,44 +658,65 @@ async def handle_video_upload(update: Update, context: CallbackContext):
         if is_banned:
             return
 
+        destination_chat_id = current_destination_chat_id(user_id)
+        if destination_chat_id is None:
+            await context.bot.send_message(chat_id=user_id, text="Currently, there is no active chat to link to. Please check back later.")
+            return
+
         if media_group_id:
             return await process_as_media_group(update, context)
         
-        if db.file_id_already_uploaded(user_id, video_file_unique_id):
+        fingerprint = await fingerprint_video(context.bot, thumbnail_file_id)
+        near_duplicate, near_recycled = near_duplicate_check(fingerprint, user_id, destination_chat_id)
+        if near_duplicate:
+            journal.record("duplicate", user_id, destination_chat_id, file=video_file_unique_id, reason="near_copy")
             await context.bot.send_message(chat_id=user_id, text="You have already uploaded this video.")
-            logging.warning(f"User {user_id} attempted to upload a duplicate video.")
+            logging.debug("User %s uploaded a near copy of a video they already sent.", user_id)
             return
 
-        # Store the uploaded video in the database
-        upload_success = db.store_uploaded_video(user_id, video_file_id, video_file_unique_id, chat_id)
-        if not upload_success:
+        recycled = near_recycled or media_is_recycled(video_file_unique_id)
+        if recycled and MEDIA_REUSE_POLICY == "reject":
+            journal.record("duplicate", user_id, destination_chat_id, file=video_file_unique_id, reason="recycled")
+            await context.bot.send_message(chat_id=user_id, text="This video has already been shared by many other users and can't be counted. Please upload something original.")
+            logging.debug("User %s uploaded recycled media %s.", user_id, video_file_unique_id)
+            return
+
+        # Store the video and count it in one go; None means this user already sent it
+        num_uploads = record_upload(user_id, video_file_id, video_file_unique_id, destination_chat_id, counted=not recycled, fingerprint=fingerprint)
+        if num_uploads is None:
             await context.bot.send_message(chat_id=user_id, text="You have already uploaded this video.")
-            logging.warning(f"User {user_id} attempted to upload a duplicate video.")
+            logging.debug("User %s attempted to upload a duplicate video.", user_id)
+            return
+        if recycled:
+            await context.bot.send_message(chat_id=user_id, text="This video has already been shared by many other users, so it does not count toward your total.")
+            logging.debug("User %s uploaded recycled media %s.", user_id, video_file_unique_id)
             return
-        num_uploads = db.record_video_upload(user_id)
-        logging.warning(f"User {user_id} uploaded a video. Total uploads: {num_uploads}")
-        await assess_upload_threshold(context, user_specs)
+        logging.debug("User %s uploaded a video. Total uploads: %s", user_id, num_uploads)
+        await assess_upload_threshold(context, user_specs, destination_chat_id, num_uploads)
     except Exception as e:
         handle_error(e)
     return
 
 
-async def assess_upload_threshold(context, user_specs):
+async def assess_upload_threshold(context, user_specs, destination_chat_id, num_uploads=None):
+    # num_uploads is the count record_upload just returned. The user's progress is only read when it is
+    # unknown or the user has qualified, since then we need to know whether a link was already granted.
     try:
         user_id, full_name, _ = user_specs
-        db_user = db.lookup_user(user_id)
-        db_user_dict = parse_user_tuple_list_from_db([db_user])
+        uploads_needed, minutes_to_link_expiration = destination_settings(destination_chat_id)
+        access_granted = invite_link = None
+        if num_uploads is None or num_uploads >= uploads_needed:
+            stored_uploads, access_granted, invite_link, _ = db.lookup_progress(user_id, destination_chat_id) or (0, None, None, None)
+            num_uploads = (stored_uploads or 0) if num_uploads is None else num_uploads
         response_text = ""
-        num_uploads = db_user_dict[user_id]['number_videos_uploaded']
         # Check if user has uploaded enough videos
-        if num_uploads >= UPLOADS_NEEDED and not db_user_dict[user_id]['access_granted']:   
-            await grant_access_to_user(context, user_specs)
-
-        elif num_uploads >= UPLOADS_NEEDED and db_user_dict[user_id]['access_granted']:
-            invite_link = db_user_dict[user_id]['invite_link']
-            link_creation_time = db_user_dict[user_id]['access_granted']
-            response_text = await generate_existing_link_response_text(full_name, invite_link, link_creation_time)
-            logging.warning(f"User {user_id} has met the upload requirement.")
+        if num_uploads >= uploads_needed and not access_granted:   
+            await grant_access_to_user(context, user_specs, destination_chat_id)
+
+        elif num_uploads >= uploads_needed and access_granted:
+            link_creation_time = parse_date_from_db(access_granted)
+            response_text = await generate_existing_link_response_text(full_name, invite_link, link_creation_time, minutes_to_link_expiration)
+            logging.info("User %s has met the upload requirement.", user_id)
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"<i style='color:#808080;'>{response_text}</i>",
@@ -403,8 +724,8 @@ async def assess_upload_threshold(context, user_specs):
             )
 
         else:
-            response_text += f"Thank you. You have uploaded {num_uploads} out of {UPLOADS_NEEDED} required media files." if UPLOADS_NEEDED >0 else ""
-            logging.warning(f"User {user_id} has uploaded {num_uploads} out of {UPLOADS_NEEDED} required media files.")
+            response_text += f"Thank you. You have uploaded {num_uploads} out of {uploads_needed} required media files." if uploads_needed >0 else ""
+            logging.debug("User %s has uploaded %s out of %s required media files.", user_id, num_uploads, uploads_needed)
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"<i style='color:#808080;'>{response_text}</i>",
@@ -415,87 +736,119 @@ async def assess_upload_threshold(context, user_specs):
     return
 
 
-async def handle_media_group(context: CallbackContext):
+async def handle_media_group(context: CallbackContext, media):
     try:
-        media = context.job.data
         if not media:
             return
-        num_uploads = 0
+        num_uploads = None
         user_id = None
         full_name = None
         username = None
         chat_id = None
         duplicates = 0
-        for msg_dict in media:
+        recycled = 0
+        # Thumbnails are downloaded and fingerprinted all at once; the checks below still run in album order,
+        # so a near copy inside the same album is caught against the item recorded before it
+        album_fingerprints = await asyncio.gather(*(fingerprint_video(context.bot, msg_dict.get("thumbnail_file_id"))
+                                                    for msg_dict in media))
+        for msg_dict, fingerprint in zip(media, album_fingerprints):
             user_id = msg_dict["user_id"] if not user_id else user_id
             full_name = msg_dict["full_name"] if not full_name else full_name
             username = msg_dict["username"] if not username else username
             chat_id = msg_dict["chat_id"] if not chat_id else chat_id
             video_file_id = msg_dict["video_file_id"] 
             video_file_unique_id = msg_dict["video_file_unique_id"] 
-            if db.file_id_already_uploaded(user_id, video_file_unique_id):
+            near_duplicate, near_recycled = near_duplicate_check(fingerprint, user_id, chat_id)
+            if near_duplicate:
+                journal.record("duplicate", user_id, chat_id, file=video_file_unique_id, reason="near_copy")
                 duplicates +=1
                 continue
-            upload_success = db.store_uploaded_video(user_id, video_file_id, video_file_unique_id, chat_id)
-            if not upload_success:
+            is_recycled = near_recycled or media_is_recycled(video_file_unique_id)
+            if is_recycled and MEDIA_REUSE_POLICY == "reject":
+                journal.record("duplicate", user_id, chat_id, file=video_file_unique_id, reason="recycled")
+                recycled +=1
+                continue
+            stored_uploads = record_upload(user_id, video_file_id, video_file_unique_id, chat_id, counted=not is_recycled, fingerprint=fingerprint)
+            if stored_uploads is None:
                 duplicates +=1
                 continue
-            num_uploads = db.record_video_upload(user_id)
-            logging.warning(f"User {user_id} uploaded a video. Total uploads: {num_uploads}")
+            if is_recycled:
+                recycled +=1
+                continue
+            num_uploads = stored_uploads
+            logging.debug("User %s uploaded a video. Total uploads: %s", user_id, num_uploads)
 
         user_specs = (user_id, full_name, username)
         if duplicates > 0:
             await context.bot.send_message(chat_id=user_id, text=f"{duplicates} videos were duplicates and not counted.")
-        await assess_upload_threshold(context, user_specs)
+        if recycled > 0:
+            await context.bot.send_message(chat_id=user_id, text=f"{recycled} videos have already been shared by many other users and were not counted.")
+        # None if nothing in the album was counted, and the count is read back instead
+        await assess_upload_threshold(context, user_specs, chat_id, num_uploads)
     except Exception as e:
         handle_error(e)
     return
 
 
-async def grant_access_to_user(context, user_specs):
+async def grant_access_to_user(context, user_specs, destination_chat_id):
     user_id, full_name, username = user_specs
-    db_user = db.lookup_user(user_id)
+    if not await acquire_grant_lock(user_id, destination_chat_id):
+        logging.debug("A link for user %s is already being granted.", user_id)
+        return
     try:
+        progress = db.lookup_progress(user_id, destination_chat_id)
 
         #If the user exists in the database and has not been granted access, forward their media to the admin group
-        if db_user is not None and not db_user[6] and VIDEO_REVIEW_GROUP_ID:
-            asyncio.create_task(forward_media_to_admin_group(context, user_specs))
+        if progress is not None and not progress[1] and runtime_config.VIDEO_REVIEW_GROUP_ID:
+            forward_media_to_admin_group(context, user_specs, destination_chat_id)
 
         # Create a one-time invite link
-        destination_chat_id = db.lookup_setting("destination_chat_id")
-        logging.warning(f"User {user_id} has met the upload requirement.")
-        invite_link = await request_invite_link(context, user_specs)
-        db.record_access_granted(user_id, invite_link, destination_chat_id)
+        logging.info("User %s has met the upload requirement.", user_id)
+        invite_link = await request_invite_link(context, user_specs, destination_chat_id)
+        record_granted_link(user_id, invite_link, destination_chat_id)
     except Exception as e:
         handle_error(e)
+    finally:
+        await release_grant_lock(user_id, destination_chat_id)
     return
 
 
-async def forward_media_to_admin_group( context: CallbackContext, user_specs):
+def forward_media_to_admin_group(context: CallbackContext, user_specs, destination_chat_id):
+    """Queue the user's qualifying uploads for the review group. The review queue paces sends per chat
+    and retries on RetryAfter, so a burst of qualifying users is delivered instead of dropped."""
     try:
-        admin_group_id = VIDEO_REVIEW_GROUP_ID
+        admin_group_id = runtime_config.VIDEO_REVIEW_GROUP_ID
         user_id, full_name, username = user_specs
+        uploads_needed, _ = destination_settings(destination_chat_id)
 
-        # Collect recent videos from the database
-        media_files = db.get_recent_videos(user_id, UPLOADS_NEEDED)
+        # Collect recent videos from the database now, before the user can upload more
+        media_files = db.get_recent_videos(user_id, destination_chat_id, uploads_needed)
 
         if not media_files:
-            logging.error(f"No media files found for user {user_id}")
+            logging.error("No media files found for user %s", user_id)
             return
 
-        # Collect media into an album
-        media_group = [InputMediaVideo(media=file_id) for file_id in media_files]
-
-        # Forward the album to the admin group
-        if len(media_group) > 1:
-            await context.bot.send_media_group(chat_id=admin_group_id, media=media_group)
-        else:
-            await context.bot.send_video(chat_id=admin_group_id, video=media_group[0].media)
-
-        # Add inline keyboard with "Ban User" button
-        keyboard = [[InlineKeyboardButton(f"Ban {full_name}", callback_data=f"ban_user:{user_id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(chat_id=admin_group_id, text=f"{full_name}{' (@'+username + ')' if username else ''}", reply_markup=reply_markup)
+        async def send_review(send):
+            # Albums hold at most ALBUM_LIMIT items, so larger sets go out as several albums
+            first_message_id = None
+            for start in range(0, len(media_files), ALBUM_LIMIT):
+                chunk = media_files[start:start + ALBUM_LIMIT]
+                if len(chunk) > 1:
+                    messages = await send(context.bot.send_media_group, chat_id=admin_group_id,
+                                          media=[InputMediaVideo(media=file_id) for file_id in chunk])
+                    message_id = messages[0].message_id
+                else:
+                    message_id = (await send(context.bot.send_video, chat_id=admin_group_id, video=chunk[0])).message_id
+                first_message_id = first_message_id or message_id
+
+            # Add inline keyboard with "Ban User" button, as a reply to the album
+            keyboard = [[InlineKeyboardButton(f"Ban {full_name}", callback_data=f"ban_user:{user_id}")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await send(context.bot.send_message, chat_id=admin_group_id,
+                       text=f"{full_name}{' (@'+username + ')' if username else ''}", reply_markup=reply_markup,
+                       reply_parameters=ReplyParameters(message_id=first_message_id, allow_sending_without_reply=True))
+
+        review_queue.put(admin_group_id, send_review)
 
     except Exception as e:
         handle_error(e)
@@ -509,29 +862,31 @@ async def ban_user(update: Update, context: CallbackContext):
     try:
         # Check if the user pressing the button is an authorized admin
         pressing_user_id = query.from_user.id
-        if pressing_user_id not in AUTHORIZED_ADMINS:
-            await context.bot.send_message(chat_id = VIDEO_REVIEW_GROUP_ID, text="You are not authorized to perform this action.")
-            logging.warning(f"Unauthorized ban attempt by user {pressing_user_id}")
+        if pressing_user_id not in runtime_config.AUTHORIZED_ADMINS:
+            await context.bot.send_message(chat_id = runtime_config.VIDEO_REVIEW_GROUP_ID, text="You are not authorized to perform this action.")
+            logging.warning("Unauthorized ban attempt by user %s", pressing_user_id)
             return
 
         # Extract user_id from callback_data
         data = query.data.split(':')
         user_id = int(data[1])
-        chat_id = db.lookup_chat_id_for_user(user_id)
-
-        if chat_id and user_id not in AUTHORIZED_ADMINS:
-            # Ban the user
-            try:
-                await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
-            except Exception as e:
-                logging.warning(f"Error banning user: {e}")
+        chat_ids = db.lookup_chat_ids_for_user(user_id)
+
+        if chat_ids and user_id not in runtime_config.AUTHORIZED_ADMINS:
+            # Ban the user from every destination chat they requested entry to
+            for chat_id in chat_ids:
+                try:
+                    await context.bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+                except Exception as e:
+                    logging.warning("Error banning user: %s", e)
             db.record_banned_user(user_id)
+            journal.record("banned", user_id, by=pressing_user_id)
             # Edit the existing message text and remove the button
             await query.edit_message_text(text=f"User {user_id} has been successfully banned.")
-            logging.warning(f"User {user_id} banned from chat {chat_id}")
+            logging.info("User %s banned from chats %s", user_id, chat_ids)
         else:
             await query.edit_message_text(text="Failed to find the chat to ban the user.")
-            logging.error(f"Chat ID for user {user_id} not found.")
+            logging.error("Chat ID for user %s not found.", user_id)
 
     except Exception as e:
         handle_error(e)
@@ -539,6 +894,108 @@ async def ban_user(update: Update, context: CallbackContext):
     return
 
 
+#############  BULK MODERATION  #############
+
+def parse_user_ids_from_csv(text) -> list:
+    """Read user IDs from the user_id column of a CSV (as written by /csv), or from its first column."""
+    rows = list(csv.reader(io.StringIO(text)))
+    column = 0
+    if rows and "user_id" in rows[0]:
+        column = rows[0].index("user_id")
+        rows = rows[1:]
+    user_ids = []
+    for row in rows:
+        if len(row) > column and row[column].strip().lstrip("-").isdigit():
+            user_ids.append(int(row[column]))
+    return user_ids
+
+
+async def parse_bulk_ban_targets(update: Update, context: CallbackContext) -> tuple:
+    """Return (user_ids, description of where they came from)."""
+    message = update.effective_message
+    # Document messages carry the command in their caption, where CommandHandler does not look
+    args = context.args if context.args is not None else (message.caption or "").split()[1:]
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+
+    if len(args) == 2 and args[0].lower() == "file":
+        return db.lookup_users_for_media(args[1]), f"everyone who shared {args[1]}"
+    if document:
+        data = await (await document.get_file()).download_as_bytearray()
+        return parse_user_ids_from_csv(data.decode("utf-8-sig")), document.file_name
+    return [int(arg) for arg in re.split(r"[,\s]+", " ".join(args)) if arg.lstrip("-").isdigit()], "the listed users"
+
+
+async def ban_in_chats(bot, user_id, chat_ids, semaphore) -> bool:
+    async with semaphore:
+        banned = False
+        for chat_id in chat_ids:
+            try:
+                await call_with_retry(bot.ban_chat_member, max_retries=BULK_BAN_MAX_RETRIES, chat_id=chat_id, user_id=user_id)
+                banned = True
+            except TelegramError as e:
+                # Includes timeouts and network errors: one chat failing must not stop the others
+                logging.warning("Could not ban user %s from chat %s: %s", user_id, chat_id, e)
+        return banned
+
+
+async def bulk_ban(update: Update, context: CallbackContext):
+    # Usage: /bulkban <user_id> [user_id ...] | /bulkban file <unique_file_id> | a CSV sent with the caption /bulkban
+    try:
+        admin_id = update.effective_user.id
+        user_ids, source = await parse_bulk_ban_targets(update, context)
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in runtime_config.AUTHORIZED_ADMINS]
+        if not user_ids:
+            await context.bot.send_message(chat_id=admin_id, text="Usage: /bulkban <user_id> [user_id ...], /bulkban file <unique_file_id>, or send a CSV of user IDs with the caption /bulkban")
+            return
+
+        # Recorded first, in one transaction, so the users are locked out of the bot while the chat bans run
+        db.record_banned_users(user_ids)
+        for user_id in user_ids:
+            journal.record("banned", user_id, by=admin_id)
+        known_chat_ids = db.lookup_chat_ids_for_users(user_ids)
+        # Users the bot has never seen are banned from every destination chat
+        all_chat_ids = list(db.return_all_destination_chats()) or [chat_id for chat_id in [default_destination_chat_id()] if chat_id]
+
+        status = await call_with_retry(context.bot.send_message, chat_id=admin_id, text=f"Banning {len(user_ids)} users ({source})...")
+        semaphore = asyncio.Semaphore(BULK_BAN_CONCURRENCY)
+        tasks = [asyncio.create_task(ban_in_chats(context.bot, user_id, known_chat_ids.get(user_id) or all_chat_ids, semaphore))
+                 for user_id in user_ids]
+
+        loop = asyncio.get_running_loop()
+        last_progress = loop.time()
+        banned = failed = 0
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    user_banned = await task
+                except Exception as e:
+                    handle_error(e)
+                    user_banned = False
+                if user_banned:
+                    banned += 1
+                else:
+                    failed += 1
+                if loop.time() - last_progress >= BULK_BAN_PROGRESS_SECONDS:
+                    last_progress = loop.time()
+                    try:
+                        await status.edit_text(f"Banning {len(user_ids)} users ({source})... {banned + failed}/{len(user_ids)} done")
+                    except TelegramError:
+                        pass
+        finally:
+            # Whatever happened above, nothing is left running unwatched and the admin gets the tally
+            for task in tasks:
+                task.cancel()
+            unfinished = len(user_ids) - banned - failed
+            report = f"Bulk ban finished: {banned} users banned, {failed} could not be banned in any chat"
+            report += f", {unfinished} were not attempted." if unfinished else "."
+            await call_with_retry(status.edit_text, text=f"{report} All {len(user_ids)} are blocked from the bot.")
+            logging.warning("Admin %s bulk banned %s users (%s): %s banned in chats, %s failed, %s not attempted",
+                            admin_id, len(user_ids), source, banned, failed, unfinished)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
 async def send_no_active_chat_message(context, user_id, full_name) -> None:
     try:
         response_text = f"Welcome back, {full_name}! Currently, there is no active chat to link to. Please check back later."
@@ -552,18 +1009,18 @@ async def send_no_active_chat_message(context, user_id, full_name) -> None:
     return
 
 
-async def generate_existing_link_response_text(full_name, invite_link, link_creation_time):
+async def generate_existing_link_response_text(full_name, invite_link, link_creation_time, minutes_to_link_expiration):
     try:
         response_text = f"Welcome back, {full_name}! You have already been granted access. Here is your invite link:\n{invite_link}\n\n"
-        if MINUTES_TO_LINK_EXPIRATION:
-            # time_remaining equals the number of minutes reflected in MINUTES_TO_LINK_EXPIRATION, minus the elapsed time beteween now and the link creation time
-            time_remaining = timedelta(minutes=MINUTES_TO_LINK_EXPIRATION) - (datetime.now(timezone.utc) - link_creation_time)
+        if minutes_to_link_expiration:
+            # time_remaining equals the chat's link expiration in minutes, minus the elapsed time beteween now and the link creation time
+            time_remaining = timedelta(minutes=minutes_to_link_expiration) - (datetime.now(timezone.utc) - link_creation_time)
             total_minutes = int(time_remaining.total_seconds() / 60)
             hours, minutes = divmod(total_minutes, 60)
             if hours > 0:
                 response_text += f"This link will expire in {hours} {'hours' if hours > 1 else 'hour'}. and {minutes} {'minutes' if minutes > 1 else 'minute'}."
             elif total_minutes == 0:
-                response_text += f"This link will expire in less than one minute."
+                response_text += "This link will expire in less than one minute."
             else:
                 response_text += f"This link will expire in {minutes} {'minutes' if minutes > 1 else 'minute'}."
         return response_text
@@ -572,42 +1029,45 @@ async def generate_existing_link_response_text(full_name, invite_link, link_crea
         return None
 
 
-async def generate_start_command_response_text(db_user, num_uploads, user_id, full_name, destination_chat_id, chat_title) -> str:
+async def generate_start_command_response_text(progress, num_uploads, user_id, full_name, destination_chat_id, chat_title) -> str:
+
+    uploads_needed, minutes_to_link_expiration = destination_settings(destination_chat_id)
 
     async def generate_new_link_response_text(user_id, full_name):
-        invite_link = await create_one_time_invite_link()
-        if invite_link is None:
-            response_text = f"Welcome back, {full_name}! You have already been granted access. Currently, there is no active chat to link to. Please check back later."
-        else:
-            destination_chat_id = db.lookup_setting("destination_chat_id")
-            db.record_access_granted(user_id, invite_link, destination_chat_id)
-            response_text = f"Welcome back, {full_name}! You have already been granted access. Here is your invite link:\n{invite_link}\n\n"
-            if MINUTES_TO_LINK_EXPIRATION:
-                response_text += f"This link will expire in {MINUTES_TO_LINK_EXPIRATION} minutes."
+        if not await acquire_grant_lock(user_id, destination_chat_id):
+            return f"Welcome back, {full_name}! Your invite link is on its way."
+        try:
+            invite_link = await create_one_time_invite_link(destination_chat_id)
+            if invite_link is None:
+                response_text = f"Welcome back, {full_name}! You have already been granted access. Currently, there is no active chat to link to. Please check back later."
+            else:
+                record_granted_link(user_id, invite_link, destination_chat_id)
+                response_text = f"Welcome back, {full_name}! You have already been granted access. Here is your invite link:\n{invite_link}\n\n"
+                if minutes_to_link_expiration:
+                    response_text += f"This link will expire in {minutes_to_link_expiration} minutes."
+        finally:
+            await release_grant_lock(user_id, destination_chat_id)
         return response_text
 
 
     response_text = f"💥 <strong>Welcome to {chat_title}</strong> 💥\n\n"
-    response_text += START_MESSAGE
+    response_text += runtime_config.START_MESSAGE
     try:
     # If user is in the database, check if they have an invite link and if it has been used
-        if db_user is not None:
-            db_user_dict = parse_user_tuple_list_from_db([db_user])
-            access_granted_timestamp = db_user_dict[user_id]['access_granted']
-            invite_link = db_user_dict[user_id]['invite_link']
-            link_used = db_user_dict[user_id]['link_used']
-            link_chat_id = db_user_dict[user_id]['chat_id']
+        if progress is not None:
+            _, access_granted, invite_link, link_used = progress
+            access_granted_timestamp = parse_date_from_db(access_granted)
 
-            #If an invite link exists, has not been used, has not expired, and is for the correct chat, generate a response with the existing link:
-            if invite_link and not link_used and (datetime.now(timezone.utc) - access_granted_timestamp) < timedelta(minutes=MINUTES_TO_LINK_EXPIRATION) and link_chat_id == destination_chat_id:
-                response_text = await generate_existing_link_response_text(full_name, invite_link, access_granted_timestamp)
+            #If an invite link exists, has not been used and has not expired, generate a response with the existing link:
+            if invite_link and not link_used and (not minutes_to_link_expiration or (datetime.now(timezone.utc) - access_granted_timestamp) < timedelta(minutes=minutes_to_link_expiration)):
+                response_text = await generate_existing_link_response_text(full_name, invite_link, access_granted_timestamp, minutes_to_link_expiration)
 
             #If the existing link has expired, or there is no existing link but the obligation has been met, generate a new link
-            elif num_uploads >= UPLOADS_NEEDED:
+            elif num_uploads >= uploads_needed:
                 response_text = await generate_new_link_response_text(user_id, full_name)
             #If there is no existing link and the obligation has not been met, inform the user of their progress
             else:
-                response_text += f"\n\nYou have uploaded {num_uploads} out of {UPLOADS_NEEDED} required media files." if UPLOADS_NEEDED >0 else ""
+                response_text += f"\n\nYou have uploaded {num_uploads} out of {uploads_needed} required media files." if uploads_needed >0 else ""
         
         return response_text
     except Exception as e:
@@ -618,35 +1078,61 @@ async def generate_start_command_response_text(db_user, num_uploads, user_id, fu
 #############  INACTIVE CHAT HANDLING #############
 
 async def find_inactive_chats():
-    db_chats = db.return_all_active_chats()
     active_chats = []
     inactive_chats = []
-    for chat_id, chat_title in db_chats.items(): 
+    for chat_id, chat_title in list(chat_registry.items()):
         try:
-            chat = await bouncerbot.get_chat(chat_id)  # Test to see if chat is active
+            await bouncerbot.get_chat(chat_id)  # Test to see if chat is active
             active_chats.append(chat_id)
         except (BadRequest, Forbidden) as e:
-            logging.warning(f"Chat {chat_id} ({chat_title}) is not accessible. Removing from active_chats.")
+            logging.warning("Chat %s (%s) is not accessible (%s). Removing from active_chats.", chat_id, chat_title, e)
             inactive_chats.append(chat_id)
             await clean_inactive_chats(chat_id)
     return active_chats, inactive_chats
 
 
 async def clean_inactive_chats(chat_id: int):
+    # Users are archived to CSV and deleted in batches, pausing between them so updates keep flowing.
+    # chat_cleanups remembers the archive file, so a cleanup interrupted by a restart resumes into it.
+    token = lock_token()
+    if not await state_call(state.set_if_absent, f"chat_cleanup:{chat_id}", token, ttl=CHAT_CLEANUP_LOCK_SECONDS):
+        return
     try:
-        db_users = db.return_users_for_chat(chat_id)
-        db_user_dict = parse_user_tuple_list_from_db(db_users)
-        chat_title = db.lookup_active_chat_title_with_id(chat_id)
-        write_users_to_csv(db_user_dict, chat_title)
-        
-        db.delete_users_for_chat(chat_id)
-        db.delete_active_chat(chat_id)
-        logging.warning(f"Chat {chat_id} ({chat_title}) removed from active chats and all user data deleted.")
+        chat_title = chat_registry.title(chat_id, str(chat_id))
+        file_path = f'users_{sanitize_filename(chat_title)}_{create_readable_current_date_for_filenames()}.csv'
+        chat_title, file_path, rows_archived = db.start_chat_cleanup(chat_id, chat_title, file_path)
+        if rows_archived:
+            logging.warning("Resuming cleanup of chat %s (%s) after %s users.", chat_id, chat_title, rows_archived)
+
+        while True:
+            user_rows = db.return_users_for_chat_batch(chat_id, CHAT_CLEANUP_BATCH_SIZE)
+            if not user_rows:
+                break
+            # Rows are on disk before they are deleted. A crash in between archives the batch twice, never zero times.
+            await asyncio.to_thread(append_users_to_csv, parse_user_tuple_list_from_db(user_rows), file_path)
+            db.delete_users_batch_for_chat(chat_id, user_rows)
+            rows_archived += len(user_rows)
+            await state_call(state.set, f"chat_cleanup:{chat_id}", token, ttl=CHAT_CLEANUP_LOCK_SECONDS)
+            await asyncio.sleep(CHAT_CLEANUP_PAUSE_SECONDS)
+
+        db.finish_chat_cleanup(chat_id)
+        chat_registry.discard(chat_id)
+        journal.record("chat_removed", chat_id=chat_id, title=chat_title, users_archived=rows_archived)
+        if default_destination_chat_id() == chat_id:
+            db.update_settings("destination_chat_id", None)
+        logging.warning("Chat %s (%s) removed from active chats and %s users archived to %s.", chat_id, chat_title, rows_archived, file_path)
     except Exception as e:
         handle_error(e)
+    finally:
+        await state_call(state.delete, f"chat_cleanup:{chat_id}")
     return
 
 
+async def resume_chat_cleanups():
+    for chat_id in db.return_pending_chat_cleanups():
+        await clean_inactive_chats(chat_id)
+
+
 #############  CSV PROCESSING FUNCTIONS #############
 
 
@@ -677,6 +1163,25 @@ def write_users_to_csv(users_dict, chat_title):
     return file_path
 
 
+def append_users_to_csv(users_dict, file_path):
+    """Append rows to a CSV archive, writing the header if the file is new."""
+    if not users_dict:
+        return file_path
+    first_user_key = next(iter(users_dict))
+    fieldnames = ['user_id'] + list(users_dict[first_user_key].keys())
+    write_header = not os.path.exists(file_path) or os.path.getsize(file_path) == 0
+
+    with open(file_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+        for user_id, data in users_dict.items():
+            writer.writerow({'user_id': user_id, **data})
+        f.flush()
+        os.fsync(f.fileno())
+    return file_path
+
+
 def sanitize_filename(filename):
     # Define a regex pattern to match any disallowed file name characters
     # Spaces are also included in the pattern to replace them with underscores
@@ -694,16 +1199,23 @@ async def start_command(update: Update, context: CallbackContext) -> None:
     """Send a message with information about the bot's available commands."""
     try:
         user_id, full_name, username = get_user_details(update)
-        destination_chat_id = db.lookup_setting("destination_chat_id")
+        # A deep link (t.me/<bot>?start=<chat_id>) selects a destination; plain /start uses the default one
+        destination_chat_id = resolve_destination_chat_id(context.args)
+        if destination_chat_id is None:
+            await send_no_active_chat_message(context, user_id, full_name)
+            return
         db.record_bot_user(user_id, full_name, username, destination_chat_id)
-        db_user = db.lookup_user(user_id)
+        journal.record("started", user_id, destination_chat_id)
+        progress = db.lookup_progress(user_id, destination_chat_id)
         num_uploads = 0
-        destination_chat_id = db.lookup_setting("destination_chat_id")
         try:
-            chat = await bouncerbot.get_chat(destination_chat_id) if destination_chat_id else None
+            chat = await bouncerbot.get_chat(destination_chat_id)
         except BadRequest as e:
+            logging.warning("Destination chat %s is not accessible (%s). Removing from settings.", destination_chat_id, e)
             chat = None
-            db.update_settings("destination_chat_id", None)
+            db.delete_destination_chat(destination_chat_id)
+            if default_destination_chat_id() == destination_chat_id:
+                db.update_settings("destination_chat_id", None)
 
         if not chat:
             await send_no_active_chat_message(context, user_id, full_name)
@@ -711,10 +1223,10 @@ async def start_command(update: Update, context: CallbackContext) -> None:
 
         chat_title = chat.title if chat else "None"
         chat_id = chat.id if chat else "None"
-        if db_user[5] is not None:
-            num_uploads = db_user[5]
+        if progress is not None and progress[0] is not None:
+            num_uploads = progress[0]
 
-        response_text = await generate_start_command_response_text(db_user, num_uploads, user_id, full_name, chat_id, chat_title)
+        response_text = await generate_start_command_response_text(progress, num_uploads, user_id, full_name, chat_id, chat_title)
         
         await context.bot.send_message(
             chat_id=user_id,
@@ -733,7 +1245,7 @@ async def help_command(update: Update, context: CallbackContext) -> None:
     # If the user_id is in AUTHORIZED_ADMINS, send the setup message. Otherwise, send the help message
     try:
         user_id = update.effective_user.id
-        response_text = SETUP_MESSAGE if user_id in AUTHORIZED_ADMINS else HELP_MESSAGE
+        response_text = runtime_config.SETUP_MESSAGE if user_id in runtime_config.AUTHORIZED_ADMINS else runtime_config.HELP_MESSAGE
         await context.bot.send_message(
             chat_id=user_id,
             text=response_text,
@@ -757,16 +1269,17 @@ async def post_active_chats_in_message(update: Update, context: CallbackContext)
 async def register_destination_chat(update: Update, context: CallbackContext):
     try:
         issuer_user_id = update.effective_user.id
-        reply_markup, button_names = create_keyboard_from_active_chats()
+        reply_markup = create_keyboard_from_active_chats()
         menu_message = await context.bot.send_message(
             chat_id=issuer_user_id,
             text="Select the group that you want to let users through to:",
             parse_mode=ParseMode.HTML,
             reply_markup=reply_markup
         )
-        # Save the message ID for later reference
-        context.user_data['menu_message_id'] = menu_message.message_id
-        context.user_data['button_names'] = button_names
+        # Save the message ID for later reference; the click may reach another worker.
+        # Chat titles come from the chat registry, so the menu itself holds nothing else.
+        menu = {"message_id": menu_message.message_id}
+        await state_call(state.set, f"register_menu:{issuer_user_id}", json.dumps(menu), ttl=REGISTER_MENU_SECONDS)
 
 
     except Exception as e:
@@ -779,8 +1292,8 @@ async def button_click(update, context):
         query = update.callback_query
         chat_id = query.message.chat_id
         user_id = query.from_user.id
-        message_id = context.user_data['menu_message_id'] 
-        button_names = context.user_data['button_names']
+        menu = json.loads(await state_call(state.get, f"register_menu:{user_id}") or "{}")
+        message_id = menu.get("message_id")
 
         # Extract the callback_data
         action, choice = extract_callback_data(query.data)
@@ -789,14 +1302,90 @@ async def button_click(update, context):
             return
 
         # Check the action and perform the corresponding operation
-        message_text = handle_choice(choice, button_names)
+        message_text = handle_choice(choice)
 
         try:
             # Send a confirmation message and delete the original message
             await send_confirmation_and_delete_original(context.bot, chat_id, user_id, message_id, message_text)
         except BadRequest as e:
-            logging.error(f" Error with register_destination_chat() confirmation messages: {e}")
+            logging.error("Error with register_destination_chat() confirmation messages: %s", e)
+
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def register_page_click(update, context):
+    # Swap the /register keyboard for another page of chats
+    try:
+        query = update.callback_query
+        _, page_number = extract_callback_data(query.data)
+        reply_markup = create_keyboard_from_active_chats(int(page_number))
+        if reply_markup.inline_keyboard != query.message.reply_markup.inline_keyboard:
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
+        await query.answer()
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def list_destination_chats(update: Update, context: CallbackContext):
+    try:
+        user_id = update.effective_user.id
+        default_chat_id = default_destination_chat_id()
+        response_text = "DESTINATION CHATS:\n\n"
+        for chat_id, (uploads_needed, minutes_to_link_expiration) in db.return_all_destination_chats().items():
+            effective_uploads, effective_minutes = destination_settings(chat_id)
+            response_text += (
+                f"{chat_id} - {chat_registry.title(chat_id, 'Unknown')}{' (default)' if chat_id == default_chat_id else ''}\n"
+                f"    uploads needed: {effective_uploads}{'' if uploads_needed is not None else ' (config)'}, "
+                f"link expires after: {effective_minutes} min{'' if minutes_to_link_expiration is not None else ' (config)'}\n"
+                f"    {deep_link_for_chat(chat_id)}\n"
+            )
+        await context.bot.send_message(chat_id=user_id, text=response_text, disable_web_page_preview=True)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def set_destination_chat(update: Update, context: CallbackContext):
+    # Usage: /setchat <chat_id> [uploads_needed] [minutes_to_link_expiration]
+    try:
+        user_id = update.effective_user.id
+        try:
+            chat_id = int(context.args[0])
+            uploads_needed = int(context.args[1]) if len(context.args) > 1 else None
+            minutes_to_link_expiration = int(context.args[2]) if len(context.args) > 2 else None
+        except (IndexError, ValueError):
+            await context.bot.send_message(chat_id=user_id, text="Usage: /setchat <chat_id> [uploads_needed] [minutes_to_link_expiration]")
+            return
+
+        if chat_id not in chat_registry:
+            await context.bot.send_message(chat_id=user_id, text=f"Chat {chat_id} is not an active chat. Use /cleandb to see the chats the bot is in.")
+            return
+        db.record_destination_chat(chat_id, uploads_needed, minutes_to_link_expiration)
+        if default_destination_chat_id() is None:
+            db.update_settings("destination_chat_id", chat_id)
+        await context.bot.send_message(chat_id=user_id, text=f"Destination chat {chat_id} saved. Users can start here:\n{deep_link_for_chat(chat_id)}", disable_web_page_preview=True)
+    except Exception as e:
+        handle_error(e)
+    return
 
+
+async def remove_destination_chat(update: Update, context: CallbackContext):
+    # Usage: /removechat <chat_id>
+    try:
+        user_id = update.effective_user.id
+        try:
+            chat_id = int(context.args[0])
+        except (IndexError, ValueError):
+            await context.bot.send_message(chat_id=user_id, text="Usage: /removechat <chat_id>")
+            return
+        db.delete_destination_chat(chat_id)
+        if default_destination_chat_id() == chat_id:
+            db.update_settings("destination_chat_id", None)
+        journal.record("chat_removed", chat_id=chat_id, by=user_id)
+        await context.bot.send_message(chat_id=user_id, text=f"Chat {chat_id} is no longer a destination.")
     except Exception as e:
         handle_error(e)
     return
@@ -805,12 +1394,12 @@ async def button_click(update, context):
 async def export_all_users_to_csv(update: Update, context: CallbackContext):
     try:
         db_users = db.return_all_users()
-        db_user_dict = parse_user_tuple_list_from_db(db_users)
 
-        chat_users = {}
-        for user_id, data in db_user_dict.items():
-            chat_id = data['chat_id']
-            chat_users.setdefault(chat_id, {})[user_id] = data
+        # Users have one row per destination chat, so group the rows by chat before keying them by user
+        chat_rows = {}
+        for db_user in db_users:
+            chat_rows.setdefault(db_user[9], []).append(db_user)
+        chat_users = {chat_id: parse_user_tuple_list_from_db(rows) for chat_id, rows in chat_rows.items()}
 
         for chat_id, users in chat_users.items():
             sorted_users = sorted(
@@ -818,7 +1407,7 @@ async def export_all_users_to_csv(update: Update, context: CallbackContext):
                 key=lambda x: x[1]['last_accessed_bot'] if x[1]['last_accessed_bot'] is not None else datetime.min.replace(tzinfo=utc_timezone),
                 reverse=True
             )
-            chat_title = db.lookup_active_chat_title_with_id(chat_id)
+            chat_title = chat_registry.title(chat_id, str(chat_id))
             file_path = write_users_to_csv({uid: dat for uid, dat in sorted_users}, chat_title)
             await context.bot.send_document(chat_id=update.effective_chat.id, document=open(file_path, 'rb'))
 
@@ -885,6 +1474,76 @@ async def register_destination_chat_loop(update: Update, context: CallbackContex
     return
 
 
+@private_bot_chat_check
+@authorized_admin_check
+async def list_destination_chats_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(list_destination_chats(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def set_destination_chat_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(set_destination_chat(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def remove_destination_chat_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(remove_destination_chat(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def bulk_ban_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(bulk_ban(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def reload_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(reload_command(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def set_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(set_command(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def backup_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(backup_command(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def events_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(events_command(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def stats_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(stats_command(update, context))
+    return
+
+
+@private_bot_chat_check
+@authorized_admin_check
+async def profile_loop(update: Update, context: CallbackContext):
+    asyncio.create_task(profile_command(update, context))
+    return
+
+
 @private_bot_chat_check
 @authorized_admin_check
 async def export_loop(update: Update, context: CallbackContext):
@@ -898,57 +1557,684 @@ async def reset_me_loop(update: Update, context: CallbackContext):
     return
 
 
-async def post_init(application: Application):
-    asyncio.create_task(cache_chats_on_startup())
+#############  ADMISSION CONTROL  #############
 
+async def admission_check(update: Update, context: CallbackContext):
+    # Runs before every handler group. Only /start and uploads in the private chat cost a token.
+    message = update.message
+    user = update.effective_user
+    if not ADMISSION_RATE_PER_MINUTE or message is None or user is None or message.chat.type != ChatType.PRIVATE:
+        return
+    if message.video is None and not (message.text or "").startswith("/start"):
+        return
+    if user.id in runtime_config.AUTHORIZED_ADMINS:
+        return
+    decision = admission.admit(user.id, message.media_group_id)
+    if decision == Decision.ADMIT:
+        return
+    if decision == Decision.NOTIFY:
+        try:
+            await context.bot.send_message(chat_id=user.id, text="You're sending too much too fast. Please wait a minute, then try again.")
+        except Exception as e:
+            handle_error(e)
+    logging.debug("Refused update from user %s (%s).", user.id, decision.value)
+    raise ApplicationHandlerStop
 
-async def cache_chats_on_startup():
-    db_chats = db.return_all_active_chats()
-    for chat_id, chat_title in db_chats.items(): 
+
+#############  RUNTIME CONFIG  #############
+
+def reload_config() -> str:
+    """Re-read config.py and the stored overrides. Returns a short report for the admin or the log."""
+    try:
+        changed = runtime_config.reload()
+    except ConfigError as e:
+        logging.error("Config not reloaded: %s", e)
+        return f"Config not reloaded, nothing changed: {e}"
+    return f"Config reloaded. Changed: {', '.join(changed)}" if changed else "Config reloaded. Nothing changed."
+
+
+def reload_config_from_signal():
+    # kill -HUP <pid>
+    logging.warning(reload_config())
+
+
+async def reload_command(update: Update, context: CallbackContext):
+    try:
+        await context.bot.send_message(chat_id=update.effective_user.id, text=reload_config())
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def set_command(update: Update, context: CallbackContext):
+    # Usage: /set <NAME> <value> | /set <NAME> reset | /set
+    try:
+        user_id = update.effective_user.id
+        if not context.args:
+            current = runtime_config.current
+            response_text = "RUNTIME CONFIG (* = set with /set):\n\n"
+            for name in RELOADABLE:
+                value = getattr(current, name)
+                shown = value if not isinstance(value, str) else (value[:40] + "..." if len(value) > 40 else value)
+                response_text += f"{name}{' *' if name in runtime_config.overrides else ''} = {shown!r}\n"
+            response_text += "\nUsage: /set <NAME> <value>, or /set <NAME> reset to go back to config.py"
+            await context.bot.send_message(chat_id=user_id, text=response_text)
+            return
+
+        name = context.args[0].upper()
+        # Messages keep their line breaks, so take the raw text after the name
+        text = update.message.text.split(None, 2)[2] if len(context.args) > 1 else ""
         try:
-            await bouncerbot.get_chat(chat_id)  # Test to see if chat is active
-            cached_active_chats[chat_id] = chat_title
-        except (BadRequest, Forbidden) as e:
-            logging.warning(f"Chat {chat_id} ({chat_title}) is not accessible. Removing from active_chats.")
-            await clean_inactive_chats(chat_id)
+            if name not in RELOADABLE:
+                raise ConfigError(f"{name} can't be changed at runtime. Options: {', '.join(RELOADABLE)}")
+            if not text:
+                raise ConfigError("Usage: /set <NAME> <value>, or /set <NAME> reset")
+            if text.strip().lower() == "reset":
+                runtime_config.clear_override(name)
+                response_text = f"{name} is back to its config.py value."
+            else:
+                runtime_config.set_override(name, parse_value(name, text))
+                response_text = f"{name} updated."
+        except ConfigError as e:
+            response_text = f"Not changed: {e}"
+        await context.bot.send_message(chat_id=user_id, text=response_text)
+    except Exception as e:
+        handle_error(e)
+    return
+
 
-        destination_chat_id = db.lookup_setting("destination_chat_id")
-        if not destination_chat_id:
+#############  EVENT JOURNAL  #############
+
+async def events_command(update: Update, context: CallbackContext):
+    # Usage: /events [days] [kind ...]
+    try:
+        user_id = update.effective_user.id
+        args = list(context.args or [])
+        days = int(args.pop(0)) if args and args[0].isdigit() else EVENTS_DEFAULT_DAYS
+        kinds = [kind.lower() for kind in args]
+        if days < 1 or any(kind not in EVENT_KINDS for kind in kinds):
+            await context.bot.send_message(chat_id=user_id, text=f"Usage: /events [days] [kind ...]\nKinds: {', '.join(EVENT_KINDS)}")
+            return
+
+        journal.flush(db)  # So the export includes what is still buffered
+        now = datetime.now(timezone.utc)
+        since = (now - timedelta(days=days)).strftime(EVENT_TIME_FORMAT)
+        until = now.strftime(EVENT_TIME_FORMAT)
+        counts = [(kind, count) for kind, count in db.count_events(since, until) if not kinds or kind in kinds]
+        response_text = f"EVENTS in the last {days} day(s):\n\n"
+        response_text += "".join(f"    {kind}: {count}\n" for kind, count in counts) or "    none\n"
+        await context.bot.send_message(chat_id=user_id, text=response_text)
+        if not counts:
+            return
+
+        file_path = f"events_{create_readable_current_date_for_filenames()}.csv"
+        try:
+            with open(file_path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["created_at", "kind", "user_id", "chat_id", "detail"])
+                for position, row in enumerate(db.iterate_events(since, until, kinds), 1):
+                    writer.writerow(row)
+                    if position % 10000 == 0:
+                        await asyncio.sleep(0)
+            with open(file_path, "rb") as f:
+                await context.bot.send_document(chat_id=user_id, document=f)
+        finally:
+            os.remove(file_path)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+#############  STATS  #############
+
+async def stats_command(update: Update, context: CallbackContext):
+    # Reads only the funnel_counters rows for the last 30 days, however many users there are
+    try:
+        user_id = update.effective_user.id
+        today = datetime.now(timezone.utc).date()
+        window_starts = [(today - timedelta(days=days - 1)).isoformat() for days in STATS_WINDOW_DAYS]
+        totals = {}
+        for day, chat_id, counter, value in db.return_funnel_counters(min(window_starts)):
+            chat_totals = totals.setdefault(chat_id, {name: [0] * len(window_starts) for name in FUNNEL_COUNTERS})
+            for position, window_start in enumerate(window_starts):
+                if day >= window_start:
+                    chat_totals[counter][position] += value
+
+        response_text = "FUNNEL (today / 7 days / 30 days, UTC):\n\n"
+        if not totals:
+            response_text += "Nothing has been counted in the last 30 days.\n"
+        for chat_id, chat_totals in totals.items():
+            response_text += f"{chat_id} - {chat_registry.title(chat_id, 'Unknown')}\n"
+            for name in FUNNEL_COUNTERS:
+                response_text += f"    {name.replace('_', ' ')}: {' / '.join(str(value) for value in chat_totals[name])}\n"
+        response_text += f"\nEVENT JOURNAL (since start):\n    written: {journal.written}\n    buffered: {len(journal)}\n    dropped: {journal.dropped}\n"
+        if runtime_config.VIDEO_REVIEW_GROUP_ID or review_queue.backlog:
+            review = review_queue.snapshot()
+            response_text += (f"\nREVIEW QUEUE (now):\n    waiting: {review['backlog']}\n"
+                              f"    oldest waiting: {review['oldest_age_seconds']}s\n")
+        if LINK_REVOCATIONS_PER_MINUTE:
+            response_text += (f"\nDEAD INVITE LINKS (since start):\n    revoked: {revocation_stats['revoked']}\n"
+                              f"    given up: {revocation_stats['given_up']}\n    waiting: {db.count_links_to_revoke()}\n")
+        if ADMISSION_RATE_PER_MINUTE:
+            response_text += "\nFLOOD PROTECTION (since start):\n"
+            for name, value in admission.snapshot().items():
+                response_text += f"    {name.replace('_', ' ')}: {value}\n"
+        response_text += f"\nERRORS (since start, {sum(error_reporter.counts.values())} in total):\n"
+        for name, value in error_reporter.snapshot(STATS_ERRORS_SHOWN).items():
+            response_text += f"    {name}: {value}\n"
+        await context.bot.send_message(chat_id=user_id, text=response_text)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+#############  PROFILING  #############
+
+async def send_profile(traces, chat_id=None):
+    """Write a finished profile as a Chrome trace and send it to the admin who asked for it."""
+    try:
+        file_path = write_chrome_trace(traces, f"profile_{create_readable_current_date_for_filenames()}.json")
+        logging.warning("Profile of %s updates written to %s", len(traces), file_path)
+        if chat_id is not None:
+            await call_with_retry(bouncerbot.send_document, chat_id=chat_id, document=Path(file_path),
+                                  caption=f"Trace of {len(traces)} updates. Open it in chrome://tracing or ui.perfetto.dev.")
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def profile_command(update: Update, context: CallbackContext):
+    # Usage: /profile [number_of_updates] | /profile stop
+    try:
+        user_id = update.effective_user.id
+        if context.args and context.args[0].lower() == "stop":
+            if not profiler.active:
+                await context.bot.send_message(chat_id=user_id, text="No profile is running.")
+                return
+            profiler.stop()
+            await context.bot.send_message(chat_id=user_id, text="Profile stopped. The trace of the updates so far is on its way.")
             return
         try:
-            await bouncerbot.get_chat(destination_chat_id)  # Test to see if chat is active
+            num_updates = int(context.args[0]) if context.args else PROFILE_DEFAULT_UPDATES
+        except ValueError:
+            await context.bot.send_message(chat_id=user_id, text="Usage: /profile [number_of_updates] or /profile stop")
+            return
+        num_updates = max(1, min(num_updates, PROFILE_MAX_UPDATES))
+        profiler.start(num_updates, lambda traces: send_profile(traces, user_id))
+        await context.bot.send_message(chat_id=user_id, text=f"Profiling the next {num_updates} updates. The trace will be sent here when they are done.")
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def start_profile_from_signal():
+    # kill -USR1 <pid> profiles the next PROFILE_DEFAULT_UPDATES updates and writes the trace to disk
+    if profiler.active:
+        return
+    profiler.start(PROFILE_DEFAULT_UPDATES, send_profile)
+    logging.warning("Profiling the next %s updates (SIGUSR1).", PROFILE_DEFAULT_UPDATES)
+
+
+#############  SCHEDULED JOBS  #############
+
+async def delete_scheduled_message(context: CallbackContext, payload):
+    try:
+        await context.bot.delete_message(chat_id=payload["chat_id"], message_id=payload["message_id"])
+    except BadRequest as e:
+        # Already deleted by the user, or too old to delete
+        logging.debug("Could not delete message %s: %s", payload["message_id"], e)
+
+
+async def expire_invite_link(context: CallbackContext, payload):
+    db.expire_invite_link(payload["user_id"], payload["chat_id"], payload["invite_link"])
+    outstanding_links.discard(payload["invite_link"])
+    logging.debug("Invite link for user %s in chat %s expired.", payload["user_id"], payload["chat_id"])
+
+
+SCHEDULED_JOB_HANDLERS = {
+    "media_group": handle_media_group,
+    "delete_message": delete_scheduled_message,
+    "expire_link": expire_invite_link,
+}
+
+
+async def run_scheduled_job(context, job_id, kind, payload, attempts) -> bool:
+    """Run one job. Returns True when the job is finished and can be deleted."""
+    handler = SCHEDULED_JOB_HANDLERS.get(kind)
+    if handler is None:
+        logging.error("Dropping scheduled job %s of unknown kind %s", job_id, kind)
+        return True
+    try:
+        await handler(context, payload)
+        return True
+    except Exception as e:
+        handle_error(e)
+        if attempts + 1 >= JOB_MAX_ATTEMPTS:
+            logging.error("Dropping scheduled job %s (%s) after %s attempts", job_id, kind, attempts + 1)
+            return True
+        db.retry_job(job_id, datetime.now(timezone.utc) + timedelta(seconds=2 ** attempts * SCHEDULER_TICK_SECONDS))
+        return False
+
+
+async def run_scheduled_jobs(context: CallbackContext):
+    # Each tick leases a batch of due jobs from the scheduled_jobs table, runs them together,
+    # and deletes the finished ones in one statement. A lease left by a crashed worker runs out
+    # after JOB_LEASE_SECONDS and the job is picked up again.
+    try:
+        jobs = db.claim_due_jobs(SCHEDULER_BATCH_SIZE, JOB_LEASE_SECONDS)
+        if not jobs:
+            return
+        finished = await asyncio.gather(*(run_scheduled_job(context, *job) for job in jobs))
+        db.complete_jobs([job[0] for job, done in zip(jobs, finished) if done])
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def start_scheduler(application: Application):
+    if WORKER_COUNT == 1:
+        # No other process can hold a lease, so anything leased belongs to the previous run
+        pending = db.release_job_leases()
+        if pending:
+            logging.warning("Recovered %s scheduled jobs from the previous run.", pending)
+    application.job_queue.run_repeating(run_scheduled_jobs, interval=SCHEDULER_TICK_SECONDS, first=0, name="scheduled_jobs")
+
+
+#############  DATABASE MAINTENANCE  #############
+
+async def run_maintenance(context: CallbackContext):
+    # Works through user_progress in small keyed slices, yielding to the event loop between
+    # them, and stops when the time budget is spent. The position is kept in settings so the next
+    # run continues where this one stopped.
+    try:
+        deadline = asyncio.get_running_loop().time() + MAINTENANCE_TIME_BUDGET_SECONDS
+        abandoned_before = datetime.now(timezone.utc) - timedelta(days=ABANDONED_USER_RETENTION_DAYS)
+        after_rowid = int(db.lookup_setting("maintenance_cursor") or 0)
+        totals = {"links_expired": 0, "users_archived": 0}
+        while asyncio.get_running_loop().time() < deadline:
+            last_rowid, stats = db.maintain_users_slice(after_rowid, MAINTENANCE_SLICE_ROWS, abandoned_before,
+                                                        runtime_config.MINUTES_TO_LINK_EXPIRATION, archive=ARCHIVE_ABANDONED_USERS)
+            for key, value in stats.items():
+                totals[key] += value
+            if last_rowid is None:
+                after_rowid = 0
+                break
+            after_rowid = last_rowid
+            await asyncio.sleep(0)
+        db.update_settings("maintenance_cursor", after_rowid)
+
+        while asyncio.get_running_loop().time() < deadline:
+            if not db.incremental_vacuum(MAINTENANCE_VACUUM_PAGES):
+                break
+            await asyncio.sleep(0)
+        db.optimize()
+        logging.info("Maintenance: %s links expired, %s users archived",
+                     totals["links_expired"], totals["users_archived"])
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def migrate_legacy_users(context: CallbackContext):
+    # Databases from before the table split keep their users in users_requesting_entry until this
+    # has moved them all. Handlers move the rows of anyone they touch first, so the bot works
+    # normally meanwhile; this only has to catch up with everyone else, a batch at a time.
+    try:
+        logging.warning("Moving %s user rows to the new tables in the background.", db.count_legacy_users())
+        moved = 0
+        while True:
+            batch = db.migrate_legacy_users(USER_MIGRATION_BATCH_SIZE)
+            if not batch:
+                break
+            moved += batch
+            await asyncio.sleep(USER_MIGRATION_PAUSE_SECONDS)
+        logging.warning("Finished moving users to the new tables (%s rows moved).", moved)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def start_maintenance(application: Application):
+    # Only one worker needs to do this
+    if WORKER_INDEX == 0 and db.legacy_users:
+        application.job_queue.run_once(migrate_legacy_users, when=5, name="migrate_legacy_users")
+    if WORKER_INDEX == 0 and MAINTENANCE_INTERVAL_MINUTES:
+        application.job_queue.run_repeating(run_maintenance, interval=MAINTENANCE_INTERVAL_MINUTES * 60,
+                                            first=60, name="maintenance")
+
+
+#############  LINK REVOCATION  #############
+
+async def revoke_links_in_chat(bot, chat_id, invite_links):
+    revoked = []
+    for invite_link in invite_links:
+        await revocation_limiter.wait(chat_id)
+        try:
+            await call_with_retry(bot.revoke_chat_invite_link, chat_id=chat_id, invite_link=invite_link)
+            revocation_stats["revoked"] += 1
         except (BadRequest, Forbidden) as e:
-            logging.warning(f"Destination chat {destination_chat_id} is not accessible. Removing from settings.")
-            db.update_settings("destination_chat_id", None)
+            # Already gone, or the bot is no longer an admin there. Trying again won't help.
+            logging.debug("Could not revoke %s in chat %s: %s", invite_link, chat_id, e)
+            revocation_stats["given_up"] += 1
+        except (RetryAfter, NetworkError) as e:
+            # Left for the next run
+            if isinstance(e, RetryAfter):
+                revocation_limiter.hold(chat_id, retry_after_seconds(e))
+            logging.warning("Stopped revoking invite links in chat %s for now: %s", chat_id, e)
+            break
+        revoked.append(invite_link)
+    db.record_links_revoked(revoked)
+
+
+async def revoke_stale_links(context: CallbackContext):
+    # Links that were replaced by a newer one, expired or belong to a banned user stay in the group's
+    # link list until they are revoked. Each run takes the oldest batch and revokes them, every chat
+    # in parallel but each paced to LINK_REVOCATIONS_PER_MINUTE. Revoked links are marked in the
+    # database as each chat finishes, so they are only revoked once.
+    if revocation_lock.locked():
+        return  # The previous run is still working through its batch
+    async with revocation_lock:
+        try:
+            links_by_chat = {}
+            for invite_link, chat_id in db.return_links_to_revoke(LINK_REVOCATION_BATCH_SIZE):
+                links_by_chat.setdefault(chat_id, []).append(invite_link)
+            await asyncio.gather(*(revoke_links_in_chat(context.bot, chat_id, invite_links)
+                                   for chat_id, invite_links in links_by_chat.items()))
+            revocation_limiter.forget_idle()
+        except Exception as e:
+            handle_error(e)
+    return
+
+
+def start_link_revocation(application: Application):
+    # Only one worker needs to do this
+    if WORKER_INDEX == 0 and LINK_REVOCATIONS_PER_MINUTE:
+        application.job_queue.run_repeating(revoke_stale_links, interval=LINK_REVOCATION_INTERVAL_SECONDS,
+                                            first=30, name="revoke_stale_links")
+
+
+#############  BACKUPS  #############
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list, interval=0.01):
+    # How late the event loop wakes up, i.e. how long a handler would have waited to run
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+async def run_backup() -> str:
+    """Back up the database, rotate old backups and verify the new one. Returns a one-line report."""
+    async with backup_lock:
+        stop = asyncio.Event()
+        lag = []
+        probe = asyncio.create_task(measure_loop_lag(stop, lag))
+        try:
+            report = await asyncio.to_thread(backup_database, Database.DB_LOCATION, BACKUP_DIRECTORY,
+                                             BACKUP_PAGES_PER_STEP, BACKUP_STEP_PAUSE_SECONDS)
+        finally:
+            stop.set()
+            await probe
+        removed = rotate_backups(BACKUP_DIRECTORY, BACKUP_KEEP)
+
+        lag.sort()
+        lag_ms = (lag[len(lag) // 2] * 1000, lag[-1] * 1000) if lag else (0.0, 0.0)
+        response_text = (
+            f"Backup {os.path.basename(report['path'])}: {report['database_bytes'] / 1e6:.1f} MB "
+            f"({report['compressed_bytes'] / 1e6:.1f} MB compressed), copied in {report['copy_seconds']}s "
+            f"over {report['steps']} steps and compressed in {report['compress_seconds']}s. "
+            f"Handler delay while copying: p50 {lag_ms[0]:.1f} ms, max {lag_ms[1]:.1f} ms."
+        )
+        if removed:
+            response_text += f" Removed {len(removed)} old backup(s)."
+        if BACKUP_VERIFY:
+            verification = await asyncio.to_thread(verify_backup, report["path"])
+            if verification["ok"]:
+                response_text += f" Verified: {sum(verification['tables'].values())} rows in {len(verification['tables'])} tables."
+            else:
+                response_text += f" VERIFICATION FAILED: {verification['integrity']}"
+                logging.error("Backup %s failed verification: %s", report["path"], verification["integrity"])
+        logging.warning(response_text)
+        return response_text
+
+
+async def backup_job(context: CallbackContext):
+    try:
+        await run_backup()
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+async def backup_command(update: Update, context: CallbackContext):
+    try:
+        user_id = update.effective_user.id
+        if backup_lock.locked():
+            await context.bot.send_message(chat_id=user_id, text="A backup is already running.")
+            return
+        await context.bot.send_message(chat_id=user_id, text="Backing up the database...")
+        await context.bot.send_message(chat_id=user_id, text=await run_backup())
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def start_backups(application: Application):
+    # Only one worker needs to do this. Restarts don't reset the schedule: the first run is
+    # due when the newest backup on disk is BACKUP_INTERVAL_HOURS old.
+    if WORKER_INDEX != 0 or not BACKUP_INTERVAL_HOURS:
+        return
+    interval = BACKUP_INTERVAL_HOURS * 3600
+    backups = list_backups(BACKUP_DIRECTORY)
+    age = time.time() - os.path.getmtime(backups[-1]) if backups else interval
+    application.job_queue.run_repeating(backup_job, interval=interval, first=max(interval - age, 60), name="backup")
+
+
+#############  WORKER PARTITIONING  #############
+
+def partition_for_update(update: Update) -> int:
+    user = update.effective_user
+    return user.id % WORKER_COUNT if user else 0
+
+
+async def route_update(update: Update, context: CallbackContext):
+    # Worker 0 receives every update from Telegram and hands other partitions' updates to their workers.
+    # All updates from one user land on the same worker, so per-user state never spans processes.
+    partition = partition_for_update(update)
+    if partition != WORKER_INDEX:
+        await state_call(state.push, f"updates:{partition}", update.to_json())
+        raise ApplicationHandlerStop
+
+
+async def run_partition_worker(application: Application):
+    """Process the updates routed to this worker's partition instead of polling Telegram."""
+    consumer = create_state_backend(STATE_BACKEND_URL)
+    queue_key = f"updates:{WORKER_INDEX}"
+    async with application:
+        await post_init(application)
+        await application.start()
+        logging.warning("Worker %s of %s consuming %s", WORKER_INDEX, WORKER_COUNT, queue_key)
+        # A push whose reply was lost is sent again, so the same update can arrive twice
+        recent_ids, recent_order = set(), deque()
+        try:
+            while True:
+                payload = await asyncio.to_thread(consumer.pop, queue_key, 5)
+                if payload:
+                    update = Update.de_json(json.loads(payload), application.bot)
+                    if update.update_id in recent_ids:
+                        logging.debug("Skipping update %s, which was routed twice.", update.update_id)
+                        continue
+                    recent_ids.add(update.update_id)
+                    recent_order.append(update.update_id)
+                    if len(recent_order) > ROUTED_UPDATE_IDS_KEPT:
+                        recent_ids.discard(recent_order.popleft())
+                    await application.update_queue.put(update)
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+
+async def post_init(application: Application):
+    # Only what must be ready before the first update. Jobs start once polling has started,
+    # so warm_caches runs after that.
+    application.job_queue.run_repeating(flush_links_used_job, interval=LINK_USED_FLUSH_SECONDS, name="flush_links_used")
+    application.job_queue.run_repeating(flush_events_job, interval=EVENT_FLUSH_SECONDS, name="flush_events")
+    start_scheduler(application)
+    start_maintenance(application)
+    start_link_revocation(application)
+    start_backups(application)
+    application.job_queue.run_once(warm_caches, when=0, name="warm_caches")
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, start_profile_from_signal)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config_from_signal)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass  # No SIGUSR1/SIGHUP on Windows, and only the main thread may install handlers
+    record_startup_phase("post_init_ms")
+
+
+async def warm_caches(context: CallbackContext):
+    try:
+        load_outstanding_links()
+        await load_media_filter()
+        if near_duplicates_enabled:
+            await load_fingerprint_index()
+        elif NEAR_DUPLICATE_DETECTION:
+            logging.warning("NEAR_DUPLICATE_DETECTION is on but Pillow is not installed (pip install Pillow), so near-duplicate detection is off.")
+        record_startup_phase("caches_warm_ms")
+        await cache_chats_on_startup()
+        record_startup_phase("chats_probed_ms")
+        logging.info("Startup finished: %s", startup_timings)
+    except Exception as e:
+        handle_error(e)
+    return
+
+
+def record_startup_phase(phase):
+    startup_timings[phase] = round((time.perf_counter() - startup_started) * 1000, 1)
+
+
+async def note_first_update(update: Update, context: CallbackContext):
+    global first_update_seen
+    if first_update_seen:
+        return
+    first_update_seen = True
+    record_startup_phase("first_update_ms")
+    logging.warning("First update handled %.0f ms after start: %s", startup_timings["first_update_ms"], startup_timings)
+
+
+async def post_shutdown(application: Application):
+    flush_links_used()
+    journal.flush(db)
+    fingerprinter.shutdown()
+
+
+async def cache_chats_on_startup():
+    await resume_chat_cleanups()
+    # Known chats are usable straight away. Probing only removes the ones the bot has lost.
+    chat_registry.load()
+    db_chats = dict(chat_registry.items())
+
+    semaphore = asyncio.Semaphore(STARTUP_PROBE_CONCURRENCY)
+
+    async def probe(chat_id) -> bool:
+        async with semaphore:
+            try:
+                await call_with_retry(bouncerbot.get_chat, chat_id=chat_id)  # Test to see if chat is active
+                return True
+            except (BadRequest, Forbidden) as e:
+                logging.debug("Probing chat %s failed: %s", chat_id, e)
+                return False
+
+    chat_ids = list(db_chats)
+    for chat_id, accessible in zip(chat_ids, await asyncio.gather(*(probe(chat_id) for chat_id in chat_ids))):
+        if not accessible:
+            logging.warning("Chat %s (%s) is not accessible. Removing from active_chats.", chat_id, db_chats[chat_id])
+            await clean_inactive_chats(chat_id)
+
+    destination_chat_ids = list(db.return_all_destination_chats())
+    for destination_chat_id, accessible in zip(destination_chat_ids, await asyncio.gather(*(probe(chat_id) for chat_id in destination_chat_ids))):
+        if not accessible:
+            logging.warning("Destination chat %s is not accessible. Removing from settings.", destination_chat_id)
+            db.delete_destination_chat(destination_chat_id)
+            if default_destination_chat_id() == destination_chat_id:
+                db.update_settings("destination_chat_id", None)
     return
 
 #############  MAIN FUNCTION  #############
 
-def main() -> None:
+def build_application(bot=None) -> Application:
+    """Create the Application and register all handlers. Pass `bot` to run against a stand-in Bot."""
     global bouncerbot
     global app
-
-    # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    global db
+    global chat_registry
+
+    if db is None:
+        db = Database()
+        record_startup_phase("database_ms")
+        startup_timings["schema_checked"] = db.schema_checked
+        chat_registry = ChatRegistry(db, refresh_seconds=CHAT_REGISTRY_REFRESH_SECONDS if WORKER_COUNT > 1 else None)
+        runtime_config.attach(db)
+
+    builder = Application.builder().application_class(ProfilingApplication).post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN).request(TracingRequest(connection_pool_size=256))
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, note_first_update), group=-3)
+    if WORKER_COUNT > 1:
+        application.add_handler(TypeHandler(Update, route_update), group=-2)
+    # After routing, so each user's bucket lives on the worker that handles them
+    application.add_handler(TypeHandler(Update, admission_check), group=-1)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("csv", export_loop))
     application.add_handler(CommandHandler("cleandb", clean_database_loop))
     # application.add_handler(CommandHandler("reset", reset_me_loop))
     application.add_handler(CommandHandler("register", register_destination_chat_loop))
+    application.add_handler(CommandHandler("destinations", list_destination_chats_loop))
+    application.add_handler(CommandHandler("setchat", set_destination_chat_loop))
+    application.add_handler(CommandHandler("removechat", remove_destination_chat_loop))
+    application.add_handler(CommandHandler("bulkban", bulk_ban_loop))
+    application.add_handler(CommandHandler("profile", profile_loop))
+    application.add_handler(CommandHandler("stats", stats_loop))
+    application.add_handler(CommandHandler("events", events_loop))
+    application.add_handler(CommandHandler("backup", backup_loop))
+    application.add_handler(CommandHandler("reload", reload_loop))
+    application.add_handler(CommandHandler("set", set_loop))
     # application.add_handler(CommandHandler("drop", drop_table))
     application.add_handler(ChatMemberHandler(track_used_link, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(CallbackQueryHandler(button_click, pattern='^activechats_.*'))
+    application.add_handler(CallbackQueryHandler(register_page_click, pattern=r'^registerpage_\d+$'))
     application.add_handler(CallbackQueryHandler(ban_user, pattern=r'^ban_user:'))
     application.add_handler(MessageHandler(filters.VIDEO, handle_video_upload))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv") & filters.CaptionRegex(r"^/bulkban"), bulk_ban_loop))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message_loop))
 
+    # Each handler shows up as a span in /profile traces
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = traced(handler.callback)
+
+    bouncerbot = application.bot
+    app = application
+    record_startup_phase("application_built_ms")
+    return application
+
+
+def main() -> None:
+    log_listener = configure_logging(LOG_LEVEL)
+
+    # Create the Application and pass it your bot's token.
+    application = build_application()
     try:
-        bouncerbot = application.bot
-        app = application
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WORKER_COUNT > 1 and WORKER_INDEX != 0:
+            asyncio.run(run_partition_worker(application))
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         print(e)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
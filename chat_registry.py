@@ -0,0 +1,76 @@
+"""
+CHAT_REGISTRY.PY
+
+The chats the bot is in, held in memory. The active_chats table is read once (on first
+use) and every change goes through the registry, which writes it to the database and
+updates memory together, so handlers never query active_chats.
+
+With several workers each process has its own registry, and chats recorded by another
+worker only show up here after a reload. Pass `refresh_seconds` to reload that often.
+"""
+
+import time
+
+
+class ChatRegistry(object):
+
+    def __init__(self, database, refresh_seconds: float = None):
+        self.database = database
+        self.refresh_seconds = refresh_seconds
+        self._titles = None
+        self._sorted = None
+        self._loaded_at = 0.0
+
+    def load(self) -> None:
+        self._titles = self.database.return_all_active_chats()
+        self._sorted = None
+        self._loaded_at = time.monotonic()
+
+    def _chats(self) -> dict:
+        if self._titles is None or (self.refresh_seconds is not None
+                                    and time.monotonic() - self._loaded_at > self.refresh_seconds):
+            self.load()
+        return self._titles
+
+    ########## READS ##########
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self._chats()
+
+    def __len__(self) -> int:
+        return len(self._chats())
+
+    def title(self, chat_id, default=None):
+        return self._chats().get(chat_id) or default
+
+    def items(self) -> list:
+        """(chat_id, title) pairs sorted by title, so pages stay stable between requests"""
+        chats = self._chats()
+        if self._sorted is None:
+            self._sorted = sorted(chats.items(), key=lambda item: ((item[1] or "").casefold(), item[0]))
+        return self._sorted
+
+    def page(self, page_number: int, page_size: int) -> tuple:
+        """return (chats on the page, clamped page number, number of pages)"""
+        chats = self.items()
+        pages = max((len(chats) + page_size - 1) // page_size, 1)
+        page_number = min(max(page_number, 0), pages - 1)
+        return chats[page_number * page_size:(page_number + 1) * page_size], page_number, pages
+
+    ########## WRITES ##########
+
+    def add(self, chat_id, title) -> bool:
+        """record a chat (or its new title). returns True if the database was written"""
+        chats = self._chats()
+        if chat_id in chats and chats[chat_id] == title:
+            return False
+        self.database.record_active_chat(chat_id, title)
+        chats[chat_id] = title
+        self._sorted = None
+        return True
+
+    def discard(self, chat_id) -> None:
+        """forget a chat whose rows the caller has already deleted"""
+        if self._titles is not None and chat_id in self._titles:
+            del self._titles[chat_id]
+            self._sorted = None
@@ -0,0 +1,263 @@
+#! /usr/bin/python
+"""
+DB_BENCHMARK.PY
+
+Micro-benchmarks for the hot db_utils.Database queries at realistic table sizes.
+
+Builds seeded synthetic databases (cached between runs under --dir), then times each
+method once on a freshly opened connection (cold) and repeatedly on random keys (warm).
+Methods that write run against a temporary copy, so every run starts from the same data.
+Prints the EXPLAIN QUERY PLAN of every statement a method issues, and can write all
+results as JSON so separate runs can be compared.
+
+Usage:
+    python db_benchmark.py --users 10000 100000 1000000 --videos 10000000 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from db_utils import Database
+
+
+CHAT_IDS = [-1001000000001, -1001000000002, -1001000000003]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+BATCH_SIZE = 50_000
+
+# Cases that change the database. They run on a throwaway copy so the cached one stays as generated
+WRITE_CASES = {"record_upload"}
+
+
+########## SYNTHETIC DATA ##########
+
+def invite_link_for(user_id):
+    return f"https://t.me/+bench{user_id:x}"
+
+
+def chat_id_for(user_id):
+    return CHAT_IDS[user_id % len(CHAT_IDS)]
+
+
+def unique_file_id_for(n):
+    return f"AgAD{n:012x}"
+
+
+def generate_database(path, num_users, num_videos, seed):
+    """Create a database at `path` with the bot's own schema and fill it with seeded rows."""
+    rng = random.Random(seed)
+    Database.DB_LOCATION = path
+    database = Database()
+    database.connection.close()
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    now = datetime.now(timezone.utc)
+
+    def user_rows():
+        for user_id in range(1, num_users + 1):
+            accessed = now - timedelta(minutes=rng.randrange(60 * 24 * 90))
+            uploads = rng.choice((0, 0, 1, 2, 3, 5, 5, 5))
+            granted = uploads >= 5 and rng.random() < 0.8
+            yield (
+                user_id,
+                f"User {user_id}",
+                f"user{user_id}" if rng.random() < 0.7 else None,
+                accessed.strftime(TIME_FORMAT),
+                accessed.strftime(TIME_FORMAT) if uploads else None,
+                uploads,
+                accessed.strftime(TIME_FORMAT) if granted else None,
+                invite_link_for(user_id) if granted else None,
+                accessed.strftime(TIME_FORMAT) if granted and rng.random() < 0.6 else None,
+                chat_id_for(user_id),
+                rng.random() < 0.01,
+            )
+
+    def video_rows():
+        for n in range(num_videos):
+            uploaded = now - timedelta(seconds=rng.randrange(60 * 60 * 24 * 90))
+            user_id = rng.randrange(1, num_users + 1)
+            yield (user_id, f"BAACAg{n:016x}", unique_file_id_for(n),
+                   chat_id_for(user_id), uploaded.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def insert_in_batches(query, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                connection.executemany(query, batch)
+                batch.clear()
+        if batch:
+            connection.executemany(query, batch)
+        connection.commit()
+
+    def insert_users(batch):
+        # Each wide row is split across the three user tables, like Database stores it
+        connection.executemany("""
+            INSERT INTO user_profiles (user_id, full_name, username, banned) VALUES (?, ?, ?, ?)
+        """, [(u[0], u[1], u[2], u[10]) for u in batch])
+        connection.executemany("""
+            INSERT INTO user_progress (user_id, chat_id, last_accessed_bot, last_uploaded_video,
+                number_videos_uploaded, access_granted)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(u[0], u[9], u[3], u[4], u[5], u[6]) for u in batch])
+        connection.executemany("""
+            INSERT INTO invite_grants (invite_link, user_id, chat_id, access_granted, link_used, used_by)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(u[7], u[0], u[9], u[6], u[8], u[0] if u[8] else None) for u in batch if u[7]])
+
+    batch = []
+    for row in user_rows():
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            insert_users(batch)
+            batch.clear()
+    if batch:
+        insert_users(batch)
+    connection.commit()
+    insert_in_batches("""
+        INSERT OR IGNORE INTO uploaded_videos (user_id, file_id, unique_file_id, chat_id, upload_time)
+        VALUES (?, ?, ?, ?, ?)
+    """, video_rows())
+    connection.execute("ANALYZE")
+    connection.commit()
+    connection.close()
+
+
+def database_path(directory, num_users, num_videos, seed):
+    return os.path.join(directory, f"bench_u{num_users}_v{num_videos}_s{seed}.db")
+
+
+########## BENCHMARKS ##########
+
+def benchmark_cases(num_users, num_videos):
+    """Return (name, callable(database, rng)) pairs for each hot Database method."""
+    def random_user(rng):
+        return rng.randrange(1, num_users + 1)
+
+    def lookup_progress(d, rng):
+        user_id = random_user(rng)
+        return d.lookup_progress(user_id, chat_id_for(user_id))
+
+    def record_upload(d, rng):
+        # Mostly new files, with some repeats of seeded ones
+        user_id = random_user(rng)
+        n = rng.randrange(max(num_videos, 1) * 2)
+        return d.record_upload(user_id, f"BAACAg{n:016x}", unique_file_id_for(n), chat_id_for(user_id))
+
+    return [
+        ("lookup_progress", lookup_progress),
+        ("lookup_is_user_banned", lambda d, rng: d.lookup_is_user_banned(random_user(rng))),
+        ("lookup_invite_link", lambda d, rng: d.lookup_invite_link(invite_link_for(random_user(rng)))),
+        ("record_upload", record_upload),
+        ("return_all_users", lambda d, rng: d.return_all_users()),
+    ]
+
+
+def query_plans(connection, statements):
+    plans = []
+    for statement in statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+            continue
+        rows = connection.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+        plans.append({"sql": " ".join(statement.split()), "plan": [row[3] for row in rows]})
+    return plans
+
+
+def run_case(path, name, case, iterations, seed):
+    rng = random.Random(seed)
+    Database.DB_LOCATION = path
+
+    # Cold: first call on a freshly opened connection
+    database = Database()
+    statements = []
+    database.connection.set_trace_callback(statements.append)
+    start = time.perf_counter()
+    case(database, rng)
+    cold = time.perf_counter() - start
+    database.connection.set_trace_callback(None)
+    plans = query_plans(database.connection, statements)
+
+    # Warm: repeated calls on the same connection
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        case(database, rng)
+        samples.append(time.perf_counter() - start)
+    database.connection.close()
+
+    samples.sort()
+    return {
+        "method": name,
+        "cold_ms": round(cold * 1000, 4),
+        "warm_p50_ms": round(statistics.median(samples) * 1000, 4),
+        "warm_p99_ms": round(samples[min(len(samples) - 1, int(0.99 * len(samples)))] * 1000, 4),
+        "warm_iterations": iterations,
+        "statements": plans,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark db_utils.Database hot queries.")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000],
+                        help="number of users (one database per value)")
+    parser.add_argument("--videos", type=int, default=100_000, help="row count for uploaded_videos")
+    parser.add_argument("--iterations", type=int, default=1000, help="warm calls per method")
+    parser.add_argument("--full-scan-iterations", type=int, default=3, help="warm calls for return_all_users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default="bench_data", help="where generated databases are cached")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "sqlite_version": sqlite3.sqlite_version,
+            "python_version": platform.python_version(),
+            "seed": args.seed,
+            "videos": args.videos,
+        },
+        "results": [],
+    }
+
+    for num_users in args.users:
+        path = database_path(args.dir, num_users, args.videos, args.seed)
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            generate_database(path, num_users, args.videos, args.seed)
+            print(f"Generated {path} in {time.perf_counter() - start:.1f}s")
+
+        print(f"\n== users: {num_users:,} rows, uploaded_videos: {args.videos:,} rows ==")
+        for name, case in benchmark_cases(num_users, args.videos):
+            iterations = args.full_scan_iterations if name == "return_all_users" else args.iterations
+            if name in WRITE_CASES:
+                with tempfile.TemporaryDirectory() as scratch:
+                    copy = shutil.copy(path, os.path.join(scratch, os.path.basename(path)))
+                    result = run_case(copy, name, case, iterations, args.seed)
+            else:
+                result = run_case(path, name, case, iterations, args.seed)
+            result.update({"users": num_users, "videos": args.videos})
+            report["results"].append(result)
+            print(f"{name:<26} cold {result['cold_ms']:>10.3f} ms   warm p50 {result['warm_p50_ms']:>9.4f} ms"
+                  f"   p99 {result['warm_p99_ms']:>9.4f} ms")
+            for statement in result["statements"]:
+                for step in statement["plan"]:
+                    print(f"    {step}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
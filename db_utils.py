@@ -1,16 +1,129 @@
 import sqlite3
 import logging
+import json
 from  threading import RLock
 from config import DATABASE_PATH
 from datetime import datetime, timedelta, timezone
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from enum import Enum
+from profiling import span
 
 
 class settings (Enum):
     DEST_ID = "destination_chat_id"
 
 
+JOB_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Stored in PRAGMA user_version once _ensure_schema has run. Bump it whenever _ensure_schema changes,
+# otherwise existing databases will not pick the change up.
+SCHEMA_VERSION = 7
+
+
+USERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id INTEGER,
+        full_name STRING,
+        username STRING,
+        last_accessed_bot TIMESTAMP,
+        last_uploaded_video TIMESTAMP,
+        number_videos_uploaded INTEGER DEFAULT 0,
+        access_granted TIMESTAMP,
+        invite_link STRING,
+        link_used TIMESTAMP,
+        chat_id INTEGER NOT NULL DEFAULT 0,
+        banned BOOLEAN DEFAULT FALSE,
+        PRIMARY KEY (user_id, chat_id)
+    )
+"""
+
+# A user's row in the original single-table layout (users_requesting_entry), put back together from
+# user_profiles, user_progress and the newest invite_grants row, for exports and archives
+USER_ROW_SQL = """
+    SELECT p.user_id, f.full_name, f.username, p.last_accessed_bot, p.last_uploaded_video,
+        p.number_videos_uploaded, p.access_granted, CASE WHEN g.expired THEN NULL ELSE g.invite_link END,
+        g.link_used, p.chat_id, COALESCE(f.banned, FALSE)
+    FROM user_progress p
+    LEFT JOIN user_profiles f ON f.user_id = p.user_id
+    LEFT JOIN invite_grants g ON g.rowid = (
+        SELECT rowid FROM invite_grants
+        WHERE user_id = p.user_id AND chat_id = p.chat_id
+        ORDER BY access_granted DESC LIMIT 1
+    )
+"""
+
+# A banned user's unused links can't be handed out again, so they are expired (and later revoked)
+EXPIRE_USER_LINKS_SQL = """
+    UPDATE invite_grants
+    SET expired = TRUE
+    WHERE user_id = ? AND link_used IS NULL AND NOT expired
+"""
+
+# Moves rows matching {condition} out of users_requesting_entry, which databases from before the split
+# still have until the migration has drained it (see migrate_legacy_users)
+LEGACY_MOVE_SQL = (
+    """
+    INSERT INTO user_profiles (user_id, full_name, username, banned)
+    SELECT user_id, MAX(full_name), MAX(username), MAX(COALESCE(banned, FALSE)) FROM users_requesting_entry
+    WHERE {condition}
+    GROUP BY user_id
+    ON CONFLICT(user_id) DO UPDATE
+    SET full_name = COALESCE(user_profiles.full_name, EXCLUDED.full_name),
+        username = COALESCE(user_profiles.username, EXCLUDED.username),
+        banned = user_profiles.banned OR EXCLUDED.banned
+    """,
+    """
+    INSERT OR IGNORE INTO user_progress (user_id, chat_id, last_accessed_bot, last_uploaded_video,
+        number_videos_uploaded, access_granted)
+    SELECT user_id, chat_id, last_accessed_bot, last_uploaded_video, COALESCE(number_videos_uploaded, 0), access_granted
+    FROM users_requesting_entry
+    WHERE {condition}
+    """,
+    """
+    INSERT OR IGNORE INTO invite_grants (invite_link, user_id, chat_id, access_granted, link_used)
+    SELECT invite_link, user_id, chat_id, access_granted, link_used FROM users_requesting_entry
+    WHERE invite_link IS NOT NULL AND ({condition})
+    """,
+    "DELETE FROM users_requesting_entry WHERE {condition}",
+)
+
+# Funnel stages counted per destination chat and UTC day (see /stats)
+FUNNEL_COUNTERS = ("started", "uploaded", "qualified", "links_granted", "joined", "banned")
+
+# Takes the invite link that was used. A join counts once per user and chat, however many links they were given.
+JOINED_FOR_FIRST_TIME = """
+    EXISTS (SELECT 1 FROM invite_grants g WHERE g.invite_link = ? AND g.link_used IS NULL
+        AND NOT EXISTS (SELECT 1 FROM invite_grants u
+                        WHERE u.user_id = g.user_id AND u.chat_id = g.chat_id AND u.link_used IS NOT NULL))
+"""
+
+FUNNEL_BUMP_SQL = """
+    INSERT INTO funnel_counters (day, chat_id, counter, value)
+    SELECT date('now'), ?, ?, 1 WHERE {condition}
+    ON CONFLICT(day, chat_id, counter) DO UPDATE SET value = value + EXCLUDED.value
+"""
+
+# One ban touches every chat the user asked to join; count it once per chat where they were not banned yet
+BANNED_FUNNEL_SQL = """
+    INSERT INTO funnel_counters (day, chat_id, counter, value)
+    SELECT date('now'), chat_id, 'banned', 1 FROM user_progress
+    WHERE user_id = ? AND chat_id != 0
+        AND NOT EXISTS (SELECT 1 FROM user_profiles WHERE user_id = ? AND banned)
+    ON CONFLICT(day, chat_id, counter) DO UPDATE SET value = value + EXCLUDED.value
+"""
+
+UPLOADED_VIDEOS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        user_id INTEGER,
+        file_id STRING,
+        unique_file_id STRING,
+        chat_id INTEGER NOT NULL DEFAULT 0,
+        upload_time TIMESTAMP,
+        PRIMARY KEY (user_id, chat_id, file_id)
+    )
+"""
+
+
 class Database(object):
 
     DB_LOCATION = DATABASE_PATH
@@ -21,8 +134,22 @@ class Database(object):
             self.lock = RLock()
             self.connection = sqlite3.connect(Database.DB_LOCATION, check_same_thread=False)
             self.cur = self.connection.cursor()
+            # Lets maintenance give free pages back in small slices. Only takes effect on a new database file.
+            self.cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # WAL lets several bot workers share the file: readers never block the writer
+            self.cur.execute("PRAGMA journal_mode = WAL")
+
+            # The full schema check runs a dozen statements, so skip it when the file is already current
+            self.cur.execute("PRAGMA user_version")
+            self.schema_checked = self.cur.fetchone()[0] != SCHEMA_VERSION
+            if self.schema_checked:
+                self._ensure_schema()
+                self.cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self._commit()
 
-            self._ensure_schema()
+            # True until migrate_legacy_users has emptied and dropped the old users table
+            self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_requesting_entry'")
+            self.legacy_users = self.cur.fetchone() is not None
         except sqlite3.Error as e:
             logging.error(f"Database error: {e}")
             raise e # Initialization errors are catastrophic and should be reraised
@@ -35,7 +162,7 @@ class Database(object):
             # If there's an exception, roll back any changes made during the transaction.
             try:
                 self.connection.rollback()
-                logging.info(f"Database transaction rolled back due to an exception: {exc_value}")
+                logging.info("Database transaction rolled back due to an exception: %s", exc_value)
             except sqlite3.Error as e:
                 logging.error(f"Database transaction rolled back due to an exception: {exc_value} \n \
                               The following exception occured during rollback: {e}")
@@ -53,34 +180,81 @@ class Database(object):
 
     def _ensure_schema(self):
         """create a database table if it does not exist already"""
+        # Users used to live in one wide table, users_requesting_entry. Older versions of it are brought up to
+        # date here, and migrate_legacy_users then moves its rows into the three tables below while the bot runs.
+        self.cur.execute(f"PRAGMA table_info(users_requesting_entry)")
+        table_info = self.cur.fetchall()
+        legacy_users = bool(table_info)
+        columns = [column[1] for column in table_info]
+
+        if legacy_users and 'chat_id' not in columns:
+            # If the column doesn't exist, add it to the table
+            self.cur.execute(f"ALTER TABLE users_requesting_entry ADD COLUMN chat_id INTEGER")
+
+        if legacy_users and 'banned' not in columns:
+            # If the column doesn't exist, add it to the table
+            self.cur.execute(f"ALTER TABLE users_requesting_entry ADD COLUMN banned BOOLEAN DEFAULT FALSE")
+
+        # Progress used to be tracked per user only. Rows are now keyed by (user_id, chat_id).
+        per_chat_rows = any(column[1] == 'chat_id' and column[5] for column in table_info)
+
+
+        # Who a user is. One row per user; written when their name changes or they are banned.
         self.cur.execute("""
-            CREATE TABLE IF NOT EXISTS users_requesting_entry (
-                user_id INTEGER,
+            CREATE TABLE IF NOT EXISTS user_profiles (
+                user_id INTEGER PRIMARY KEY,
                 full_name STRING,
                 username STRING,
+                banned BOOLEAN DEFAULT FALSE
+            )
+        """
+        )
+
+
+        # How far a user has got toward one destination chat. Narrow, since every upload rewrites it.
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_progress (
+                user_id INTEGER,
+                chat_id INTEGER NOT NULL DEFAULT 0,
                 last_accessed_bot TIMESTAMP,
                 last_uploaded_video TIMESTAMP,
                 number_videos_uploaded INTEGER DEFAULT 0,
                 access_granted TIMESTAMP,
-                invite_link STRING,
-                link_used TIMESTAMP,         
-                chat_id INTEGER,
-                banned BOOLEAN DEFAULT FALSE,
-                PRIMARY KEY (user_id)
+                PRIMARY KEY (user_id, chat_id)
             )
         """
         )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_chat_id ON user_progress (chat_id)")
 
-        self.cur.execute(f"PRAGMA table_info(users_requesting_entry)")
-        columns = [column[1] for column in self.cur.fetchall()]
 
-        if 'chat_id' not in columns:
-            # If the column doesn't exist, add it to the table
-            self.cur.execute(f"ALTER TABLE users_requesting_entry ADD COLUMN chat_id INTEGER")
-
-        if 'banned' not in columns:
-            # If the column doesn't exist, add it to the table
-            self.cur.execute(f"ALTER TABLE users_requesting_entry ADD COLUMN banned BOOLEAN DEFAULT FALSE")
+        # Every invite link handed out. A user's current link is their newest row for the chat; older
+        # unused ones are marked expired when a new one is granted.
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS invite_grants (
+                invite_link STRING PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                access_granted TIMESTAMP,
+                link_used TIMESTAMP,
+                used_by INTEGER,
+                expired BOOLEAN DEFAULT FALSE,
+                revoked_at TIMESTAMP
+            )
+        """
+        )
+        self.cur.execute("PRAGMA table_info(invite_grants)")
+        if 'revoked_at' not in [column[1] for column in self.cur.fetchall()]:
+            self.cur.execute("ALTER TABLE invite_grants ADD COLUMN revoked_at TIMESTAMP")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_invite_grants_user_chat ON invite_grants (user_id, chat_id, access_granted)")
+        self.cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_invite_grants_outstanding
+            ON invite_grants (access_granted) WHERE link_used IS NULL AND NOT expired
+        """)
+        # Dead links still to be revoked in Telegram (see return_links_to_revoke)
+        self.cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_invite_grants_revocable
+            ON invite_grants (access_granted) WHERE expired AND link_used IS NULL AND revoked_at IS NULL
+        """)
 
 
         self.cur.execute("""
@@ -102,16 +276,100 @@ class Database(object):
 
 
         self.cur.execute("""
-            CREATE TABLE IF NOT EXISTS uploaded_videos (
+            CREATE TABLE IF NOT EXISTS destination_chats (
+                chat_id INTEGER PRIMARY KEY,
+                uploads_needed INTEGER,
+                minutes_to_link_expiration INTEGER
+            )
+        """
+        )
+
+
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_destinations (
+                user_id INTEGER PRIMARY KEY,
+                chat_id INTEGER
+            )
+        """
+        )
+
+
+        # Progress of chat cleanups, so an interrupted cleanup resumes into the same archive file
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_cleanups (
+                chat_id INTEGER PRIMARY KEY,
+                chat_title STRING,
+                file_path STRING,
+                rows_archived INTEGER DEFAULT 0,
+                started_at TIMESTAMP
+            )
+        """
+        )
+
+
+        # Running totals for /stats, bumped in the same transactions as the rows they count
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS funnel_counters (
+                day DATE,
+                chat_id INTEGER,
+                counter STRING,
+                value INTEGER DEFAULT 0,
+                PRIMARY KEY (day, chat_id, counter)
+            )
+        """
+        )
+
+
+        # Thumbnail fingerprints for near-duplicate detection (see fingerprints.py)
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS video_fingerprints (
                 user_id INTEGER,
-                file_id STRING,
+                chat_id INTEGER,
                 unique_file_id STRING,
+                fingerprint INTEGER NOT NULL,
+                PRIMARY KEY (user_id, chat_id, unique_file_id)
+            )
+        """
+        )
+
+
+        # Append-only journal of what happened to each user (see event_journal.py). Rows are never updated.
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                event_id INTEGER PRIMARY KEY,
+                created_at TIMESTAMP NOT NULL,
+                kind STRING NOT NULL,
+                user_id INTEGER,
                 chat_id INTEGER,
-                upload_time TIMESTAMP,
-                PRIMARY KEY (user_id, file_id)
+                detail TEXT
             )
         """
         )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_events_user_id ON events (user_id, created_at)")
+
+
+        # Abandoned users moved out of users_requesting_entry by maintenance
+        self.cur.execute(USERS_TABLE_SQL.format(table="archived_users"))
+
+
+        # Delayed work (album processing, message deletions, link expiry) that must survive a restart
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_key STRING UNIQUE,
+                kind STRING NOT NULL,
+                run_at TIMESTAMP NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                locked_until TIMESTAMP
+            )
+        """
+        )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_run_at ON scheduled_jobs (run_at)")
+
+
+        self.cur.execute(UPLOADED_VIDEOS_TABLE_SQL.format(table="uploaded_videos"))
 
         self.cur.execute(f"PRAGMA table_info(uploaded_videos)")
         columns = [column[1] for column in self.cur.fetchall()]
@@ -120,8 +378,103 @@ class Database(object):
             # If the column doesn't exist, add it to the table
             self.cur.execute(f"ALTER TABLE uploaded_videos ADD COLUMN unique_file_id STRING")
 
+        if legacy_users and not per_chat_rows:
+            self._migrate_to_per_chat_rows()
+
+        if legacy_users:
+            # Until the rows have been moved, chat cleanups and join events still look them up here
+            self.cur.execute("CREATE INDEX IF NOT EXISTS idx_users_requesting_entry_chat_id ON users_requesting_entry (chat_id)")
+            self.cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_requesting_entry_invite_link
+                ON users_requesting_entry (invite_link) WHERE invite_link IS NOT NULL
+            """)
+        self._ensure_unique_uploads()
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_videos_user_chat_time ON uploaded_videos (user_id, chat_id, upload_time)")
+        # Finds everyone who shared a file, for bulk bans
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_uploaded_videos_unique_file_id ON uploaded_videos (unique_file_id)")
+
+
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'media_index'")
+        media_index_exists = self.cur.fetchone() is not None
+        self.cur.execute("""
+            CREATE TABLE IF NOT EXISTS media_index (
+                unique_file_id STRING PRIMARY KEY,
+                first_seen_user_id INTEGER,
+                first_seen_time TIMESTAMP,
+                reuse_count INTEGER DEFAULT 1
+            )
+        """
+        )
+
+        if not media_index_exists:
+            # Backfill from existing uploads: first uploader and number of distinct uploaders per file
+            self.cur.execute("""
+                INSERT INTO media_index (unique_file_id, first_seen_user_id, first_seen_time, reuse_count)
+                SELECT unique_file_id, user_id, MIN(upload_time), COUNT(DISTINCT user_id)
+                FROM uploaded_videos
+                WHERE unique_file_id IS NOT NULL
+                GROUP BY unique_file_id
+            """
+            )
+
         self._commit()
 
+    def _ensure_unique_uploads(self):
+        """make (user_id, chat_id, unique_file_id) unique so record_upload can skip repeats with ON CONFLICT"""
+        self.cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_uploaded_videos_user_chat_unique_file'")
+        if self.cur.fetchone() is not None:
+            return
+        # The old pre-check could race, so keep only the first copy of any repeated upload
+        self.cur.execute("""
+            DELETE FROM uploaded_videos
+            WHERE unique_file_id IS NOT NULL
+              AND rowid NOT IN (
+                  SELECT MIN(rowid) FROM uploaded_videos
+                  WHERE unique_file_id IS NOT NULL
+                  GROUP BY user_id, chat_id, unique_file_id
+              )
+        """)
+        self.cur.execute("DROP INDEX IF EXISTS idx_uploaded_videos_user_chat_file")
+        self.cur.execute("""
+            CREATE UNIQUE INDEX idx_uploaded_videos_user_chat_unique_file
+            ON uploaded_videos (user_id, chat_id, unique_file_id)
+        """)
+
+
+    def _migrate_to_per_chat_rows(self):
+        """rebuild users_requesting_entry and uploaded_videos keyed by (user_id, chat_id, ...)"""
+        logging.warning("Migrating users_requesting_entry to per-chat rows.")
+        self.cur.execute(USERS_TABLE_SQL.format(table="users_requesting_entry_migrated"))
+        self.cur.execute("""
+            INSERT OR IGNORE INTO users_requesting_entry_migrated (user_id, full_name, username, last_accessed_bot,
+                last_uploaded_video, number_videos_uploaded, access_granted, invite_link, link_used, chat_id, banned)
+            SELECT user_id, full_name, username, last_accessed_bot, last_uploaded_video, number_videos_uploaded,
+                access_granted, invite_link, link_used, COALESCE(chat_id, 0), COALESCE(banned, FALSE)
+            FROM users_requesting_entry
+        """
+        )
+        self.cur.execute("DROP TABLE users_requesting_entry")
+        self.cur.execute("ALTER TABLE users_requesting_entry_migrated RENAME TO users_requesting_entry")
+
+        # uploaded_videos.chat_id used to hold the private chat the video was sent in
+        self.cur.execute(UPLOADED_VIDEOS_TABLE_SQL.format(table="uploaded_videos_migrated"))
+        self.cur.execute("""
+            INSERT OR IGNORE INTO uploaded_videos_migrated (user_id, file_id, unique_file_id, chat_id, upload_time)
+            SELECT v.user_id, v.file_id, v.unique_file_id,
+                COALESCE((SELECT u.chat_id FROM users_requesting_entry u WHERE u.user_id = v.user_id LIMIT 1), 0),
+                v.upload_time
+            FROM uploaded_videos v
+        """
+        )
+        self.cur.execute("DROP TABLE uploaded_videos")
+        self.cur.execute("ALTER TABLE uploaded_videos_migrated RENAME TO uploaded_videos")
+        self.cur.execute("""
+            INSERT OR IGNORE INTO user_destinations (user_id, chat_id)
+            SELECT user_id, chat_id FROM users_requesting_entry WHERE chat_id != 0
+        """
+        )
+
+
     def _close(self):
         """close sqlite3 connection"""
         try:
@@ -135,12 +488,17 @@ class Database(object):
     def _execute(self, query, params=None):
         """Execute a row of data to current cursor with detailed error handling."""
         try:
-            with self.lock:
-                if params is None:
-                    self.cur.execute(query)
-                else:
-                    self.cur.execute(query, params)
+            with span("lock wait", "db"):
+                self.lock.acquire()
+            try:
+                with span(query, "db"):
+                    if params is None:
+                        self.cur.execute(query)
+                    else:
+                        self.cur.execute(query, params)
                 return True
+            finally:
+                self.lock.release()
         except sqlite3.Error as e:
             logging.error(f"Database error during execute: {e} - Query: {query}")
             # You could optionally include more information about the error
@@ -157,21 +515,143 @@ class Database(object):
 
     def _commit(self):
         """commit changes to database"""
-        with self.lock:
+        with self.lock, span("COMMIT", "db"):
             self.connection.commit()
 
 
+    def _legacy_rows(self, query, params=()) -> List[Tuple]:
+        """run a read against users_requesting_entry while it still exists, otherwise return nothing"""
+        if not self.legacy_users:
+            return []
+        try:
+            with self.lock:
+                self.cur.execute(query, params)
+                return self.cur.fetchall()
+        except sqlite3.OperationalError as e:
+            if "no such table" not in str(e):
+                raise
+            self.legacy_users = False  # Another worker finished the migration and dropped the table
+            return []
+
+
+    def _adopt_legacy_users(self, user_ids: List[int], batch_size: int = 500, commit: bool = True) -> None:
+        """move these users' rows out of users_requesting_entry before they are read or written in the new
+        tables. with commit=False the move becomes part of the caller's transaction"""
+        moved = False
+        with self.lock:
+            for start in range(0, len(user_ids), batch_size):
+                batch = list(user_ids[start:start + batch_size])
+                legacy = self._legacy_rows(f"""
+                    SELECT DISTINCT user_id FROM users_requesting_entry
+                    WHERE user_id IN ({", ".join("?" * len(batch))})
+                """, batch)
+                for (user_id,) in legacy:
+                    for statement in LEGACY_MOVE_SQL:
+                        self.cur.execute(statement.format(condition="user_id = ?"), (user_id,))
+                    moved = True
+            if moved and commit:
+                self._commit()
+
+
+    def _adopt_legacy_links(self, invite_links: List[str], batch_size: int = 500, commit: bool = True) -> None:
+        """move the rows of whoever was given these invite links out of users_requesting_entry"""
+        owners = []
+        for start in range(0, len(invite_links), batch_size):
+            batch = list(invite_links[start:start + batch_size])
+            owners += self._legacy_rows(f"""
+                SELECT DISTINCT user_id FROM users_requesting_entry
+                WHERE invite_link IN ({", ".join("?" * len(batch))})
+            """, batch)
+        if owners:
+            self._adopt_legacy_users([owner[0] for owner in owners], batch_size, commit)
+
+
+    def count_legacy_users(self) -> int:
+        """rows still waiting in users_requesting_entry"""
+        rows = self._legacy_rows("SELECT COUNT(*) FROM users_requesting_entry")
+        return rows[0][0] if rows else 0
+
+
+    def migrate_legacy_users(self, limit: int) -> int:
+        """move the next `limit` rows of users_requesting_entry into the split tables in one transaction.
+        returns how many were moved; once none are left the old table is dropped and 0 is returned"""
+        try:
+            with self.lock:
+                rows = self._legacy_rows("""
+                    SELECT MAX(rowid) FROM (
+                        SELECT rowid FROM users_requesting_entry
+                        ORDER BY rowid
+                        LIMIT ?
+                    )
+                """, (limit,))
+                last_rowid = rows[0][0] if rows else None
+                if last_rowid is None:
+                    if self.legacy_users:
+                        self.cur.execute("DROP TABLE IF EXISTS users_requesting_entry")
+                        self._commit()
+                        self.legacy_users = False
+                    return 0
+                for statement in LEGACY_MOVE_SQL:
+                    self.cur.execute(statement.format(condition="rowid <= ?"), (last_rowid,))
+                moved = self.cur.rowcount
+                self._commit()
+                return moved
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error migrating users: {e}")
+
+
+    def _bump_funnel(self, counter: str, chat_id, condition: str = "TRUE", params: Tuple = ()) -> bool:
+        """add one to today's funnel counter for chat_id if condition holds. the caller commits"""
+        return self._execute(FUNNEL_BUMP_SQL.format(condition=condition), (chat_id, counter, *params))
+
+
+    def return_funnel_counters(self, since_day: str) -> List[Tuple]:
+        """return (day, chat_id, counter, value) rows from since_day (YYYY-MM-DD, UTC) onward"""
+        query = """
+                SELECT day, chat_id, counter, value FROM funnel_counters
+                WHERE day >= ?
+                """
+        params = (since_day,)
+        success = self._execute(query, params)
+        if success:
+            return self.cur.fetchall()
+        else:
+            raise Exception("Error returning funnel counters")
+
+
     def record_bot_user(self, user_id, full_name, username, chat_id) -> bool:
-        """record bot access time for user"""
+        """record bot access time for user and make chat_id the user's current destination"""
+        self._adopt_legacy_users([user_id])
+        success = self._bump_funnel("started", chat_id, """
+                NOT EXISTS (SELECT 1 FROM user_progress WHERE user_id = ? AND chat_id = ?)
+                """, (user_id, chat_id))
+        # Only rewritten when the name changed
         query = """
-                INSERT INTO users_requesting_entry (user_id, full_name, username, last_accessed_bot, chat_id)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO user_profiles (user_id, full_name, username)
+                VALUES (?, ?, ?)
                 ON CONFLICT(user_id) DO UPDATE
-                SET last_accessed_bot = EXCLUDED.last_accessed_bot,
-                    chat_id = EXCLUDED.chat_id
+                SET full_name = EXCLUDED.full_name,
+                    username = EXCLUDED.username
+                WHERE user_profiles.full_name IS NOT EXCLUDED.full_name
+                    OR user_profiles.username IS NOT EXCLUDED.username
                 """
-        params =  (user_id, full_name, username, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"), chat_id)
-        success = self._execute(query, params)
+        success = success and self._execute(query, (user_id, full_name, username))
+        query = """
+                INSERT INTO user_progress (user_id, chat_id, last_accessed_bot)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, chat_id) DO UPDATE
+                SET last_accessed_bot = EXCLUDED.last_accessed_bot
+                """
+        params =  (user_id, chat_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
+        success = success and self._execute(query, params)
+        query = """
+                INSERT INTO user_destinations (user_id, chat_id)
+                VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE
+                SET chat_id = EXCLUDED.chat_id
+                """
+        success = success and self._execute(query, (user_id, chat_id))
         if success:
             self._commit()
         else:
@@ -181,85 +661,159 @@ class Database(object):
 
     def delete_user(self, user_id) -> bool:
         """delete user from database"""
-        query = """
-                DELETE FROM users_requesting_entry
-                WHERE user_id = ?
-                """
-        params = (user_id,)
-        success = self._execute(query, params)
-        query = """
-                DELETE FROM uploaded_videos
-                WHERE user_id = ?
-                """
+        self._adopt_legacy_users([user_id])
         params = (user_id,)
-        success_2 = self._execute(query, params)
+        success = True
+        for table in ("user_progress", "invite_grants", "user_profiles", "uploaded_videos", "user_destinations", "video_fingerprints"):
+            success = success and self._execute(f"DELETE FROM {table} WHERE user_id = ?", params)
 
-        if success and success_2:
+        if success:
             self._commit()
         else:
             raise Exception("Error deleting user")
         return success
     
     
-    def record_video_upload(self, user_id) -> bool:
-
-        ## NOTE Add coalesce for times uploaded
-        """record video upload time for user"""
-        query = """
-                INSERT INTO users_requesting_entry (user_id, last_uploaded_video, number_videos_uploaded)
-                VALUES (?, ?, 1)
-                ON CONFLICT(user_id) DO UPDATE
-                SET last_uploaded_video = EXCLUDED.last_uploaded_video,
-                    number_videos_uploaded = users_requesting_entry.number_videos_uploaded + 1
-                """
-        params =  (user_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
-        success = self._execute(query, params)
-        if success:
-            self._commit()
-            fetch_query = "SELECT number_videos_uploaded FROM users_requesting_entry WHERE user_id = ?"
-            self.cur.execute(fetch_query, (user_id,))
-            number_videos_uploaded = self.cur.fetchone()[0]     
-        else:
-            raise Exception("Error recording video upload time")
+    def record_upload(self, user_id: int, file_id: str, unique_file_id: str, chat_id: int, counted: bool = True,
+                      uploads_needed: int = None, fingerprint: int = None) -> Optional[int]:
+        """store an uploaded video, add it to the media index and (if counted) bump the user's upload count,
+        all in one transaction. returns the new upload count, 0 if the video was stored without being counted,
+        or None if the user already uploaded this file for the chat. reaching uploads_needed counts as qualifying.
+        fingerprint (a signed 64-bit thumbnail hash) is stored with the upload when given"""
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        try:
+            with self.lock, span("record_upload", "db"):
+                self._adopt_legacy_users([user_id], commit=False)
+                self.cur.execute("""
+                    INSERT INTO uploaded_videos (user_id, file_id, unique_file_id, chat_id, upload_time)
+                    VALUES (?, ?, ?, ?, datetime('now'))
+                    ON CONFLICT DO NOTHING
+                    RETURNING 1
+                """, (user_id, file_id, unique_file_id, chat_id))
+                if self.cur.fetchone() is None:
+                    self._commit()
+                    return None
+                # reuse_count counts users, so the same user sending the file for another chat doesn't add to it
+                self.cur.execute("""
+                    INSERT INTO media_index (unique_file_id, first_seen_user_id, first_seen_time, reuse_count)
+                    VALUES (?, ?, ?, 1)
+                    ON CONFLICT(unique_file_id) DO UPDATE
+                    SET reuse_count = media_index.reuse_count + 1
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM uploaded_videos
+                        WHERE unique_file_id = EXCLUDED.unique_file_id AND user_id = ? AND chat_id != ?
+                    )
+                """, (unique_file_id, user_id, now, user_id, chat_id))
+                if fingerprint is not None:
+                    self.cur.execute("""
+                        INSERT OR IGNORE INTO video_fingerprints (user_id, chat_id, unique_file_id, fingerprint)
+                        VALUES (?, ?, ?, ?)
+                    """, (user_id, chat_id, unique_file_id, fingerprint))
+                number_videos_uploaded = 0
+                if counted:
+                    self.cur.execute("""
+                        INSERT INTO user_progress (user_id, chat_id, last_uploaded_video, number_videos_uploaded)
+                        VALUES (?, ?, ?, 1)
+                        ON CONFLICT(user_id, chat_id) DO UPDATE
+                        SET last_uploaded_video = EXCLUDED.last_uploaded_video,
+                            number_videos_uploaded = user_progress.number_videos_uploaded + 1
+                        RETURNING number_videos_uploaded
+                    """, (user_id, chat_id, now))
+                    number_videos_uploaded = self.cur.fetchone()[0]
+                    if number_videos_uploaded == 1:
+                        self.cur.execute(FUNNEL_BUMP_SQL.format(condition="TRUE"), (chat_id, "uploaded"))
+                    if number_videos_uploaded == uploads_needed:
+                        self.cur.execute(FUNNEL_BUMP_SQL.format(condition="TRUE"), (chat_id, "qualified"))
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording video upload: {e}")
         return number_videos_uploaded
-    
+
 
     def record_access_granted(self, user_id, invite_link, chat_id) -> bool:
-        """record access granted time for user"""
-        query = """
-                INSERT INTO users_requesting_entry (user_id, access_granted, invite_link, chat_id)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE
-                SET access_granted = EXCLUDED.access_granted,
-                    invite_link = EXCLUDED.invite_link,
-                    link_used = NULL,
-                    chat_id = EXCLUDED.chat_id
-                """
-        params =  (user_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"), invite_link, chat_id)
-        success = self._execute(query, params)
-        if success:
-            self._commit()
-        else:
-            raise Exception("Error recording access granted time")
-        return success
+        """record that the user qualified for chat_id and was given invite_link (None if it could not be created).
+        any earlier link of theirs for the chat that was not used is marked expired"""
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        try:
+            with self.lock:
+                self._adopt_legacy_users([user_id], commit=False)
+                self.cur.execute("""
+                    UPDATE invite_grants
+                    SET expired = TRUE
+                    WHERE user_id = ? AND chat_id = ? AND link_used IS NULL AND NOT expired
+                """, (user_id, chat_id))
+                if invite_link:
+                    self.cur.execute("""
+                        INSERT INTO invite_grants (invite_link, user_id, chat_id, access_granted)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(invite_link) DO NOTHING
+                    """, (invite_link, user_id, chat_id, now))
+                    self.cur.execute(FUNNEL_BUMP_SQL.format(condition="TRUE"), (chat_id, "links_granted"))
+                self.cur.execute("""
+                    INSERT INTO user_progress (user_id, chat_id, access_granted)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, chat_id) DO UPDATE
+                    SET access_granted = EXCLUDED.access_granted
+                """, (user_id, chat_id, now))
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording access granted time: {e}")
+        return True
     
 
-    def record_link_used(self, user_id) -> bool:
-        """record link used time for user"""
+    def record_link_used(self, invite_link, user_id, chat_id) -> bool:
+        """record that user_id joined chat_id with invite_link"""
+        return self.record_links_used([(invite_link, user_id, chat_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))])
+    
+
+    def record_links_used(self, links_used: List[Tuple]) -> bool:
+        """record many (invite_link, user_id who joined, chat_id, link_used time) rows in one transaction"""
+        if not links_used:
+            return True
+        try:
+            with self.lock:
+                self._adopt_legacy_links([row[0] for row in links_used], commit=False)
+                for invite_link, user_id, chat_id, link_used in links_used:
+                    self.cur.execute(FUNNEL_BUMP_SQL.format(condition=JOINED_FOR_FIRST_TIME),
+                                     (chat_id, "joined", invite_link))
+                    self.cur.execute("""
+                        UPDATE invite_grants
+                        SET link_used = ?, used_by = ?
+                        WHERE invite_link = ? AND link_used IS NULL
+                    """, (link_used, user_id, invite_link))
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording links used: {e}")
+        return True
+
+
+    def return_outstanding_invite_links(self, limit: int) -> List[Tuple]:
+        """return up to limit unused invite links, newest first, as (invite_link, user_id, chat_id, access_granted)"""
         query = """
-                INSERT INTO users_requesting_entry (user_id, link_used)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE
-                SET link_used = EXCLUDED.link_used
+                SELECT invite_link, user_id, chat_id, access_granted FROM invite_grants
+                WHERE link_used IS NULL AND NOT expired
+                ORDER BY access_granted DESC
+                LIMIT ?
                 """
-        params =  (user_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
+        params = (limit,)
         success = self._execute(query, params)
         if success:
-            self._commit()
+            rows = self.cur.fetchall()
         else:
-            raise Exception("Error recording link used time")
-        return success  
-    
+            raise Exception("Error returning outstanding invite links")
+        legacy = self._legacy_rows("""
+                SELECT invite_link, user_id, chat_id, access_granted FROM users_requesting_entry
+                WHERE invite_link IS NOT NULL AND link_used IS NULL
+                ORDER BY access_granted DESC
+                LIMIT ?
+                """, params)
+        if legacy:
+            rows = sorted(rows + legacy, key=lambda row: row[3] or "", reverse=True)[:limit]
+        return rows
+
 
     def record_active_chat(self, chat_id, chat_name) -> bool:
         """record active chat in database"""
@@ -311,6 +865,35 @@ class Database(object):
         return success
     
 
+    def delete_setting(self, setting) -> bool:
+        """remove a setting from the database"""
+        query = """
+                DELETE FROM settings
+                WHERE setting = ?
+                """
+        params = (setting,)
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error deleting setting")
+        return success
+
+
+    def return_settings_with_prefix(self, prefix: str) -> dict:
+        """return {setting: value} for every setting whose name starts with prefix"""
+        query = """
+                SELECT setting, value FROM settings
+                WHERE substr(setting, 1, ?) = ?
+                """
+        params = (len(prefix), prefix)
+        success = self._execute(query, params)
+        if success:
+            return dict(self.cur.fetchall())
+        else:
+            raise Exception("Error returning settings")
+
+
     def lookup_setting(self, setting) -> Tuple:
         """lookup setting in database"""
         query = """
@@ -327,26 +910,42 @@ class Database(object):
         
 
     def lookup_invite_link(self, invite_link) -> Tuple:
-        """lookup invite link in database"""
+        """return (user_id, chat_id, access_granted, link_used) for an invite link that has not expired, or None"""
         query = """
-                SELECT * FROM users_requesting_entry
-                WHERE invite_link = ?
+                SELECT user_id, chat_id, access_granted, link_used FROM invite_grants
+                WHERE invite_link = ? AND NOT expired
                 """
         params = (invite_link,)
         success = self._execute(query, params)
         if success:
-            return self.cur.fetchone()
+            grant = self.cur.fetchone()
         else:
             raise Exception("Error looking up invite link")
+        if grant is None:
+            legacy = self._legacy_rows("""
+                SELECT user_id, chat_id, access_granted, link_used FROM users_requesting_entry
+                WHERE invite_link = ?
+                """, params)
+            grant = legacy[0] if legacy else None
+        return grant
     
     
-    def lookup_user(self, user_id) -> Tuple:
-        """lookup user in database"""
+    def lookup_progress(self, user_id, chat_id) -> Tuple:
+        """return (number_videos_uploaded, access_granted, invite_link, link_used) for a user and destination chat,
+        or None. invite_link and link_used are those of the newest link; invite_link is None once it expired"""
+        self._adopt_legacy_users([user_id])
         query = """
-                SELECT * FROM users_requesting_entry
-                WHERE user_id = ?
+                SELECT p.number_videos_uploaded, p.access_granted,
+                    CASE WHEN g.expired THEN NULL ELSE g.invite_link END, g.link_used
+                FROM user_progress p
+                LEFT JOIN invite_grants g ON g.rowid = (
+                    SELECT rowid FROM invite_grants
+                    WHERE user_id = p.user_id AND chat_id = p.chat_id
+                    ORDER BY access_granted DESC LIMIT 1
+                )
+                WHERE p.user_id = ? AND p.chat_id = ?
                 """
-        params = (user_id,)
+        params = (user_id, chat_id)
         success = self._execute(query, params)
         if success:
             return self.cur.fetchone()
@@ -364,35 +963,39 @@ class Database(object):
         success = self._execute(query, params)
         result = self.cur.fetchone()
         if success:
-            return result[0] if result[0] else None
+            return result[0] if result and result[0] else None
         else:
             raise Exception("Error looking up active chat")
 
 
-    def lookup_chat_id_for_user(self, user_id) -> Tuple:
-        """lookup active chat in database"""
+    def lookup_chat_ids_for_user(self, user_id) -> List[int]:
+        """lookup every destination chat a user has a row for"""
+        self._adopt_legacy_users([user_id])
         query = """
-                SELECT chat_id FROM users_requesting_entry
-                WHERE user_id = ?
+                SELECT chat_id FROM user_progress
+                WHERE user_id = ? AND chat_id != 0
                 """
         params = (user_id,)
         success = self._execute(query, params)
-        result = self.cur.fetchone()
         if success:
-            return result[0] if result[0] else None
+            return [row[0] for row in self.cur.fetchall()]
         else:
             raise Exception("Error looking up active chat")
 
     
     def record_banned_user(self, user_id) -> bool:
         """record banned user in database"""
+        self._adopt_legacy_users([user_id])
+        success = self._execute(BANNED_FUNNEL_SQL, (user_id, user_id))
         query = """
-                UPDATE users_requesting_entry
+                INSERT INTO user_profiles (user_id, banned)
+                VALUES (?, TRUE)
+                ON CONFLICT(user_id) DO UPDATE
                 SET banned = TRUE
-                WHERE user_id = ?
                 """
         params = (user_id,)
-        success = self._execute(query, params)
+        success = success and self._execute(query, params)
+        success = success and self._execute(EXPIRE_USER_LINKS_SQL, params)
         if success:
             self._commit()
         else:
@@ -400,43 +1003,94 @@ class Database(object):
         return success
 
 
+    def record_banned_users(self, user_ids: List[int]) -> int:
+        """mark many users banned in one transaction. Users the bot has never seen get a profile so the ban sticks"""
+        try:
+            with self.lock:
+                self._adopt_legacy_users(user_ids, commit=False)
+                self.cur.executemany(BANNED_FUNNEL_SQL, [(user_id, user_id) for user_id in user_ids])
+                self.cur.executemany("""
+                    INSERT INTO user_profiles (user_id, banned)
+                    VALUES (?, TRUE)
+                    ON CONFLICT(user_id) DO UPDATE
+                    SET banned = TRUE
+                """, [(user_id,) for user_id in user_ids])
+                self.cur.executemany(EXPIRE_USER_LINKS_SQL, [(user_id,) for user_id in user_ids])
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording banned users: {e}")
+        return len(user_ids)
+
+
+    def lookup_chat_ids_for_users(self, user_ids: List[int], batch_size: int = 500) -> dict:
+        """lookup the destination chats of many users at once, as {user_id: [chat_id, ...]}"""
+        self._adopt_legacy_users(user_ids)
+        chat_ids = {}
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            query = f"""
+                    SELECT user_id, chat_id FROM user_progress
+                    WHERE user_id IN ({", ".join("?" * len(batch))}) AND chat_id != 0
+                    """
+            success = self._execute(query, batch)
+            if success:
+                for user_id, chat_id in self.cur.fetchall():
+                    chat_ids.setdefault(user_id, []).append(chat_id)
+            else:
+                raise Exception("Error looking up chats for users")
+        return chat_ids
+
+
+    def lookup_users_for_media(self, unique_file_id: str) -> List[int]:
+        """return every user who uploaded a file"""
+        query = """
+                SELECT DISTINCT user_id FROM uploaded_videos
+                WHERE unique_file_id = ?
+                """
+        params = (unique_file_id,)
+        success = self._execute(query, params)
+        if success:
+            return [row[0] for row in self.cur.fetchall()]
+        else:
+            raise Exception("Error looking up users for media")
+
+
     def lookup_is_user_banned(self, user_id) -> bool:
         """lookup banned user in database"""
         query = """
-                SELECT banned FROM users_requesting_entry
+                SELECT banned FROM user_profiles
                 WHERE user_id = ?
                 """
         params = (user_id,)
         success = self._execute(query, params)
         result = self.cur.fetchone()
         if success:
-            return result[0] if result else None
+            banned = result[0] if result else None
+            if not banned:
+                legacy = self._legacy_rows("SELECT MAX(banned) FROM users_requesting_entry WHERE user_id = ?", params)
+                banned = legacy[0][0] if legacy and legacy[0][0] else banned
+            return banned
         else:
             raise Exception("Error looking up banned user")
         
     
     def return_all_users(self) -> List[Tuple]:
-        """return all users in database"""
-        query = """
-                SELECT * FROM users_requesting_entry
-                """
-        success = self._execute(query)
+        """return every user's row per destination chat, in the original users_requesting_entry layout"""
+        success = self._execute(USER_ROW_SQL)
         if success:
-            return self.cur.fetchall()
+            return self.cur.fetchall() + self._legacy_rows("SELECT * FROM users_requesting_entry")
         else:
             raise Exception("Error returning all users")
         
 
     def return_users_for_chat(self, chat_id) -> List[Tuple]:
-        """return all users in database"""
-        query = """
-                SELECT * FROM users_requesting_entry
-                WHERE chat_id = ?
-                """
+        """return the rows of every user of a destination chat, in the original users_requesting_entry layout"""
+        query = USER_ROW_SQL + " WHERE p.chat_id = ?"
         params = (chat_id,)
         success = self._execute(query, params)
         if success:
-            return self.cur.fetchall()
+            return self.cur.fetchall() + self._legacy_rows("SELECT * FROM users_requesting_entry WHERE chat_id = ?", params)
         else:
             raise Exception("Error returning all users")
 
@@ -457,14 +1111,87 @@ class Database(object):
         return success
     
 
-    def delete_users_for_chat(self, chat_id) -> bool:
-        """delete user from database"""
+    def record_destination_chat(self, chat_id, uploads_needed=None, minutes_to_link_expiration=None) -> bool:
+        """add or update a destination chat; NULL settings fall back to the config defaults"""
         query = """
-                DELETE FROM users_requesting_entry
+                INSERT INTO destination_chats (chat_id, uploads_needed, minutes_to_link_expiration)
+                VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE
+                SET uploads_needed = EXCLUDED.uploads_needed,
+                    minutes_to_link_expiration = EXCLUDED.minutes_to_link_expiration
+                """
+        params = (chat_id, uploads_needed, minutes_to_link_expiration)
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error recording destination chat")
+        return success
+
+
+    def lookup_destination_chat(self, chat_id) -> Tuple:
+        """return (uploads_needed, minutes_to_link_expiration) for a destination chat, or None"""
+        query = """
+                SELECT uploads_needed, minutes_to_link_expiration FROM destination_chats
+                WHERE chat_id = ?
+                """
+        params = (chat_id,)
+        success = self._execute(query, params)
+        if success:
+            return self.cur.fetchone()
+        else:
+            raise Exception("Error looking up destination chat")
+
+
+    def return_all_destination_chats(self) -> dict:
+        """return {chat_id: (uploads_needed, minutes_to_link_expiration)} for all destination chats"""
+        query = """
+                SELECT chat_id, uploads_needed, minutes_to_link_expiration FROM destination_chats
+                """
+        success = self._execute(query)
+        if success:
+            return {row[0]: (row[1], row[2]) for row in self.cur.fetchall()}
+        else:
+            raise Exception("Error returning destination chats")
+
+
+    def delete_destination_chat(self, chat_id) -> bool:
+        """remove a destination chat"""
+        query = """
+                DELETE FROM destination_chats
                 WHERE chat_id = ?
                 """
         params = (chat_id,)
         success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error deleting destination chat")
+        return success
+
+
+    def lookup_user_destination(self, user_id) -> int:
+        """return the destination chat the user is currently working toward, or None"""
+        query = """
+                SELECT chat_id FROM user_destinations
+                WHERE user_id = ?
+                """
+        params = (user_id,)
+        success = self._execute(query, params)
+        if success:
+            result = self.cur.fetchone()
+            return result[0] if result else None
+        else:
+            raise Exception("Error looking up user destination")
+
+
+    def delete_users_for_chat(self, chat_id) -> bool:
+        """delete the progress and invite links of every user of a destination chat"""
+        params = (chat_id,)
+        success = self._execute("DELETE FROM user_progress WHERE chat_id = ?", params)
+        success = success and self._execute("DELETE FROM invite_grants WHERE chat_id = ?", params)
+        if success and self.legacy_users:
+            success = self._execute("DELETE FROM users_requesting_entry WHERE chat_id = ?", params)
         if success:
             self._commit()
         else:
@@ -472,50 +1199,487 @@ class Database(object):
         return success
         
 
-    def drop_table(self):
-        """drop table from database"""
+    def start_chat_cleanup(self, chat_id, chat_title, file_path) -> Tuple:
+        """record the start of a chat cleanup, or return the one already in progress, as (chat_title, file_path, rows_archived)"""
         query = """
-                DROP TABLE IF EXISTS users_requesting_entry
+                INSERT INTO chat_cleanups (chat_id, chat_title, file_path, rows_archived, started_at)
+                VALUES (?, ?, ?, 0, ?)
+                ON CONFLICT(chat_id) DO NOTHING
                 """
-        success = self._execute(query)
+        params = (chat_id, chat_title, file_path, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
+        success = self._execute(query, params)
         if success:
             self._commit()
+            self.cur.execute("SELECT chat_title, file_path, rows_archived FROM chat_cleanups WHERE chat_id = ?", (chat_id,))
+            return self.cur.fetchone()
         else:
-            raise Exception("Error dropping table")
+            raise Exception("Error starting chat cleanup")
 
 
-    def store_uploaded_video(self, user_id: int, file_id: str, unique_file_id: str, chat_id: int) -> None:
+    def return_pending_chat_cleanups(self) -> List[int]:
+        """return the chat_ids of cleanups that did not finish"""
+        success = self._execute("SELECT chat_id FROM chat_cleanups")
+        if success:
+            return [row[0] for row in self.cur.fetchall()]
+        else:
+            raise Exception("Error returning pending chat cleanups")
+
+
+    def return_users_for_chat_batch(self, chat_id, limit) -> List[Tuple]:
+        """return up to limit users of a chat, in the original users_requesting_entry layout"""
+        query = USER_ROW_SQL + """
+                WHERE p.chat_id = ?
+                ORDER BY p.rowid
+                LIMIT ?
+                """
+        params = (chat_id, limit)
+        success = self._execute(query, params)
+        if success:
+            user_rows = self.cur.fetchall()
+        else:
+            raise Exception("Error returning users for chat")
+        if len(user_rows) < limit:
+            user_rows += self._legacy_rows("""
+                SELECT * FROM users_requesting_entry
+                WHERE chat_id = ?
+                ORDER BY rowid
+                LIMIT ?
+                """, (chat_id, limit - len(user_rows)))
+        return user_rows
+
+
+    def delete_users_batch_for_chat(self, chat_id, user_rows: List[Tuple]) -> bool:
+        """delete one batch from return_users_for_chat_batch together with those users' uploaded_videos
+        for the chat, and advance the cleanup checkpoint, in one transaction"""
+        pairs = [(row[0], chat_id) for row in user_rows]
         try:
-            query = """
-                INSERT INTO uploaded_videos (user_id, file_id, unique_file_id, chat_id, upload_time)
-                VALUES (?, ?, ?, ?, datetime('now'))
-            """
-            params = (user_id, file_id, unique_file_id, chat_id)
-            self._execute(query, params)
+            with self.lock:
+                self.cur.executemany("DELETE FROM uploaded_videos WHERE user_id = ? AND chat_id = ?", pairs)
+                self.cur.executemany("DELETE FROM video_fingerprints WHERE user_id = ? AND chat_id = ?", pairs)
+                self.cur.executemany("DELETE FROM invite_grants WHERE user_id = ? AND chat_id = ?", pairs)
+                self.cur.executemany("DELETE FROM user_progress WHERE user_id = ? AND chat_id = ?", pairs)
+                if self.legacy_users:
+                    try:
+                        self.cur.executemany("DELETE FROM users_requesting_entry WHERE user_id = ? AND chat_id = ?", pairs)
+                    except sqlite3.OperationalError as e:
+                        if "no such table" not in str(e):
+                            raise
+                        self.legacy_users = False  # Already migrated and dropped
+                # Profiles go with the user's last chat, unless the ban has to stick
+                self.cur.executemany("""
+                    DELETE FROM user_profiles
+                    WHERE user_id = ? AND NOT COALESCE(banned, FALSE)
+                        AND NOT EXISTS (SELECT 1 FROM user_progress WHERE user_id = ?)
+                """, [(row[0], row[0]) for row in user_rows])
+                self.cur.execute("UPDATE chat_cleanups SET rows_archived = rows_archived + ? WHERE chat_id = ?",
+                                 (len(user_rows), chat_id))
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error deleting users for chat: {e}")
+        return True
+
+
+    def finish_chat_cleanup(self, chat_id) -> bool:
+        """drop what is left of a chat once its users are gone"""
+        try:
+            with self.lock:
+                self.cur.execute("DELETE FROM user_destinations WHERE chat_id = ?", (chat_id,))
+                self.cur.execute("DELETE FROM active_chats WHERE chat_id = ?", (chat_id,))
+                self.cur.execute("DELETE FROM destination_chats WHERE chat_id = ?", (chat_id,))
+                self.cur.execute("DELETE FROM chat_cleanups WHERE chat_id = ?", (chat_id,))
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error finishing chat cleanup: {e}")
+        return True
+
+
+    def drop_table(self):
+        """drop the user tables from database"""
+        success = True
+        for table in ("user_progress", "invite_grants", "user_profiles", "users_requesting_entry"):
+            success = success and self._execute(f"DROP TABLE IF EXISTS {table}")
+        if success:
             self._commit()
-            return True
-        except Exception as e:
-            logging.error(f"Error storing uploaded video: {e}")
-            return False
+            self.legacy_users = False
+        else:
+            raise Exception("Error dropping table")
 
 
-    def get_recent_videos(self, user_id: int, uploads_needed: int) -> List[str]:
+    def get_recent_videos(self, user_id: int, chat_id: int, uploads_needed: int) -> List[str]:
         query = """
             SELECT file_id FROM uploaded_videos
-            WHERE user_id = ?
+            WHERE user_id = ? AND chat_id = ?
             ORDER BY upload_time DESC
             LIMIT ?
         """
-        params = (user_id, uploads_needed)
+        params = (user_id, chat_id, uploads_needed)
         self._execute(query, params)
         return [row[0] for row in self.cur.fetchall()]
     
 
-    def file_id_already_uploaded(self, user_id: int, unique_file_id: str) -> bool:
+    def lookup_media_reuse_count(self, unique_file_id: str) -> int:
+        """return how many distinct users have submitted a file (0 if never seen)"""
         query = """
-            SELECT * FROM uploaded_videos
-            WHERE user_id = ? AND unique_file_id = ?
-        """
-        params = (user_id, unique_file_id)
-        self._execute(query, params)
-        return self.cur.fetchone() is not None
+                SELECT reuse_count FROM media_index
+                WHERE unique_file_id = ?
+                """
+        params = (unique_file_id,)
+        success = self._execute(query, params)
+        if success:
+            result = self.cur.fetchone()
+            return result[0] if result else 0
+        else:
+            raise Exception("Error looking up media reuse count")
+
+
+    def iterate_media_index_ids(self, batch_size: int = 10000):
+        """yield every unique_file_id in the media index, fetched in batches"""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT unique_file_id FROM media_index")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+        cursor.close()
+
+
+    def iterate_video_fingerprints(self, batch_size: int = 10000):
+        """yield every (fingerprint, user_id, chat_id), fetched in batches"""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT fingerprint, user_id, chat_id FROM video_fingerprints")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+
+
+    def record_events(self, events: List[Tuple]) -> bool:
+        """append many (created_at, kind, user_id, chat_id, detail) rows in one transaction"""
+        if not events:
+            return True
+        try:
+            with self.lock:
+                self.cur.executemany("""
+                    INSERT INTO events (created_at, kind, user_id, chat_id, detail)
+                    VALUES (?, ?, ?, ?, ?)
+                """, events)
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording events: {e}")
+        return True
+
+
+    def count_events(self, since: str, until: str) -> List[Tuple]:
+        """(kind, count) for events in [since, until), most frequent first"""
+        query = """
+                SELECT kind, COUNT(*) FROM events
+                WHERE created_at >= ? AND created_at < ?
+                GROUP BY kind ORDER BY COUNT(*) DESC
+                """
+        success = self._execute(query, (since, until))
+        if success:
+            return self.cur.fetchall()
+        else:
+            raise Exception("Error counting events")
+
+
+    def iterate_events(self, since: str, until: str, kinds: List[str] = None, batch_size: int = 10000):
+        """yield (created_at, kind, user_id, chat_id, detail) for events in [since, until), oldest first"""
+        query = "SELECT created_at, kind, user_id, chat_id, detail FROM events WHERE created_at >= ? AND created_at < ?"
+        params = [since, until]
+        if kinds:
+            query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            params += list(kinds)
+        cursor = self.connection.cursor()
+        cursor.execute(query + " ORDER BY created_at", params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+
+
+    def schedule_job(self, kind: str, run_at: datetime, payload, job_key: str = None) -> bool:
+        """schedule a job to run at run_at. A pending job with the same job_key is replaced"""
+        query = """
+                INSERT INTO scheduled_jobs (job_key, kind, run_at, payload)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(job_key) DO UPDATE
+                SET kind = EXCLUDED.kind,
+                    run_at = EXCLUDED.run_at,
+                    payload = EXCLUDED.payload,
+                    attempts = 0
+                """
+        params = (job_key, kind, run_at.strftime(JOB_TIME_FORMAT), json.dumps(payload))
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error scheduling job")
+        return success
+
+
+    def append_to_job(self, kind: str, run_at: datetime, job_key: str, item) -> bool:
+        """append item to the list payload of the pending job job_key, creating the job if needed"""
+        query = """
+                INSERT INTO scheduled_jobs (job_key, kind, run_at, payload)
+                VALUES (?, ?, ?, json_array(json(?)))
+                ON CONFLICT(job_key) DO UPDATE
+                SET payload = json_insert(scheduled_jobs.payload, '$[#]', json(?))
+                """
+        item = json.dumps(item)
+        params = (job_key, kind, run_at.strftime(JOB_TIME_FORMAT), item, item)
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error appending to job")
+        return success
+
+
+    def claim_due_jobs(self, limit: int, lease_seconds: float) -> List[Tuple]:
+        """lease up to limit due jobs and return them as (job_id, kind, payload, attempts).
+        Claimed jobs give up their job_key, so new work for the same key starts a fresh job"""
+        now = datetime.now(timezone.utc)
+        query = """
+                UPDATE scheduled_jobs
+                SET locked_until = ?, job_key = NULL
+                WHERE job_id IN (
+                    SELECT job_id FROM scheduled_jobs
+                    WHERE run_at <= ? AND (locked_until IS NULL OR locked_until <= ?)
+                    ORDER BY run_at
+                    LIMIT ?
+                )
+                RETURNING job_id, kind, payload, attempts
+                """
+        params = ((now + timedelta(seconds=lease_seconds)).strftime(JOB_TIME_FORMAT),
+                  now.strftime(JOB_TIME_FORMAT), now.strftime(JOB_TIME_FORMAT), limit)
+        success = self._execute(query, params)
+        if success:
+            jobs = [(job_id, kind, json.loads(payload), attempts) for job_id, kind, payload, attempts in self.cur.fetchall()]
+            self._commit()
+        else:
+            raise Exception("Error claiming due jobs")
+        return jobs
+
+
+    def complete_jobs(self, job_ids: List[int]) -> bool:
+        """delete finished jobs"""
+        if not job_ids:
+            return True
+        try:
+            with self.lock:
+                self.cur.executemany("DELETE FROM scheduled_jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+                self._commit()
+        except sqlite3.Error as e:
+            raise Exception(f"Error completing jobs: {e}")
+        return True
+
+
+    def retry_job(self, job_id: int, run_at: datetime) -> bool:
+        """release a failed job and run it again at run_at"""
+        query = """
+                UPDATE scheduled_jobs
+                SET run_at = ?, attempts = attempts + 1, locked_until = NULL
+                WHERE job_id = ?
+                """
+        params = (run_at.strftime(JOB_TIME_FORMAT), job_id)
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error rescheduling job")
+        return success
+
+
+    def release_job_leases(self) -> int:
+        """clear every job lease, for recovery after a crash. Returns the number of pending jobs"""
+        success = self._execute("UPDATE scheduled_jobs SET locked_until = NULL WHERE locked_until IS NOT NULL")
+        if success:
+            self._commit()
+            self.cur.execute("SELECT COUNT(*) FROM scheduled_jobs")
+            return self.cur.fetchone()[0]
+        else:
+            raise Exception("Error releasing job leases")
+
+
+    def count_scheduled_jobs(self, due_before: datetime = None) -> int:
+        """return the number of jobs waiting to run or running, optionally only those due before due_before"""
+        if due_before is None:
+            success = self._execute("SELECT COUNT(*) FROM scheduled_jobs")
+        else:
+            success = self._execute("SELECT COUNT(*) FROM scheduled_jobs WHERE run_at < ?", (due_before.strftime(JOB_TIME_FORMAT),))
+        if success:
+            return self.cur.fetchone()[0]
+        else:
+            raise Exception("Error counting scheduled jobs")
+
+
+    def expire_invite_link(self, user_id: int, chat_id: int, invite_link: str) -> bool:
+        """forget an invite link that expired without being used"""
+        self._adopt_legacy_users([user_id])
+        query = """
+                UPDATE invite_grants
+                SET expired = TRUE
+                WHERE invite_link = ? AND user_id = ? AND chat_id = ? AND link_used IS NULL
+                """
+        params = (invite_link, user_id, chat_id)
+        success = self._execute(query, params)
+        if success:
+            self._commit()
+        else:
+            raise Exception("Error expiring invite link")
+        return success
+
+
+    def return_links_to_revoke(self, limit: int) -> List[Tuple]:
+        """return up to limit unused links, oldest first, that expired, were replaced by a newer link or belong
+        to a banned user, and have not been revoked in Telegram yet, as (invite_link, chat_id)"""
+        query = """
+                SELECT invite_link, chat_id FROM invite_grants
+                WHERE expired AND link_used IS NULL AND revoked_at IS NULL
+                ORDER BY access_granted
+                LIMIT ?
+                """
+        params = (limit,)
+        success = self._execute(query, params)
+        if success:
+            return self.cur.fetchall()
+        else:
+            raise Exception("Error returning links to revoke")
+
+
+    def record_links_revoked(self, invite_links: List[str]) -> int:
+        """mark invite links as revoked in Telegram, so they are not revoked again"""
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        try:
+            with self.lock:
+                self.cur.executemany("""
+                    UPDATE invite_grants
+                    SET revoked_at = ?
+                    WHERE invite_link = ?
+                """, [(now, invite_link) for invite_link in invite_links])
+                self._commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error recording revoked links: {e}")
+        return len(invite_links)
+
+
+    def count_links_to_revoke(self) -> int:
+        """return how many links return_links_to_revoke still has to hand out"""
+        query = """
+                SELECT COUNT(*) FROM invite_grants
+                WHERE expired AND link_used IS NULL AND revoked_at IS NULL
+                """
+        success = self._execute(query)
+        if success:
+            return self.cur.fetchone()[0]
+        else:
+            raise Exception("Error counting links to revoke")
+
+
+    def maintain_users_slice(self, after_rowid: int, limit: int, abandoned_before: datetime,
+                             default_minutes_to_link_expiration: int, archive: bool = True) -> Tuple:
+        """clean up the next `limit` rows of user_progress after after_rowid in one transaction:
+        expire their unused invite links that are past due, and archive (or delete) users who never uploaded
+        and have not been seen since abandoned_before. uploaded_videos is left alone, since duplicate checks,
+        media reuse and /bulkban by file all read it.
+        Returns (last rowid of the slice or None when the table is exhausted, stats dict)"""
+        stats = {"links_expired": 0, "users_archived": 0}
+        try:
+            with self.lock:
+                self.cur.execute("""
+                    SELECT MAX(rowid) FROM (
+                        SELECT rowid FROM user_progress
+                        WHERE rowid > ?
+                        ORDER BY rowid
+                        LIMIT ?
+                    )
+                """, (after_rowid, limit))
+                last_rowid = self.cur.fetchone()[0]
+                if last_rowid is None:
+                    return None, stats
+                window = (after_rowid, last_rowid)
+
+                # A chat's own expiry overrides the default. 0 or NULL means links never expire.
+                self.cur.execute("""
+                    UPDATE invite_grants
+                    SET expired = TRUE
+                    WHERE rowid IN (
+                        SELECT g.rowid FROM user_progress p
+                        JOIN invite_grants g ON g.user_id = p.user_id AND g.chat_id = p.chat_id
+                        WHERE p.rowid > ? AND p.rowid <= ?
+                            AND g.link_used IS NULL AND NOT g.expired
+                            AND COALESCE((SELECT d.minutes_to_link_expiration FROM destination_chats d
+                                          WHERE d.chat_id = g.chat_id), ?) > 0
+                            AND g.access_granted < strftime('%Y-%m-%d %H:%M:%f', 'now', '-' ||
+                                COALESCE((SELECT d.minutes_to_link_expiration FROM destination_chats d
+                                          WHERE d.chat_id = g.chat_id), ?) || ' minutes')
+                    )
+                """, (*window, default_minutes_to_link_expiration or 0, default_minutes_to_link_expiration or 0))
+                stats["links_expired"] = self.cur.rowcount
+
+                abandoned = """
+                    user_progress.rowid > ? AND user_progress.rowid <= ?
+                    AND COALESCE(user_progress.number_videos_uploaded, 0) = 0
+                    AND user_progress.access_granted IS NULL
+                    AND COALESCE(user_progress.last_accessed_bot, '') < ?
+                    AND NOT EXISTS (SELECT 1 FROM user_profiles f WHERE f.user_id = user_progress.user_id AND f.banned)
+                """
+                params = (*window, abandoned_before.strftime("%Y-%m-%d %H:%M:%S.%f"))
+                if archive:
+                    self.cur.execute(f"""
+                        INSERT OR REPLACE INTO archived_users (user_id, full_name, username, last_accessed_bot,
+                            last_uploaded_video, number_videos_uploaded, access_granted, invite_link, link_used, chat_id, banned)
+                        SELECT user_progress.user_id, f.full_name, f.username, user_progress.last_accessed_bot,
+                            user_progress.last_uploaded_video, user_progress.number_videos_uploaded, NULL, NULL, NULL,
+                            user_progress.chat_id, FALSE
+                        FROM user_progress
+                        LEFT JOIN user_profiles f ON f.user_id = user_progress.user_id
+                        WHERE {abandoned}
+                    """, params)
+                self.cur.execute(f"DELETE FROM user_progress WHERE {abandoned} RETURNING user_id", params)
+                archived_user_ids = [(row[0],) for row in self.cur.fetchall()]
+                stats["users_archived"] = len(archived_user_ids)
+                self.cur.executemany("""
+                    DELETE FROM user_destinations
+                    WHERE user_id = ? AND user_id NOT IN (SELECT user_id FROM user_progress)
+                """, archived_user_ids)
+                self.cur.executemany("""
+                    DELETE FROM user_profiles
+                    WHERE user_id = ? AND user_id NOT IN (SELECT user_id FROM user_progress)
+                """, archived_user_ids)
+
+                self._commit()
+                return last_rowid, stats
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise Exception(f"Error maintaining users: {e}")
+
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """free up to `pages` unused pages and return how many free pages remain (0 if auto_vacuum is not incremental)"""
+        with self.lock:
+            self.cur.execute("PRAGMA auto_vacuum")
+            if self.cur.fetchone()[0] != 2:
+                return 0
+            self.cur.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            self.cur.fetchall()
+            self.cur.execute("PRAGMA freelist_count")
+            return self.cur.fetchone()[0]
+
+
+    def optimize(self) -> None:
+        """let sqlite refresh the statistics its query planner uses"""
+        with self.lock:
+            self.cur.execute("PRAGMA optimize")
+            self.cur.fetchall()
@@ -0,0 +1,155 @@
+"""
+DISPATCH_QUEUE.PY
+
+Paced, per-chat delivery of Bot API sends. Work for a chat is queued and run in order by
+one worker task per chat, so a burst of work (e.g. many users qualifying at once and
+being forwarded to the review group) is spread out instead of tripping flood limits.
+
+Each queued job is an async callable that receives a `send` function:
+
+    async def job(send):
+        messages = await send(bot.send_media_group, chat_id=chat_id, media=media)
+        await send(bot.send_message, chat_id=chat_id, text="...")
+
+`send` waits for the chat's next free slot (messages_per_minute) and retries the call
+when Telegram answers with RetryAfter.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # retry_after is an int in older python-telegram-bot releases and a timedelta in newer ones
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+async def call_with_retry(method, /, max_retries: int = 3, **kwargs):
+    """Call a Bot method, sleeping and retrying when Telegram answers with RetryAfter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(retry_after_seconds(e))
+
+
+class RateLimiter(object):
+    """Spaces calls for each key at least 60 / per_minute seconds apart."""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next_slot = {}
+
+    async def wait(self, key) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(key, now))
+        self._next_slot[key] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def hold(self, key, seconds: float) -> None:
+        """Push the key's next slot back, e.g. after RetryAfter."""
+        self._next_slot[key] = max(self._next_slot.get(key, 0.0), time.monotonic() + seconds)
+
+    def forget_idle(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, slot in self._next_slot.items() if slot < now]:
+            del self._next_slot[key]
+
+
+class DispatchQueue(object):
+
+    def __init__(self, messages_per_minute: float, max_retries: int = 5,
+                 backlog_warning: int = 50, on_error=None, name: str = "dispatch"):
+        self.limiter = RateLimiter(messages_per_minute)
+        self.max_retries = max_retries
+        self.backlog_warning = backlog_warning
+        self.on_error = on_error
+        self.name = name
+        self._queues = {}
+        self._workers = {}
+        self._enqueued_at = {}
+        self._last_warning = 0.0
+
+    ########## GAUGES ##########
+
+    @property
+    def backlog(self) -> int:
+        """Jobs queued or running, across all chats."""
+        return sum(len(times) for times in self._enqueued_at.values())
+
+    def oldest_age(self) -> float:
+        """Seconds the oldest unfinished job has been waiting."""
+        oldest = min((times[0] for times in self._enqueued_at.values() if times), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "backlog": self.backlog,
+            "oldest_age_seconds": round(self.oldest_age(), 1),
+            "chats": {chat_id: len(times) for chat_id, times in self._enqueued_at.items() if times},
+        }
+
+    ########## QUEUEING ##########
+
+    def put(self, chat_id, job) -> None:
+        """Queue `job` for chat_id. Must be called from the event loop."""
+        queue = self._queues.setdefault(chat_id, asyncio.Queue())
+        queue.put_nowait(job)
+        self._enqueued_at.setdefault(chat_id, deque()).append(time.monotonic())
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._work(chat_id))
+
+        backlog = self.backlog
+        if backlog >= self.backlog_warning and time.monotonic() - self._last_warning > 60:
+            self._last_warning = time.monotonic()
+            logging.warning("%s backlog is %s jobs (oldest waiting %.0fs)", self.name, backlog, self.oldest_age())
+        else:
+            logging.debug("%s backlog is %s jobs", self.name, backlog)
+
+    async def _work(self, chat_id) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    await job(lambda method, /, **kwargs: self.send(chat_id, method, **kwargs))
+                except Exception as e:
+                    if self.on_error:
+                        self.on_error(e)
+                    else:
+                        logging.exception("%s job for chat %s failed", self.name, chat_id)
+                finally:
+                    self._enqueued_at[chat_id].popleft()
+        finally:
+            del self._workers[chat_id]
+            if queue.empty():
+                self._queues.pop(chat_id, None)
+                self._enqueued_at.pop(chat_id, None)
+            self.limiter.forget_idle()
+
+    async def send(self, key, method, /, **kwargs):
+        """Call a Bot method in the next free slot for key (the chat), retrying on RetryAfter."""
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.wait(key)
+            try:
+                return await method(**kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                logging.info("%s: flood limit in chat %s, retrying in %ss", self.name, key, delay)
+                self.limiter.hold(key, delay)
+
+    async def join(self) -> None:
+        """Wait until every queued job has run."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
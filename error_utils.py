@@ -0,0 +1,83 @@
+"""
+ERROR_UTILS.PY
+
+Error reporting for BouncerBot. Exceptions are classified by kind, counted per
+(kind, function), and logged at most once per window for each call site. Tracebacks
+are only formatted for a sampled fraction of reports.
+"""
+
+import logging
+import random
+import time
+from collections import Counter
+from telegram.error import RetryAfter, Forbidden, TimedOut, BadRequest, NetworkError
+
+
+# Order matters: TimedOut and BadRequest are both subclasses of NetworkError.
+ERROR_CLASSES = (
+    (RetryAfter, "retry_after", logging.WARNING),
+    (Forbidden, "forbidden", logging.INFO),
+    (TimedOut, "timed_out", logging.INFO),
+    (BadRequest, "bad_request", logging.WARNING),
+    (NetworkError, "network_error", logging.WARNING),
+)
+
+
+def classify(exception: Exception) -> tuple:
+    """Return (error_class, log_level) for an exception."""
+    for exc_type, error_class, level in ERROR_CLASSES:
+        if isinstance(exception, exc_type):
+            return error_class, level
+    return "internal", logging.WARNING
+
+
+class ErrorReporter(object):
+
+    def __init__(self, window_seconds: float = 60, traceback_sample_rate: float = 0.01):
+        self.window_seconds = window_seconds
+        self.traceback_sample_rate = traceback_sample_rate
+        self.counts = Counter()
+        self._last_logged = {}
+
+    def report(self, exception: Exception, function_name: str = None) -> str:
+        """Count an exception and log it unless the same call site logged recently.
+
+        The reporting function is read from the exception's own traceback, whose first
+        frame is the function that caught it, so no frame introspection is needed.
+        Returns the error class.
+        """
+        error_class, level = classify(exception)
+        tb = exception.__traceback__
+        if function_name is None:
+            function_name = tb.tb_frame.f_code.co_name if tb else "Unknown"
+        line = tb.tb_lineno if tb else None
+        self.counts[(error_class, function_name)] += 1
+
+        key = (error_class, function_name, line)
+        now = time.monotonic()
+        last = self._last_logged.get(key)
+        if last is not None and now - last[0] < self.window_seconds:
+            last[1] += 1
+            return error_class
+        suppressed = last[1] if last is not None else 0
+        self._last_logged[key] = [now, 0]
+
+        if not logging.getLogger().isEnabledFor(level):
+            return error_class
+        exc_info = exception if random.random() < self.traceback_sample_rate else None
+        logging.log(
+            level,
+            "Error in function '%s' (line %s) - %s: %s%s",
+            function_name, line, error_class, exception,
+            f" [{suppressed} similar suppressed]" if suppressed else "",
+            exc_info=exc_info,
+            extra={
+                "error_class": error_class,
+                "retry_after": getattr(exception, "retry_after", None),
+            },
+        )
+        return error_class
+
+    def snapshot(self, limit: int = None) -> dict:
+        """Return error counts keyed by 'error_class:function', most frequent first."""
+        return {f"{error_class}:{function_name}": count for (error_class, function_name), count in self.counts.most_common(limit)}
@@ -0,0 +1,71 @@
+"""
+EVENT_JOURNAL.PY
+
+An append-only record of what happened to whom and when, kept in the events table. The
+users table only holds each user's latest state (a new link replaces the old one), so
+questions like "how long did people take to qualify" or "how often are links passed on"
+are answered from the journal instead.
+
+Handlers call `record`, which only appends a tuple to a bounded in-memory buffer. A job
+writes the buffer to the database in one transaction every few seconds, and once more at
+shutdown. If the database falls so far behind that the buffer fills up, the oldest events
+are dropped and counted in `dropped` rather than slowing the handlers down.
+"""
+
+import json
+import logging
+from collections import deque
+from datetime import datetime, timezone
+
+
+EVENT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# What `detail` holds for each kind
+EVENT_KINDS = (
+    "started",       # None
+    "uploaded",      # {"file": unique_file_id, "counted": bool}
+    "duplicate",     # {"file": unique_file_id, "reason": "repeat" | "near_copy" | "recycled"}
+    "granted",       # {"link": invite_link}
+    "link_used",     # {"link": invite_link}
+    "banned",        # {"by": admin_id}
+    "chat_removed",  # {"title": chat_title, "users_archived": n} or {"by": admin_id}
+)
+
+
+class EventJournal(object):
+
+    def __init__(self, capacity: int):
+        self._buffer = deque(maxlen=capacity)
+        self.written = 0
+        self.dropped = 0
+        self._dropped_reported = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def record(self, kind: str, user_id: int = None, chat_id: int = None, **detail) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((datetime.now(timezone.utc), kind, user_id, chat_id, detail or None))
+
+    def flush(self, database) -> int:
+        """write everything buffered so far in one transaction. returns the number of events written"""
+        if not self._buffer:
+            return 0
+        batch = [self._buffer.popleft() for _ in range(len(self._buffer))]
+        rows = [(created_at.strftime(EVENT_TIME_FORMAT), kind, user_id, chat_id,
+                 json.dumps(detail) if detail is not None else None)
+                for created_at, kind, user_id, chat_id, detail in batch]
+        try:
+            database.record_events(rows)
+        except Exception:
+            # Put the batch back in front of anything recorded meanwhile; the next flush retries it
+            room = self._buffer.maxlen - len(self._buffer)
+            self.dropped += max(len(batch) - room, 0)
+            self._buffer.extendleft(reversed(batch[-room:] if room else []))
+            raise
+        self.written += len(rows)
+        if self.dropped > self._dropped_reported:
+            logging.warning("Event journal buffer overflowed: %s events dropped so far.", self.dropped)
+            self._dropped_reported = self.dropped
+        return len(rows)
@@ -0,0 +1,185 @@
+"""
+FINGERPRINTS.PY
+
+Near-duplicate detection for uploaded videos. Telegram gives every video a new
+file_unique_id when it is re-encoded or trimmed, but its thumbnail barely changes, so
+the thumbnail's difference hash (dHash) is used as a fingerprint. Two fingerprints that
+differ in at most a few of their 64 bits are the same clip.
+
+Hashing decodes an image, so it runs in a process pool and never on the event loop.
+Lookups go through a multi-index hash: each fingerprint is split into BANDS chunks and
+filed under each chunk's value. A fingerprint within distance d of the query must match
+one of its chunks within d // BANDS bits (pigeonhole), so only those buckets are checked.
+
+Needs Pillow (pip install Pillow). Without it `available` is False and nothing is hashed.
+
+Images on disk can be compared without the bot, e.g. to pick NEAR_DUPLICATE_MAX_DISTANCE:
+
+    python fingerprints.py original.jpg reencoded.jpg other.jpg
+
+`python fingerprints.py --check [max_distance]` runs the same comparison on generated
+images (a re-encoded, a trimmed and an unrelated copy of a test frame) and through a
+FingerprintIndex, so a threshold can be checked without Telegram.
+"""
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+available = Image is not None
+
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """64-bit difference hash: one bit per pair of horizontally adjacent pixels of a small grayscale copy"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    fingerprint = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            fingerprint = (fingerprint << 1) | (left > right)
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def to_signed(fingerprint: int) -> int:
+    # SQLite integers are signed 64-bit
+    return fingerprint - (1 << HASH_BITS) if fingerprint >= 1 << (HASH_BITS - 1) else fingerprint
+
+
+def to_unsigned(fingerprint: int) -> int:
+    return fingerprint & ((1 << HASH_BITS) - 1)
+
+
+class FingerprintIndex(object):
+    """Multi-index hash of fingerprints, each stored with a value such as (user_id, chat_id)."""
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self.band_radius = max_distance // BANDS
+        self._entries = []
+        self._bands = [dict() for _ in range(BANDS)]
+        # Every way to flip up to band_radius bits of one band
+        self._flips = [sum(1 << bit for bit in bits)
+                       for radius in range(self.band_radius + 1)
+                       for bits in combinations(range(BAND_BITS), radius)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _band(fingerprint: int, band: int) -> int:
+        return (fingerprint >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1)
+
+    def add(self, fingerprint: int, value) -> None:
+        position = len(self._entries)
+        self._entries.append((fingerprint, value))
+        for band, buckets in enumerate(self._bands):
+            buckets.setdefault(self._band(fingerprint, band), []).append(position)
+
+    def search(self, fingerprint: int) -> list:
+        """return (distance, value) for every stored fingerprint within max_distance, closest first"""
+        candidates = set()
+        for band, buckets in enumerate(self._bands):
+            chunk = self._band(fingerprint, band)
+            for flip in self._flips:
+                candidates.update(buckets.get(chunk ^ flip, ()))
+        matches = []
+        for position in candidates:
+            stored, value = self._entries[position]
+            distance = hamming_distance(fingerprint, stored)
+            if distance <= self.max_distance:
+                matches.append((distance, value))
+        return sorted(matches, key=lambda match: match[0])
+
+    def clear(self) -> None:
+        self._entries.clear()
+        for buckets in self._bands:
+            buckets.clear()
+
+
+class Fingerprinter(object):
+    """Hashes images in a process pool, created on first use."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = None
+
+    async def fingerprint(self, image_bytes: bytes) -> int:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, dhash, bytes(image_bytes))
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _test_frames() -> dict:
+    """a deterministic test frame and copies of it as a re-encode or trim would change it, as JPEG bytes"""
+    def encode(image, quality):
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+
+    width, height = 320, 180
+    frame = Image.new("L", (width, height))
+    frame.putdata([(x * 255 // width + (y // 30) * 40) % 256 for y in range(height) for x in range(width)])
+    frame = frame.convert("RGB")
+    other = frame.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    return {
+        "original": encode(frame, 90),
+        "reencoded": encode(frame.resize((240, 135)), 40),
+        "trimmed": encode(frame.crop((4, 2, width - 4, height - 2)), 75),
+        "other": encode(other, 90),
+    }
+
+
+def check(max_distance: int) -> bool:
+    """fingerprint the generated frames and report whether max_distance tells the copies from the other frame"""
+    frames = {name: dhash(image) for name, image in _test_frames().items()}
+    index = FingerprintIndex(max_distance)
+    index.add(frames["original"], "original")
+    ok = True
+    for name, fingerprint in frames.items():
+        distance = hamming_distance(frames["original"], fingerprint)
+        found = any(value == "original" for _, value in index.search(fingerprint))
+        expected = name != "other"
+        ok = ok and found == expected
+        print(f"{distance:2d}  {name:10s} {'match' if found else 'no match'}{'' if found == expected else '  <- WRONG'}")
+    return ok
+
+
+def main(paths) -> None:
+    if not available:
+        sys.exit("Pillow is not installed (pip install Pillow).")
+    if paths and paths[0] == "--check":
+        max_distance = int(paths[1]) if len(paths) > 1 else 6
+        sys.exit(0 if check(max_distance) else f"NEAR_DUPLICATE_MAX_DISTANCE = {max_distance} gets these wrong.")
+    fingerprints = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            fingerprints[path] = dhash(f.read())
+        print(f"{fingerprints[path]:016x}  {path}")
+    for a, b in combinations(paths, 2):
+        print(f"{hamming_distance(fingerprints[a], fingerprints[b]):2d}  {a}  {b}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,48 @@
+"""
+INVITE_LINKS.PY
+
+In-memory map of the invite links the bot has handed out and that are still waiting to be
+used, so join events can be matched to a link without a database query. The map holds at
+most `capacity` links and drops the oldest when full. Once anything has been dropped (or
+other workers hand out links too) a miss is no longer proof that a link is unknown, and
+`complete` is False so callers fall back to the database.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class OutstandingLinks(object):
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self.complete = True
+        self._links = OrderedDict()
+
+    def __len__(self):
+        return len(self._links)
+
+    def add(self, invite_link: str, user_id: int, chat_id: int, expires_at: float = None) -> None:
+        """Remember a link. `expires_at` is a unix timestamp, or None for links that never expire."""
+        self._links.pop(invite_link, None)
+        self._links[invite_link] = (user_id, chat_id, expires_at)
+        while len(self._links) > self.capacity:
+            self._links.popitem(last=False)
+            self.complete = False
+
+    def pop(self, invite_link: str):
+        """Forget a link and return its (user_id, chat_id), or None if it is unknown or expired."""
+        entry = self._links.pop(invite_link, None)
+        if entry is None:
+            return None
+        user_id, chat_id, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return user_id, chat_id
+
+    def discard(self, invite_link: str) -> None:
+        self._links.pop(invite_link, None)
+
+    def clear(self) -> None:
+        self._links.clear()
+        self.complete = True
@@ -0,0 +1,478 @@
+#! /usr/bin/python
+"""
+LOADTEST.PY
+
+Replay/load harness for BouncerBot. Feeds synthetic Telegram updates through the real
+Application handlers against a throwaway database and a fake Bot that records every API
+call, injects latency, and occasionally answers with RetryAfter. Reports throughput,
+p50/p99 latency, and SQL statement counts per scenario.
+
+Usage:
+    python loadtest.py --users 200 --latency-ms 20 --retry-after-rate 0.01 [--json results.json]
+
+With --resp-state the bot's shared state goes through the Redis-protocol client in
+state_backend.py, talking to an in-process fake RESP server that drops the connection
+every few commands, so encoding, error replies and reconnects are exercised without Redis.
+
+Requires config.py like the bot itself. The database in config.py is never touched.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import socketserver
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+import db_utils
+from state_backend import LocalStateBackend, RedisStateBackend, StateBackendError
+
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "BouncerBot", "username": "bouncer_loadtest_bot"}
+DESTINATION_CHAT_ID = -1001000000001
+CHATTER_CHAT_ID = -1001000000002
+ADMIN_ID = 42  # Made the only authorized admin, so the ban callbacks take the real ban path
+DRAIN_JOB_HORIZON_SECONDS = 10
+
+
+class FakeBot(ExtBot):
+    """ExtBot whose Bot API transport is replaced by canned responses.
+
+    Every call is recorded in `calls`. `latency` seconds are awaited per call, and a
+    `retry_after_rate` fraction of calls raise RetryAfter instead of answering.
+    """
+
+    def __init__(self, latency: float = 0.0, retry_after_rate: float = 0.0, seed: int = 0):
+        super().__init__(FAKE_TOKEN)
+        with self._unfrozen():
+            self.latency = latency
+            self.retry_after_rate = retry_after_rate
+            self.calls = Counter()
+            self.retry_afters = 0
+            self.minted_links = {}
+            self._random = random.Random(seed)
+            self._ids = itertools.count(1)
+
+    async def _do_post(self, endpoint, data, **kwargs):
+        self.calls[endpoint] += 1
+        if endpoint == "getMe":
+            return BOT_USER
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_rate and self._random.random() < self.retry_after_rate:
+            with self._unfrozen():
+                self.retry_afters += 1
+            raise RetryAfter(1)
+        return self._fake_result(endpoint, data)
+
+    def _fake_message(self, chat_id):
+        return {"message_id": next(self._ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}}
+
+    def _fake_result(self, endpoint, data):
+        chat_id = data.get("chat_id", 0)
+        if endpoint in ("sendMessage", "sendVideo", "sendDocument", "editMessageText"):
+            return self._fake_message(chat_id)
+        if endpoint == "sendMediaGroup":
+            return [self._fake_message(chat_id) for _ in data.get("media", [])]
+        if endpoint == "createChatInviteLink":
+            link = f"https://t.me/+loadtest{next(self._ids)}"
+            self.minted_links[link] = int(chat_id)
+            return {"invite_link": link, "creator": BOT_USER, "creates_join_request": False,
+                    "is_primary": False, "is_revoked": False}
+        if endpoint == "revokeChatInviteLink":
+            return {"invite_link": data["invite_link"], "creator": BOT_USER, "creates_join_request": False,
+                    "is_primary": False, "is_revoked": True}
+        if endpoint == "getChat":
+            return {"id": int(chat_id), "type": "supergroup", "title": f"Chat {chat_id}",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+        return True
+
+
+########## FAKE RESP SERVER ##########
+
+class FakeRespServer(socketserver.ThreadingTCPServer):
+    """Loopback server for the subset of the Redis protocol RedisStateBackend uses, backed by a
+    LocalStateBackend. Closes each connection after `drop_every` replies to force reconnects, and
+    with `lose_next_reply` set runs the next command but closes the connection instead of answering."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password: str = None, drop_every: int = 0):
+        super().__init__(("127.0.0.1", 0), FakeRespHandler)
+        self.password = password
+        self.drop_every = drop_every
+        self.store = LocalStateBackend()
+        self.commands = Counter()
+        self.connections = 0
+        self.lose_next_reply = False
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f"redis://{':' + self.password + '@' if self.password else ''}{host}:{port}/1"
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeRespHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        authenticated = server.password is None
+        replies = 0
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            with server.lock:
+                server.commands[name] += 1
+            if name == "AUTH":
+                authenticated = args[1] == server.password
+                reply = b"+OK\r\n" if authenticated else b"-ERR invalid password\r\n"
+            elif not authenticated:
+                reply = b"-NOAUTH Authentication required.\r\n"
+            else:
+                reply = self._run(name, args[1:])
+            with server.lock:
+                lose_reply, server.lose_next_reply = server.lose_next_reply and name != "AUTH", False
+            if lose_reply:
+                return
+            self.wfile.write(reply)
+            replies += 1
+            if server.drop_every and replies % server.drop_every == 0:
+                return
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError(f"Expected a RESP array, got {line!r}")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+    @staticmethod
+    def _bulk(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        encoded = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(encoded), encoded)
+
+    def _run(self, name, args) -> bytes:
+        store = self.server.store
+        if name == "SELECT":
+            return b"+OK\r\n"
+        if name == "GET":
+            return self._bulk(store.get(args[0]))
+        if name == "SET":
+            key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+            ttl = int(options[options.index("PX") + 1]) / 1000 if "PX" in options else None
+            if "NX" in options:
+                return b"+OK\r\n" if store.set_if_absent(key, value, ttl) else b"$-1\r\n"
+            store.set(key, value, ttl)
+            return b"+OK\r\n"
+        if name == "DEL":
+            existed = store.get(args[0]) is not None
+            store.delete(args[0])
+            return b":%d\r\n" % existed
+        if name == "RPUSH":
+            store.push(args[0], args[1])
+            return b":1\r\n"
+        if name == "LPOP":
+            return self._bulk(store.pop(args[0]))
+        if name == "BLPOP":
+            value = store.pop(args[0], timeout=float(args[1]))
+            return b"*-1\r\n" if value is None else b"*2\r\n" + self._bulk(args[0]) + self._bulk(value)
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+
+def check_resp_backend(backend: RedisStateBackend, server: FakeRespServer) -> None:
+    """Round-trip every command the bot uses, an error reply and lost replies. Raises AssertionError on a mismatch."""
+    value = "line one\r\nline two \u2713"  # CRLF and non-ASCII must survive bulk string framing
+    backend.set("check:value", value)
+    assert backend.get("check:value") == value
+    assert backend.get("check:missing") is None
+    assert backend.set_if_absent("check:lock", "a", ttl=0.2)
+    assert not backend.set_if_absent("check:lock", "b", ttl=0.2)
+    time.sleep(0.25)
+    assert backend.set_if_absent("check:lock", "c")
+    backend.delete("check:lock")
+    assert backend.get("check:lock") is None
+    for item in ("1", "2"):
+        backend.push("check:queue", item)
+    assert backend.pop("check:queue") == "1"
+    assert backend.pop("check:queue", timeout=1) == "2"
+    assert backend.pop("check:queue", timeout=0.1) is None
+    # A SET NX that went through but whose reply was lost still takes the lock, and is not sent twice
+    server.lose_next_reply = True
+    assert backend.set_if_absent("check:lost", "mine", ttl=1)
+    assert not backend.set_if_absent("check:lost", "theirs", ttl=1)
+    try:
+        backend.command("FLUSHALL")
+    except StateBackendError as e:
+        assert "unknown command" in str(e)
+    else:
+        raise AssertionError("error reply was not raised")
+
+
+########## SYNTHETIC UPDATES ##########
+
+class UpdateFactory(object):
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, chat, **fields):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat,
+                   "from": self.user(user_id)}
+        message.update(fields)
+        return message
+
+    def _update(self, **fields):
+        return Update.de_json({"update_id": next(self._update_ids), **fields}, self.bot)
+
+    def private_chat(self, user_id):
+        return {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+
+    def start(self, user_id):
+        return self._update(message=self._message(
+            user_id, self.private_chat(user_id), text="/start",
+            entities=[{"type": "bot_command", "offset": 0, "length": 6}]))
+
+    def video(self, user_id, media_group_id=None, unique_id=None):
+        n = next(self._file_ids)
+        video = {"file_id": f"file{n}", "file_unique_id": unique_id or f"unique{n}",
+                 "width": 640, "height": 360, "duration": 10}
+        fields = {"video": video}
+        if media_group_id:
+            fields["media_group_id"] = media_group_id
+        return self._update(message=self._message(user_id, self.private_chat(user_id), **fields))
+
+    def album(self, user_id, size=10):
+        media_group_id = f"album{user_id}_{next(self._file_ids)}"
+        return [self.video(user_id, media_group_id) for _ in range(size)]
+
+    def group_chatter(self, user_id, chat_id=CHATTER_CHAT_ID):
+        chat = {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+        return self._update(message=self._message(user_id, chat, text="hello"))
+
+    def join(self, user_id, invite_link, chat_id=DESTINATION_CHAT_ID):
+        user = self.user(user_id)
+        return self._update(chat_member={
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": user,
+            "date": int(time.time()),
+            "old_chat_member": {"status": "left", "user": user},
+            "new_chat_member": {"status": "member", "user": user},
+            "invite_link": {"invite_link": invite_link, "creator": BOT_USER, "creates_join_request": False,
+                            "is_primary": False, "is_revoked": False},
+        })
+
+    def ban_callback(self, admin_id, user_id):
+        return self._update(callback_query={
+            "id": str(next(self._update_ids)),
+            "from": self.user(admin_id),
+            "chat_instance": "loadtest",
+            "data": f"ban_user:{user_id}",
+            "message": self._message(self.bot.id, {"id": admin_id, "type": "private"}, text="review"),
+        })
+
+
+########## RUNNER ##########
+
+class StatementCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def drain(application, baseline_tasks, database):
+    """Wait for tasks the handlers spawned with create_task and for scheduled jobs that are due soon
+    (albums, message deletions). Link expiry jobs minutes away are left pending."""
+    while True:
+        current = asyncio.current_task()
+        pending = [t for t in asyncio.all_tasks() if t is not current and t not in baseline_tasks]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        elif database.count_scheduled_jobs(due_before=datetime.now(timezone.utc) + timedelta(seconds=DRAIN_JOB_HORIZON_SECONDS)):
+            await asyncio.sleep(0.05)
+        else:
+            return
+
+
+async def run_scenario(name, application, updates, statements, concurrency, baseline_tasks, database):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(update):
+        async with semaphore:
+            start = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - start)
+
+    statements_before = statements.count
+    calls_before = Counter(application.bot.calls)
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(update) for update in updates))
+    await drain(application, baseline_tasks, database)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "scenario": name,
+        "updates": len(updates),
+        "seconds": round(elapsed, 4),
+        "throughput_per_s": round(len(updates) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "db_statements": statements.count - statements_before,
+        "bot_calls": dict(Counter(application.bot.calls) - calls_before),
+    }
+
+
+async def run(args) -> list:
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bouncerbot_loadtest_"), "loadtest.db")
+    db_utils.Database.DB_LOCATION = db_path
+
+    # Imported after DB_LOCATION is set, so build_application() opens the throwaway file.
+    import bouncerbot
+
+    resp_server = None
+    if args.resp_state:
+        resp_server = FakeRespServer(password="loadtest", drop_every=7)
+        resp_server.start()
+        check_resp_backend(RedisStateBackend(*resp_server.server_address, db=1, password="loadtest", timeout=2), resp_server)
+        bouncerbot.state = bouncerbot.create_state_backend(resp_server.url)
+
+    bot = FakeBot(latency=args.latency_ms / 1000, retry_after_rate=args.retry_after_rate, seed=args.seed)
+    application = bouncerbot.build_application(bot=bot)
+    statements = StatementCounter()
+    bouncerbot.db.connection.set_trace_callback(statements)
+
+    bouncerbot.chat_registry.add(DESTINATION_CHAT_ID, "Load Test Destination")
+    bouncerbot.db.update_settings("destination_chat_id", DESTINATION_CHAT_ID)
+    bouncerbot.db.record_destination_chat(DESTINATION_CHAT_ID)
+    # Stored in the throwaway database only; config.py is left alone
+    bouncerbot.runtime_config.set_override("AUTHORIZED_ADMINS", [ADMIN_ID])
+
+    await application.initialize()
+    await application.start()
+    await application.post_init(application)
+    baseline_tasks = set(asyncio.all_tasks())
+    await drain(application, baseline_tasks, bouncerbot.db)
+    baseline_tasks = set(asyncio.all_tasks())
+
+    factory = UpdateFactory(bot)
+    rng = random.Random(args.seed)
+    user_ids = [1_000_000 + i for i in range(args.users)]
+    single_users = user_ids[: len(user_ids) // 2]
+    album_users = user_ids[len(user_ids) // 2:]
+
+    results = []
+
+    async def scenario(name, updates):
+        result = await run_scenario(name, application, updates, statements, args.concurrency, baseline_tasks,
+                                    bouncerbot.db)
+        results.append(result)
+
+    await scenario("start_command", [factory.start(uid) for uid in user_ids])
+    await scenario("single_videos", [factory.video(uid) for uid in single_users for _ in range(max(bouncerbot.runtime_config.UPLOADS_NEEDED, 1))])
+    await scenario("recycled_video", [factory.video(uid, unique_id="viral") for uid in user_ids])
+    await scenario("albums_of_10", [u for uid in album_users for u in factory.album(uid, 10)])
+    await scenario("group_chatter", [factory.group_chatter(rng.choice(user_ids)) for _ in range(args.users * 5)])
+    await scenario("start_after_qualifying", [factory.start(uid) for uid in user_ids])
+
+    links = bouncerbot.db.return_all_users()
+    joins = [factory.join(row[0], row[7]) for row in links if row[7]]
+    await scenario("chat_member_joins", joins)
+
+    banned = rng.sample(user_ids, max(1, args.users // 20))
+    await scenario("ban_callbacks", [factory.ban_callback(ADMIN_ID, uid) for uid in banned])
+
+    await application.stop()
+    await application.shutdown()
+    bouncerbot.db.connection.close()
+    for result in results:
+        result["retry_afters_injected"] = bot.retry_afters
+    if resp_server is not None:
+        print(f"RESP state backend: {sum(resp_server.commands.values())} commands over {resp_server.connections} connections "
+              f"({', '.join(f'{name} {count}' for name, count in sorted(resp_server.commands.items()))})")
+        resp_server.stop()
+    return results
+
+
+def print_report(results):
+    header = f"{'scenario':<24}{'updates':>8}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'SQL':>8}{'SQL/upd':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        per_update = r["db_statements"] / r["updates"] if r["updates"] else 0
+        print(f"{r['scenario']:<24}{r['updates']:>8}{r['throughput_per_s'] or 0:>10}{r['p50_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['db_statements']:>8}{per_update:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive BouncerBot handlers with synthetic updates.")
+    parser.add_argument("--users", type=int, default=100, help="number of synthetic users")
+    parser.add_argument("--concurrency", type=int, default=16, help="updates processed at once")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake Bot API latency per call")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="fraction of Bot API calls that raise RetryAfter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--resp-state", action="store_true",
+                        help="keep shared state in a fake Redis-protocol server instead of memory")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+LOG_UTILS.PY
+
+Logging setup for BouncerBot. Handlers that touch the disk or the console run on a
+QueueListener thread, so code on the event loop only pays for a queue put. Log rotation
+happens on the listener thread as well and never blocks request handling.
+"""
+
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+
+# Attributes present on every LogRecord. Anything else on a record came in through `extra=`
+# and is written out as a structured field.
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock QueueHandler merges args into the message before enqueueing, which puts the
+    string formatting back on the caller. Records only travel within this process, so the
+    record can be handed over untouched.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level="INFO", log_file="app.log") -> QueueListener:
+    """Route all logging through a queue and return the (started) listener.
+
+    Call `listener.stop()` on shutdown to flush whatever is still queued.
+    """
+    # Rotate logs at midnight and retain them for 7 days
+    file_handler = TimedRotatingFileHandler(log_file, when='midnight', interval=1, backupCount=7)
+    file_handler.suffix = "%Y-%m-%d"  # Suffix for log files (e.g., 'app.log.2023-10-22')
+    file_handler.setFormatter(JsonFormatter())
+
+    # Console output stays terse and only shows WARNING or higher
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)
+    console_handler.setFormatter(logging.Formatter("BOUNCERBOT: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    return listener
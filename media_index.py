@@ -0,0 +1,40 @@
+"""
+MEDIA_INDEX.PY
+
+In-memory Bloom filter that sits in front of the media_index table. Most uploads are
+files the bot has never seen, and for those the filter answers "not present" without
+touching SQLite. A positive answer may be a false positive and is confirmed with a query.
+"""
+
+import math
+from hashlib import blake2b
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """Size the filter for `capacity` keys at roughly `error_rate` false positives."""
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def clear(self) -> None:
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
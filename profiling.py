@@ -0,0 +1,216 @@
+"""
+PROFILING.PY
+
+On-demand traces of update handling. While a profile is running, each of the next N updates
+gets a Trace, and every span opened while handling it (handlers, database statements and
+the wait for the database lock, Bot API requests) is recorded with its parent. Tasks
+started with asyncio.create_task inherit the trace, so work handed off by the *_loop
+wrappers is included.
+
+Finished profiles are written in the Chrome trace event format, one row per update.
+Open them in chrome://tracing, https://ui.perfetto.dev or speedscope.
+
+When no profile is running, span() is a single context variable lookup.
+"""
+
+import asyncio
+import json
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class Trace(object):
+
+    def __init__(self, label: str):
+        self.label = label
+        self.spans = []  # [name, category, start, end, parent index, args]
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ("trace", "index", "token")
+
+    def __init__(self, trace, name, category, args):
+        self.trace = trace
+        self.index = len(trace.spans)
+        trace.spans.append([name, category, None, None, _current_span.get(), args])
+
+    def __enter__(self):
+        self.token = _current_span.set(self.index)
+        self.trace.spans[self.index][2] = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.spans[self.index][3] = time.perf_counter()
+        _current_span.reset(self.token)
+        return False
+
+
+def span(name: str, category: str = "app", **args):
+    """Context manager recording `name` in the current trace, if there is one."""
+    trace = _current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return _Span(trace, name, category, args)
+
+
+def traced(callback, category: str = "handler"):
+    """Wrap an async callback so each call is recorded as a span."""
+    @wraps(callback)
+    async def wrapper(*args, **kwargs):
+        with span(callback.__name__, category):
+            return await callback(*args, **kwargs)
+    return wrapper
+
+
+class Profiler(object):
+
+    def __init__(self, settle_seconds: float = 2.0):
+        self.settle_seconds = settle_seconds
+        self.remaining = 0
+        self.running = 0
+        self.traces = []
+        self._on_complete = None
+
+    @property
+    def active(self) -> bool:
+        return self.remaining > 0 or self.running > 0
+
+    def start(self, num_updates: int, on_complete) -> None:
+        """Trace the next num_updates updates, then await on_complete(traces)."""
+        self.remaining = num_updates
+        self.running = 0
+        self.traces = []
+        self._on_complete = on_complete
+
+    def stop(self) -> None:
+        """Finish early with whatever has been traced so far."""
+        if self._on_complete is None:
+            return
+        self.remaining = 0
+        self._schedule_completion()
+
+    def trace_update(self, label: str):
+        if self.remaining <= 0:
+            return NULL_SPAN
+        self.remaining -= 1
+        return _UpdateTrace(self, label)
+
+    def _finished(self, trace) -> None:
+        self.running -= 1
+        if self.remaining <= 0 and self.running <= 0:
+            self._schedule_completion()
+
+    def _schedule_completion(self) -> None:
+        # Give tasks spawned by the last handlers a moment to finish their spans
+        on_complete, self._on_complete = self._on_complete, None
+        if on_complete is None:
+            return
+        traces = self.traces
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.settle_seconds, lambda: loop.create_task(on_complete(traces)))
+
+
+class _UpdateTrace(object):
+
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.trace = Trace(label)
+
+    def __enter__(self):
+        self.profiler.running += 1
+        self.profiler.traces.append(self.trace)
+        self.trace_token = _current_trace.set(self.trace)
+        self.root = _Span(self.trace, self.trace.label, "update", {})
+        self.root.__enter__()
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        self.root.__exit__(*exc_info)
+        _current_trace.reset(self.trace_token)
+        self.profiler._finished(self.trace)
+        return False
+
+
+profiler = Profiler()
+
+
+def describe_update(update: Update) -> str:
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith("/"):
+        return f"{update.update_id} {message.text.split()[0]}"
+    kind = next((kind for kind in Update.ALL_TYPES if getattr(update, kind, None) is not None), "update")
+    if kind == "message" and message is not None and message.video is not None:
+        kind = "video"
+    return f"{update.update_id} {kind}"
+
+
+class ProfilingApplication(Application):
+    """Application that traces updates while the module profiler is active."""
+
+    async def process_update(self, update: object) -> None:
+        if not profiler.active or not isinstance(update, Update):
+            return await super().process_update(update)
+        with profiler.trace_update(describe_update(update)):
+            return await super().process_update(update)
+
+
+class TracingRequest(HTTPXRequest):
+    """HTTPXRequest that records each Bot API call (by method name only, never the URL with the token)."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        with span(url.rsplit("/", 1)[-1], "bot_api"):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def chrome_trace(traces) -> dict:
+    """Convert traces to the Chrome trace event format, one thread row per update."""
+    events = []
+    starts = [trace.spans[0][2] for trace in traces if trace.spans and trace.spans[0][2] is not None]
+    origin = min(starts, default=0.0)
+    for tid, trace in enumerate(traces, 1):
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": trace.label}})
+        for index, (name, category, start, end, parent, args) in enumerate(trace.spans):
+            if start is None:
+                continue
+            if category == "db":
+                # Spans carry the raw statement so tracing costs nothing extra; tidy it up here
+                name = " ".join(name.split())[:120]
+            events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": round((start - origin) * 1e6, 1),
+                "dur": round(((end if end is not None else start) - start) * 1e6, 1),
+                "args": {"span": index, "parent": parent, **args},
+            })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(traces, file_path: str) -> str:
+    with open(file_path, "w") as f:
+        json.dump(chrome_trace(traces), f)
+    return file_path
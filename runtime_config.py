@@ -0,0 +1,164 @@
+"""
+RUNTIME_CONFIG.PY
+
+The settings that can change while the bot runs. Everything else in config.py is still
+read once at startup.
+
+Values come from config.py, overlaid with admin overrides stored in the settings table
+(as "config:<NAME>" = JSON). A reload builds and validates a complete new snapshot and
+then swaps it in with a single assignment, so readers never lock and never see a mix of
+old and new values; a value that fails validation leaves the running config untouched.
+
+Read a value with `runtime_config.UPLOADS_NEEDED`. Code that needs several values to agree
+takes `runtime_config.current` once and reads from that.
+"""
+
+import importlib
+import json
+import logging
+from types import SimpleNamespace
+
+
+OVERRIDE_PREFIX = "config:"
+
+
+class ConfigError(Exception):
+    pass
+
+
+def _non_negative_int(value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ConfigError("must be a whole number, 0 or more")
+    return value
+
+
+def _user_ids(value):
+    if not isinstance(value, (list, tuple)) or any(isinstance(item, bool) or not isinstance(item, int) for item in value):
+        raise ConfigError("must be a list of numeric user ids")
+    return list(value)
+
+
+def _optional_chat_id(value):
+    if value is None or value == 0:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ConfigError("must be a numeric chat id, or 0 for none")
+    return value
+
+
+def _message(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ConfigError("must be non-empty text")
+    return value
+
+
+# Name -> validator. Validators return the cleaned value or raise ConfigError.
+RELOADABLE = {
+    "UPLOADS_NEEDED": _non_negative_int,
+    "MINUTES_TO_LINK_EXPIRATION": _non_negative_int,  # 0 means links never expire
+    "AUTHORIZED_ADMINS": _user_ids,
+    "VIDEO_REVIEW_GROUP_ID": _optional_chat_id,
+    "START_MESSAGE": _message,
+    "HELP_MESSAGE": _message,
+    "SETUP_MESSAGE": _message,
+}
+
+
+def parse_value(name: str, text: str):
+    """turn an admin's /set argument into a value: JSON (numbers, lists) for the numeric settings, raw text for messages"""
+    if RELOADABLE[name] is _message:
+        return text
+    try:
+        return json.loads(text)
+    except ValueError:
+        raise ConfigError("is not a number or list")
+
+
+class RuntimeConfig(object):
+
+    def __init__(self, config_module):
+        self.config_module = config_module
+        self.database = None
+        self.overrides = {}
+        self.file_values = self._file_values()  # Last config.py values that passed validation
+        self.current = self._build(self.file_values, {})
+
+    def __getattr__(self, name):
+        if name == "current":
+            raise AttributeError(name)
+        return getattr(self.current, name)
+
+    def _file_values(self) -> dict:
+        return {name: getattr(self.config_module, name) for name in RELOADABLE}
+
+    @staticmethod
+    def _build(file_values: dict, overrides: dict) -> SimpleNamespace:
+        values = {}
+        for name, validate in RELOADABLE.items():
+            value = overrides.get(name, file_values[name])
+            try:
+                values[name] = validate(value)
+            except ConfigError as e:
+                source = "override" if name in overrides else "config.py"
+                raise ConfigError(f"{name} ({source}) {e}")
+        return SimpleNamespace(**values)
+
+    ########## LOADING ##########
+
+    def attach(self, database) -> None:
+        """read the admin overrides from the settings table and apply them"""
+        self.database = database
+        try:
+            self.reload(reread_file=False)
+        except ConfigError as e:
+            logging.error("Ignoring stored config overrides: %s", e)
+
+    def reload(self, reread_file: bool = True) -> list:
+        """re-read config.py (and the overrides) and swap in the new values. returns the names that changed.
+        raises ConfigError and keeps the running config if anything is invalid"""
+        if reread_file:
+            try:
+                self.config_module = importlib.reload(self.config_module)
+            except Exception as e:
+                raise ConfigError(f"config.py could not be loaded: {e}")
+        overrides = {}
+        if self.database is not None:
+            for setting, value in self.database.return_settings_with_prefix(OVERRIDE_PREFIX).items():
+                name = setting[len(OVERRIDE_PREFIX):]
+                if name in RELOADABLE:
+                    try:
+                        overrides[name] = json.loads(value)
+                    except ValueError:
+                        raise ConfigError(f"{name} (override) is not valid JSON")
+        file_values = self._file_values() if reread_file else self.file_values
+        snapshot = self._build(file_values, overrides)
+        self.file_values = file_values
+        return self._publish(snapshot, overrides)
+
+    def _publish(self, snapshot: SimpleNamespace, overrides: dict) -> list:
+        changed = [name for name in RELOADABLE if getattr(snapshot, name) != getattr(self.current, name)]
+        self.overrides = overrides
+        self.current = snapshot
+        if changed:
+            logging.warning("Config reloaded. Changed: %s", ", ".join(changed))
+        return changed
+
+    ########## OVERRIDES ##########
+
+    def set_override(self, name: str, value) -> None:
+        """validate and apply an admin override, then persist it. raises ConfigError if it is invalid"""
+        if name not in RELOADABLE:
+            raise ConfigError(f"{name} can't be changed at runtime")
+        overrides = {**self.overrides, name: value}
+        snapshot = self._build(self.file_values, overrides)
+        self.database.update_settings(OVERRIDE_PREFIX + name, json.dumps(value))
+        self._publish(snapshot, overrides)
+
+    def clear_override(self, name: str) -> None:
+        """go back to the config.py value"""
+        if name not in RELOADABLE:
+            raise ConfigError(f"{name} can't be changed at runtime")
+        overrides = {key: value for key, value in self.overrides.items() if key != name}
+        snapshot = self._build(self.file_values, overrides)
+        self.database.delete_setting(OVERRIDE_PREFIX + name)
+        self._publish(snapshot, overrides)
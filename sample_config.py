@@ -14,11 +14,27 @@ BOT_TOKEN = "XXXXXXX"
 DATABASE_PATH = "bouncerbot.db"
 
 """ SETTINGS """
+# AUTHORIZED_ADMINS, VIDEO_REVIEW_GROUP_ID, the three messages below, UPLOADS_NEEDED and
+# MINUTES_TO_LINK_EXPIRATION can be changed while the bot runs: edit this file and send /reload
+# (or `kill -HUP <pid>`), or use /set. Everything else needs a restart.
+
 # If this list is empty, your bot may be used by anyone who is an admin in a chat where the bot is operating. You can fill this 
 # list with authorized User IDs (separated by commas, no quotes) that are acceptable for use. 
 # Only those users listed will be able to command the bot, and the bot will only work in rooms where someone on the list is an admin.
 AUTHORIZED_ADMINS = [ ]
 
+# Chat ID of the group where qualifying users' uploads are forwarded for review. Set to None to disable.
+VIDEO_REVIEW_GROUP_ID = None
+
+# Level for the app.log file. Per-event chatter (uploads, joins) is logged at INFO/DEBUG;
+# the console only ever shows WARNING or higher.
+LOG_LEVEL = "INFO"
+
+# Repeated errors from the same place in the code are logged at most once per window.
+# Tracebacks are attached to this fraction of logged errors.
+ERROR_LOG_WINDOW_SECONDS = 60
+ERROR_TRACEBACK_SAMPLE_RATE = 0.01
+
 
 START_MESSAGE =  ("Just <strong>post or forward a sample video here</strong> so that we know you have material to share.\n\n"
                 "The bot will respond with your link!\n"
@@ -35,9 +51,90 @@ SETUP_MESSAGE =("ADMIN SETUP INSTRUCTIONS\n\n"
                 "4. In your publicizing channel, add a single post to the channel telling people to start a chat with the bot (and remember to give the bot's link).\n\n"
                 "5. Publicize the instruction channel to your users. Users can get their one-time link to your protected group by saying `/start` in the bot chat.\n\n"
                 "6. Use the /csv command to get a list of all users who have used the bot. If a group nukes, bot will store users in a csv.\n\n"
+                "7. To protect more than one group, use /setchat <chat_id> [uploads_needed] [minutes_to_link_expiration] for each group, and /destinations to list them with their /start deep links. /removechat <chat_id> removes one.\n\n"
+                "8. To ban many accounts at once, use /bulkban <user_id> [user_id ...], /bulkban file <unique_file_id> to ban everyone who shared a video, or send a CSV of user IDs with the caption /bulkban.\n\n"
+                "9. /stats shows, for each group, how many users started the bot, uploaded, qualified, got links, joined and were banned today, this week and this month. /events [days] [kind ...] sends the full event log for the last days as a CSV.\n\n"
+                "10. The database is backed up automatically. /backup takes a backup right away and reports how it went.\n\n"
+                "11. If the bot feels slow, /profile [number_of_updates] records where the time goes for the next updates and sends you a trace file. /profile stop ends it early.\n\n"
+                "12. After editing config.py, /reload applies the new settings without a restart. /set lists the settings that can change while the bot runs, /set <NAME> <value> changes one and /set <NAME> reset goes back to config.py.\n\n"
                 
 )
 
 
+# Defaults for every destination group. /setchat can override them per group.
 UPLOADS_NEEDED = 5
-MINUTES_TO_LINK_EXPIRATION = 10
\ No newline at end of file
+MINUTES_TO_LINK_EXPIRATION = 10
+
+# Cross-user duplicate detection. When a video has already been submitted by more than
+# MEDIA_REUSE_LIMIT different users, it is either rejected ("reject") or saved without counting
+# toward UPLOADS_NEEDED ("downweight"). Set MEDIA_REUSE_LIMIT to 0 to disable.
+MEDIA_REUSE_LIMIT = 0
+MEDIA_REUSE_POLICY = "downweight"
+
+# Expected number of distinct media files; sizes the in-memory filter in front of the media index.
+MEDIA_INDEX_BLOOM_CAPACITY = 1000000
+
+
+# Running several bot processes. Every worker needs the same STATE_BACKEND_URL (a Redis-protocol
+# server, e.g. "redis://localhost:6379/0") and DATABASE_PATH. Worker 0 polls Telegram and routes each
+# user's updates to worker (user_id % WORKER_COUNT). Keep the defaults for a single process.
+STATE_BACKEND_URL = "memory://"
+WORKER_COUNT = 1
+WORKER_INDEX = 0
+
+# Delayed work (album processing, message deletions, invite link expiry) is stored in the database
+# and survives restarts. Due jobs are checked every SCHEDULER_TICK_SECONDS, up to SCHEDULER_BATCH_SIZE at a time.
+SCHEDULER_TICK_SECONDS = 1
+SCHEDULER_BATCH_SIZE = 100
+
+# Periodic database cleanup: forgets expired invite links and moves users who never uploaded anything
+# out of the main table after ABANDONED_USER_RETENTION_DAYS (into archived_users, or deleted if
+# ARCHIVE_ABANDONED_USERS is False).
+# Each run stops after MAINTENANCE_TIME_BUDGET_SECONDS and the next one picks up where it left off.
+# Set MAINTENANCE_INTERVAL_MINUTES to 0 to turn it off.
+MAINTENANCE_INTERVAL_MINUTES = 60
+MAINTENANCE_TIME_BUDGET_SECONDS = 5
+ABANDONED_USER_RETENTION_DAYS = 90
+ARCHIVE_ABANDONED_USERS = True
+
+# Forwards to VIDEO_REVIEW_GROUP_ID are queued and sent at most REVIEW_MESSAGES_PER_MINUTE per minute
+# (Telegram allows about 20 messages a minute in a group). A warning is logged when more than
+# REVIEW_BACKLOG_WARNING users are waiting to be forwarded.
+REVIEW_MESSAGES_PER_MINUTE = 20
+REVIEW_BACKLOG_WARNING = 50
+
+# Unused invite links that were replaced by a newer one, expired or belong to a banned user are
+# revoked in Telegram in the background, so they don't pile up in each group's list of invite links.
+# At most LINK_REVOCATIONS_PER_MINUTE are revoked per group. Set it to 0 to turn this off.
+LINK_REVOCATIONS_PER_MINUTE = 20
+
+# How many unused invite links to keep in memory for matching join events. Beyond this the
+# oldest links are looked up in the database instead.
+OUTSTANDING_LINKS_CAPACITY = 100000
+
+# Flood protection for /start and uploads in the bot's private chat. Each user may send
+# ADMISSION_BURST of them at once and earns ADMISSION_RATE_PER_MINUTE more per minute (an album
+# counts once). Past that they get one "slow down" notice and are ignored for the rest, and after
+# ADMISSION_STRIKES_TO_IGNORE refused requests in a row they are ignored for ADMISSION_IGNORE_MINUTES.
+# Set ADMISSION_RATE_PER_MINUTE = 0 to turn this off. Admins are never limited.
+ADMISSION_RATE_PER_MINUTE = 10
+ADMISSION_BURST = 10
+ADMISSION_STRIKES_TO_IGNORE = 20
+ADMISSION_IGNORE_MINUTES = 10
+
+# Catch re-encoded or trimmed copies of a video, which Telegram treats as new files, by comparing
+# thumbnails. Needs Pillow (pip install Pillow) and costs two extra Bot API calls per upload.
+# Thumbnails whose fingerprints differ in at most NEAR_DUPLICATE_MAX_DISTANCE of 64 bits count as the
+# same video: a repeat from the same user is rejected, and copies from other users count toward
+# MEDIA_REUSE_LIMIT. Hashing runs in FINGERPRINT_WORKERS background processes.
+NEAR_DUPLICATE_DETECTION = False
+NEAR_DUPLICATE_MAX_DISTANCE = 6
+FINGERPRINT_WORKERS = 2
+
+# Online backups of the database, taken every BACKUP_INTERVAL_HOURS while the bot keeps running and
+# stored gzipped in BACKUP_DIRECTORY. The newest BACKUP_KEEP are kept. With BACKUP_VERIFY each new backup
+# is unpacked and checked with PRAGMA integrity_check. Set BACKUP_INTERVAL_HOURS = 0 to turn backups off.
+BACKUP_INTERVAL_HOURS = 24
+BACKUP_DIRECTORY = "backups"
+BACKUP_KEEP = 7
+BACKUP_VERIFY = True
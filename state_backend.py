@@ -0,0 +1,233 @@
+"""
+STATE_BACKEND.PY
+
+Shared state for BouncerBot workers. Everything that used to live only in module globals
+(registration menus, grant locks, and the per-worker update queues) goes
+through a StateBackend, so several bot processes can share it.
+
+    memory://                       in-process dicts (single worker, the default)
+    redis://[:password@]host:port/db  any server that speaks the Redis protocol
+
+The Redis client is a minimal RESP implementation over a plain socket, so no extra
+package is needed. Its calls block on the network, so `blocking` is True and the bot runs
+them in a thread instead of on the event loop.
+
+A dropped connection is only retried when repeating the command is harmless. After a
+dropped SET NX the key is read back to see whether the lost reply was a yes, which is why
+set_if_absent callers must use a value of their own (e.g. a random token). RPUSH is
+retried, so a queued item can arrive twice and consumers must tolerate repeats.
+"""
+
+import socket
+import time
+from collections import deque
+from threading import RLock
+from urllib.parse import urlparse
+
+
+KEY_PREFIX = "bouncerbot:"
+
+
+class StateBackendError(Exception):
+    pass
+
+
+class StateBackend(object):
+    """Interface shared by all state backends. Values are strings."""
+
+    blocking = False  # True if calls wait on the network
+
+    def get(self, key: str):
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: float = None) -> None:
+        raise NotImplementedError
+
+    def set_if_absent(self, key: str, value: str, ttl: float = None) -> bool:
+        """Set `key` only if it does not exist. Returns True if this call set it."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def push(self, key: str, value: str) -> None:
+        """Append a value to the queue stored at `key`."""
+        raise NotImplementedError
+
+    def pop(self, key: str, timeout: float = 0):
+        """Remove and return the oldest value in the queue at `key`, waiting up to `timeout` seconds."""
+        raise NotImplementedError
+
+
+class LocalStateBackend(StateBackend):
+
+    def __init__(self):
+        self.lock = RLock()
+        self._values = {}
+        self._queues = {}
+
+    def _live_value(self, key):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        return value
+
+    def get(self, key):
+        with self.lock:
+            return self._live_value(key)
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self.lock:
+            if self._live_value(key) is not None:
+                return False
+            self._values[key] = (value, time.monotonic() + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self._values.pop(key, None)
+
+    def push(self, key, value):
+        with self.lock:
+            self._queues.setdefault(key, deque()).append(value)
+
+    def pop(self, key, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                queue = self._queues.get(key)
+                if queue:
+                    return queue.popleft()
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+
+
+class RedisStateBackend(StateBackend):
+
+    blocking = True
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=5.0):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.lock = RLock()
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._send_and_read(("AUTH", self.password))
+        if self.db:
+            self._send_and_read(("SELECT", self.db))
+
+    def _close(self):
+        try:
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._file = None
+
+    def _send_and_read(self, args):
+        encoded = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+        payload = b"*%d\r\n" % len(encoded) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in encoded)
+        self._sock.sendall(payload)
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("State backend closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise StateBackendError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            return self._file.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise StateBackendError(f"Unexpected reply from state backend: {line!r}")
+
+    def command(self, *args, timeout=None, retry=True):
+        """Run one command and return its decoded reply. Reconnects once on a dropped connection; with
+        retry=False a command that may already have reached the server is not sent again and the error is raised"""
+        with self.lock:
+            for attempt in (1, 2):
+                sent = False
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.settimeout(self.timeout if timeout is None else timeout)
+                    sent = True
+                    return self._send_and_read(args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt == 2 or (sent and not retry):
+                        raise
+
+    def get(self, key):
+        return self.command("GET", KEY_PREFIX + key)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.command("SET", KEY_PREFIX + key, value, "PX", int(ttl * 1000))
+        else:
+            self.command("SET", KEY_PREFIX + key, value)
+
+    def set_if_absent(self, key, value, ttl=None):
+        args = ["SET", KEY_PREFIX + key, value, "NX"]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        try:
+            return self.command(*args, retry=False) == "OK"
+        except (OSError, ConnectionError):
+            # The reply was lost, so the SET may or may not have happened. It did if the key holds our value;
+            # if the key is still free it never arrived and is sent again on the new connection.
+            owner = self.get(key)
+            if owner is None:
+                return self.command(*args, retry=False) == "OK"
+            return owner == value
+
+    def delete(self, key):
+        self.command("DEL", KEY_PREFIX + key)
+
+    def push(self, key, value):
+        self.command("RPUSH", KEY_PREFIX + key, value)
+
+    def pop(self, key, timeout=0):
+        if not timeout:
+            return self.command("LPOP", KEY_PREFIX + key)
+        reply = self.command("BLPOP", KEY_PREFIX + key, timeout, timeout=timeout + self.timeout)
+        return reply[1] if reply else None
+
+
+def create_state_backend(url: str = "memory://") -> StateBackend:
+    """Build a backend from a URL such as memory:// or redis://:secret@localhost:6379/0"""
+    parsed = urlparse(url or "memory://")
+    if parsed.scheme == "memory":
+        return LocalStateBackend()
+    if parsed.scheme == "redis":
+        db = int(parsed.path.lstrip("/") or 0)
+        return RedisStateBackend(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password)
+    raise ValueError(f"Unsupported state backend URL: {url}")